@@ -1,3 +1,17 @@
 from django.contrib import admin
+from .models import EndpointProfile
 
-# Register your models here.
+
+@admin.register(EndpointProfile)
+class EndpointProfileAdmin(admin.ModelAdmin):
+    """Худшие точки входа по SQL: сортировка по максимуму запросов, времени и N+1"""
+    list_display = (
+        'endpoint', 'calls', 'avg_queries', 'max_queries', 'query_budget', 'over_budget_calls',
+        'avg_db_time_ms', 'max_db_time_ms', 'duplicate_queries', 'n_plus_one_calls', 'last_seen',
+    )
+    search_fields = ('endpoint',)
+    ordering = ('-max_queries', '-max_db_time_ms')
+    readonly_fields = [field.name for field in EndpointProfile._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
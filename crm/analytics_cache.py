@@ -0,0 +1,102 @@
+"""
+Кэш аналитики с точной инвалидацией и отдачей устаревших данных на время пересчета.
+
+Каждая запись хранится под стабильным ключом (период + диапазон) вместе с поколением
+данных и моментом устаревания. Сохранение или удаление Payment, TimeEntry, Case
+и Client увеличивает поколение (см. crm.signals), после чего все записи считаются
+устаревшими. Устаревшую запись пересчитывает только один воркер, захвативший
+блокировку, остальные в это время получают прежнее значение.
+"""
+import time
+from django.conf import settings
+from django.core.cache import cache
+from .utils import generate_analytics
+
+CACHE_PREFIX = 'analytics'
+GENERATION_KEY = f'{CACHE_PREFIX}:generation'
+STATS_KEYS = ('hits', 'stale_hits', 'misses', 'refreshes', 'invalidations')
+
+def _ttl():
+    return getattr(settings, 'ANALYTICS_CACHE_TTL', 300)
+
+def _stale_ttl():
+    return getattr(settings, 'ANALYTICS_CACHE_STALE_TTL', 3600)
+
+def _lock_ttl():
+    return getattr(settings, 'ANALYTICS_CACHE_LOCK_TTL', 60)
+
+def _entry_key(period, date_from, date_to):
+    return f'{CACHE_PREFIX}:entry:{period}:{date_from or ""}:{date_to or ""}'
+
+def _incr(name):
+    key = f'{CACHE_PREFIX}:stats:{name}'
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Счетчик вытеснен между add и incr
+        cache.set(key, 1, timeout=None)
+
+def _current_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, 1, timeout=None)
+        generation = cache.get(GENERATION_KEY, 1)
+    return generation
+
+def _store(key, generation, data):
+    cache.set(key, {
+        'generation': generation,
+        'fresh_until': time.time() + _ttl(),
+        'data': data,
+    }, timeout=_ttl() + _stale_ttl())
+
+def get_cached_analytics(period='month', date_from=None, date_to=None, compute=generate_analytics):
+    """Аналитика из кэша; при промахе или устаревании - пересчет через compute"""
+    key = _entry_key(period, date_from, date_to)
+    generation = _current_generation()
+    entry = cache.get(key)
+    
+    if entry is not None:
+        if entry['generation'] == generation and entry['fresh_until'] > time.time():
+            _incr('hits')
+            return entry['data']
+        
+        # Запись устарела: пересчитывает один воркер, остальные отдают старое значение
+        lock_key = f'{key}:lock'
+        if not cache.add(lock_key, 1, timeout=_lock_ttl()):
+            _incr('stale_hits')
+            return entry['data']
+        try:
+            data = compute(period=period, date_from=date_from, date_to=date_to)
+            _store(key, generation, data)
+            _incr('refreshes')
+        finally:
+            cache.delete(lock_key)
+        return data
+    
+    _incr('misses')
+    data = compute(period=period, date_from=date_from, date_to=date_to)
+    _store(key, generation, data)
+    return data
+
+def invalidate_analytics_cache():
+    """Пометить все записи аналитики устаревшими"""
+    _current_generation()
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, 1, timeout=None)
+    _incr('invalidations')
+
+def analytics_cache_stats():
+    """Счетчики попаданий и промахов кэша аналитики"""
+    values = cache.get_many([f'{CACHE_PREFIX}:stats:{name}' for name in STATS_KEYS])
+    stats = {name: values.get(f'{CACHE_PREFIX}:stats:{name}', 0) for name in STATS_KEYS}
+    requests_total = stats['hits'] + stats['stale_hits'] + stats['misses'] + stats['refreshes']
+    stats['hit_rate'] = round((stats['hits'] + stats['stale_hits']) / requests_total * 100, 1) if requests_total else 0
+    stats['generation'] = _current_generation()
+    return stats
+
+def reset_analytics_cache_stats():
+    cache.delete_many([f'{CACHE_PREFIX}:stats:{name}' for name in STATS_KEYS])
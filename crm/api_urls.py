@@ -0,0 +1,22 @@
+from django.urls import path
+from . import views
+
+urlpatterns = [
+    path('calendar/events/', views.get_calendar_events, name='api_calendar_events'),
+    path('calendar/sync/', views.calendar_sync_delta, name='api_calendar_sync'),
+    path('calendar/ics/<uuid:token>/', views.calendar_ics, name='api_calendar_ics'),
+    path('calendar/free-busy/', views.free_busy_search, name='api_free_busy'),
+    path('calendar/events/<int:pk>/occurrences/', views.calendar_occurrence_update, name='api_calendar_occurrence'),
+    path('tasks/<int:task_id>/update-status/', views.update_task_status, name='api_update_task_status'),
+    path('analytics/', views.analytics_series, name='api_analytics'),
+    path('analytics/cache-stats/', views.analytics_cache_status, name='api_analytics_cache_stats'),
+    path('clients/top/', views.top_clients, name='api_top_clients'),
+    path('payroll/', views.payroll_export, name='api_payroll'),
+    path('cases/<int:pk>/report/', views.case_report_export, name='api_case_report'),
+    path('exports/<slug:kind>/', views.export_list, name='api_export'),
+    path('search/', views.global_search, name='api_search'),
+    path('tasks/bulk/', views.bulk_task_update, name='api_tasks_bulk'),
+    path('tasks/', views.task_list, name='api_tasks'),
+    path('notifications/', views.notification_list, name='api_notifications'),
+    path('time-entries/', views.time_entry_list, name='api_time_entries'),
+]
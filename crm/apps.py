@@ -1,5 +1,12 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class CrmAppConfig(AppConfig):
-    name = 'crm_app'
+    name = 'crm'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        if getattr(settings, 'SQL_PROFILING', False):
+            from .profiling import connect_celery_profiling
+            connect_celery_profiling()
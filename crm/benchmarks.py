@@ -0,0 +1,147 @@
+"""
+Замеры горячих путей: время, количество запросов и пиковая память.
+
+Данные берутся из текущей БД (см. команду seed_firm), результаты сравниваются
+с сохраненным эталоном отдельно для каждой СУБД и масштаба.
+"""
+import json
+import statistics
+import time
+import tracemalloc
+from django.core.paginator import Page
+from django.db import connection
+from django.db.models import Count, QuerySet
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.views.generic.detail import SingleObjectMixin
+from django.views.generic.list import MultipleObjectMixin
+from .analytics_cache import invalidate_analytics_cache
+from .models import CustomUser, Case
+from .utils import generate_analytics, generate_case_report
+
+BENCHMARK_USERNAME = 'synthetic_benchmark_manager'
+
+def _evaluate(value):
+    """Принудительное выполнение ленивых запросов из контекста представления"""
+    if isinstance(value, QuerySet):
+        return list(value)
+    if isinstance(value, Page):
+        return list(value.object_list)
+    if isinstance(value, dict):
+        return {key: _evaluate(item) for key, item in value.items()}
+    return value
+
+def _view_context(view_class, user, params=None, **kwargs):
+    request = RequestFactory().get('/', params or {})
+    request.user = user
+    view = view_class()
+    view.setup(request, **kwargs)
+    if isinstance(view, MultipleObjectMixin):
+        view.object_list = view.get_queryset()
+    elif isinstance(view, SingleObjectMixin):
+        view.object = view.get_object()
+    return _evaluate(view.get_context_data())
+
+def _section_context(user, case_id, section):
+    from .views import CaseSectionView
+    
+    request = RequestFactory().get('/')
+    request.user = user
+    return _evaluate(CaseSectionView.as_view()(request, pk=case_id, section=section).context_data)
+
+def benchmark_fixtures():
+    """Пользователь-менеджер и самое «тяжелое» дело для замеров"""
+    manager, _ = CustomUser.objects.get_or_create(
+        username=BENCHMARK_USERNAME,
+        defaults={'role': 'manager'}
+    )
+    heaviest_case = Case.objects.annotate(
+        entries_count=Count('time_entries')
+    ).order_by('-entries_count').values_list('id', flat=True).first()
+    return manager, heaviest_case
+
+def hot_paths(manager, case_id):
+    from .views import DashboardView, CaseListView, CaseDetailView
+
+    def dashboard():
+        invalidate_analytics_cache()
+        return _view_context(DashboardView, manager)
+
+    paths = {
+        'dashboard': dashboard,
+        'case_list': lambda: _view_context(CaseListView, manager),
+        'case_list_search': lambda: _view_context(CaseListView, manager, {'search': 'дело 1'}),
+        'generate_analytics_year': lambda: generate_analytics('year'),
+    }
+    if case_id:
+        paths['case_detail'] = lambda: _view_context(CaseDetailView, manager, pk=case_id)
+        paths['case_detail_time_entries'] = lambda: _section_context(manager, case_id, 'time_entries')
+        paths['generate_case_report'] = lambda: generate_case_report(case_id)
+    return paths
+
+def measure(func, repeat=3):
+    """Медиана времени и число запросов по repeat запускам, пиковая память - отдельным запуском"""
+    timings = []
+    queries = 0
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - started) * 1000)
+        queries = len(captured.captured_queries)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'wall_ms': round(statistics.median(timings), 2),
+        'queries': queries,
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+def run_benchmarks(repeat=3, only=None):
+    manager, case_id = benchmark_fixtures()
+    return {
+        name: measure(func, repeat)
+        for name, func in hot_paths(manager, case_id).items()
+        if not only or name in only
+    }
+
+def compare_with_baseline(results, baseline, tolerance=0.25):
+    """
+    Список регрессий относительно эталона. Время и память допускают отклонение
+    tolerance (доля), количество запросов должно совпадать или уменьшиться.
+    """
+    regressions = []
+    for name, current in results.items():
+        reference = baseline.get(name)
+        if not reference:
+            continue
+        if current['queries'] > reference['queries']:
+            regressions.append(f"{name}: запросов {current['queries']} > {reference['queries']}")
+        for metric in ('wall_ms', 'peak_kb'):
+            if current[metric] > reference[metric] * (1 + tolerance):
+                regressions.append(f'{name}: {metric} {current[metric]} > {reference[metric]} (+{int(tolerance * 100)}%)')
+    return regressions
+
+def load_baseline(path, tier):
+    try:
+        with open(path, encoding='utf-8') as baseline_file:
+            return json.load(baseline_file).get(connection.vendor, {}).get(tier, {})
+    except FileNotFoundError:
+        return {}
+
+def save_baseline(path, tier, results):
+    try:
+        with open(path, encoding='utf-8') as baseline_file:
+            data = json.load(baseline_file)
+    except FileNotFoundError:
+        data = {}
+    data.setdefault(connection.vendor, {})[tier] = results
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as baseline_file:
+        json.dump(data, baseline_file, ensure_ascii=False, indent=2, sort_keys=True)
@@ -0,0 +1,242 @@
+"""
+Лента событий календаря для FullCalendar: окно ?start=&end= и условный GET.
+
+Событие попадает в окно, если пересекается с ним (start_time < end и
+end_time > start), - события на границах окна не теряются. Выбираются
+только события, созданные пользователем или с его участием.
+
+У каждого пользователя есть версия календаря в кэше (момент последнего
+изменения его событий в микросекундах), ее увеличивают сигналы CalendarEvent
+и участников (см. crm.signals). ETag и Last-Modified строятся из версии,
+поэтому повторный запрос неизменного окна получает 304 без запроса к
+событиям. Если версия вытеснена из кэша, она начинается заново с текущего
+момента - клиент один раз получит полный ответ, а не устаревший 304.
+"""
+import hashlib
+import time
+from datetime import datetime, time as day_time, timedelta, timezone as dt_timezone
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from .models import CalendarEvent, CalendarEventOverride
+from .recurrence import RecurrenceError
+
+VERSION_PREFIX = 'calendar_version'
+# Самое длинное окно, которое можно запросить
+MAX_WINDOW = timedelta(days=62)
+# Виды страницы календаря: ?view= -> вид FullCalendar
+CALENDAR_VIEWS = {
+    'month': 'dayGridMonth',
+    'week': 'timeGridWeek',
+    'day': 'timeGridDay',
+}
+
+def _version_key(user_id):
+    return f'{VERSION_PREFIX}:{user_id}'
+
+def _now_version():
+    return time.time_ns() // 1000
+
+def calendar_version(user_id):
+    version = cache.get(_version_key(user_id))
+    if version is None:
+        cache.add(_version_key(user_id), _now_version(), timeout=None)
+        version = cache.get(_version_key(user_id), _now_version())
+    return version
+
+def bump_calendar_versions(user_ids):
+    """Новая версия календаря пользователей user_ids (строго больше прежней)"""
+    keys = {_version_key(user_id): user_id for user_id in set(user_ids) - {None}}
+    if not keys:
+        return
+    now = _now_version()
+    current = cache.get_many(keys)
+    cache.set_many({key: max(now, current.get(key, 0) + 1) for key in keys}, timeout=None)
+
+def version_modified(version):
+    return datetime.fromtimestamp(version / 1_000_000, tz=dt_timezone.utc)
+
+def parse_moment(value):
+    """Момент из строки: дата-время ISO 8601 или дата (полночь по местному времени)"""
+    value = value or ''
+    # «+» смещения в неэкранированной строке запроса приходит пробелом
+    moment = parse_datetime(value) or parse_datetime(value.replace(' ', '+'))
+    if moment is None:
+        day = parse_date(value[:10])
+        if day is None:
+            return None
+        moment = datetime.combine(day, day_time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+def parse_window(params):
+    """(start, end) из ?start=&end= или None при некорректном окне"""
+    start, end = parse_moment(params.get('start')), parse_moment(params.get('end'))
+    if not start or not end or start >= end or end - start > MAX_WINDOW:
+        return None
+    return start, end
+
+def view_window(view, day):
+    """
+    Окно вида view с датой day так, как его запросит FullCalendar (неделя с
+    понедельника): месяц - шесть недель сетки, неделя, день.
+    """
+    if view == 'day':
+        first, days = day, 1
+    elif view == 'week':
+        first, days = day - timedelta(days=day.weekday()), 7
+    else:
+        month_start = day.replace(day=1)
+        first, days = month_start - timedelta(days=month_start.weekday()), 42
+    return (
+        timezone.make_aware(datetime.combine(first, day_time.min)),
+        timezone.make_aware(datetime.combine(first + timedelta(days=days), day_time.min)),
+    )
+
+class Occurrence:
+    """
+    Событие в окне: одиночное событие или повторение серии с учетом его
+    изменения. Остальные атрибуты берутся из события.
+    """
+
+    def __init__(self, event, original_start=None, override=None):
+        self.event = event
+        self.original_start = original_start
+        self.override = override
+        self.start_time = override and override.start_time or original_start or event.start_time
+        self.end_time = override and override.end_time or self.start_time + (event.end_time - event.start_time)
+        for field in ('title', 'description', 'location'):
+            setattr(self, field, override and getattr(override, field) or getattr(event, field))
+
+    def __getattr__(self, name):
+        return getattr(self.event, name)
+
+    @property
+    def id(self):
+        if self.original_start is None:
+            return self.event.pk
+        return f'{self.event.pk}:{int(self.original_start.timestamp())}'
+
+    @property
+    def is_cancelled(self):
+        return bool(self.override and self.override.is_cancelled)
+
+def window_filter(start, end, prefix=''):
+    """
+    Условие на события, которые могут попасть в окно [start, end): одиночные
+    события, пересекающиеся с окном, серии, начатые до конца окна и не
+    закончившиеся до его начала, и серии с повторением, перенесенным в окно.
+    prefix - путь к событию от другой модели (например, 'calendarevent__').
+    """
+    moved = CalendarEventOverride.objects.filter(start_time__lt=end, end_time__gt=start).values('event_id')
+    single = Q(**{f'{prefix}recurrence_rule': '', f'{prefix}start_time__lt': end, f'{prefix}end_time__gt': start})
+    series = (
+        ~Q(**{f'{prefix}recurrence_rule': ''}) & Q(**{f'{prefix}start_time__lt': end})
+        & (Q(**{f'{prefix}recurrence_end__isnull': True}) | Q(**{f'{prefix}recurrence_end__gt': start}))
+    )
+    return single | series | Q(**{f'{prefix}pk__in': moved})
+
+def expand_occurrences(events, start, end):
+    """
+    События из events (выбранных по window_filter), пересекающиеся с окном
+    [start, end), с развернутыми сериями, без отмененных повторений, по времени.
+    """
+    events = list(events)
+    series = {event.pk: event for event in events if event.recurrence_rule}
+    overrides = {}
+    if series:
+        longest = max(event.end_time - event.start_time for event in series.values())
+        overrides = {
+            (override.event_id, override.original_start): override
+            for override in CalendarEventOverride.objects.filter(
+                Q(original_start__lt=end, original_start__gt=start - longest)
+                | Q(start_time__lt=end, end_time__gt=start),
+                event_id__in=series,
+            )
+        }
+
+    occurrences = []
+    for event in events:
+        if not event.recurrence_rule:
+            occurrences.append(Occurrence(event))
+            continue
+        for original_start in event.rule.occurrences(event.start_time, event.end_time - event.start_time, start, end):
+            occurrences.append(Occurrence(event, original_start, overrides.pop((event.pk, original_start), None)))
+    # Повторения, перенесенные в окно из-за его пределов
+    occurrences.extend(
+        Occurrence(series[event_id], original_start, override)
+        for (event_id, original_start), override in overrides.items()
+    )
+    return sorted(
+        (
+            occurrence for occurrence in occurrences
+            if not occurrence.is_cancelled and occurrence.start_time < end and occurrence.end_time > start
+        ),
+        key=lambda occurrence: (occurrence.start_time, occurrence.event.pk),
+    )
+
+def user_events(user, start, end):
+    """События пользователя (созданные им или с его участием), которые могут попасть в окно [start, end)"""
+    participation = CalendarEvent.participants.through.objects.filter(customuser=user).values('calendarevent_id')
+    return CalendarEvent.objects.filter(
+        Q(created_by=user) | Q(pk__in=participation),
+        window_filter(start, end),
+    ).select_related('case').order_by('start_time', 'pk')
+
+def user_occurrences(user, start, end):
+    return expand_occurrences(user_events(user, start, end), start, end)
+
+def save_occurrence_override(event, original_start, cancel=False, **changes):
+    """
+    Изменение повторения серии event, начинающегося по правилу в original_start:
+    отмена (cancel) или поля title, description, location, start_time, end_time.
+    Перенос хранится парой start_time/end_time, недостающая граница
+    достраивается по длительности серии.
+    """
+    duration = event.end_time - event.start_time
+    if not event.recurrence_rule or original_start not in event.rule.occurrences(
+        event.start_time, duration, original_start, original_start + timedelta(microseconds=1)
+    ):
+        raise RecurrenceError('В серии нет такого повторения')
+    start_time, end_time = changes.pop('start_time', None), changes.pop('end_time', None)
+    if start_time or end_time:
+        start_time = start_time or (end_time - duration if end_time else original_start)
+        end_time = end_time or start_time + duration
+        if start_time >= end_time:
+            raise RecurrenceError('Повторение должно заканчиваться после начала')
+
+    override, _ = CalendarEventOverride.objects.update_or_create(
+        event=event, original_start=original_start,
+        defaults={'is_cancelled': cancel, 'start_time': start_time, 'end_time': end_time, **changes},
+    )
+    return override
+
+def serialize_event(occurrence):
+    return {
+        'id': occurrence.id,
+        'series_id': occurrence.event.pk if occurrence.original_start else None,
+        'original_start': timezone.localtime(occurrence.original_start).isoformat() if occurrence.original_start else None,
+        'title': occurrence.title,
+        'start': timezone.localtime(occurrence.start_time).isoformat(),
+        'end': timezone.localtime(occurrence.end_time).isoformat(),
+        'allDay': occurrence.is_all_day,
+        'color': occurrence.color,
+        'type': occurrence.event_type,
+        'case_id': occurrence.case_id,
+        'case': occurrence.case.title if occurrence.case else None,
+        'location': occurrence.location,
+        'description': occurrence.description,
+    }
+
+def feed_etag(request):
+    """ETag окна: пользователь, версия его календаря и границы окна (без запросов к событиям)"""
+    window = parse_window(request.GET)
+    if window is None:
+        return None
+    signature = f'{request.user.pk}:{calendar_version(request.user.pk)}:{window[0].isoformat()}:{window[1].isoformat()}'
+    return hashlib.md5(signature.encode()).hexdigest()
+
+def feed_last_modified(request):
+    return version_modified(calendar_version(request.user.pk))
@@ -0,0 +1,303 @@
+"""
+Синхронизация календаря с внешними клиентами: ICS-лента пользователя и
+выдача изменений по токену.
+
+Изменения событий пишутся сигналами в журнал CalendarChange - одна строка
+на пару (пользователь, событие), при новом изменении она заменяется строкой
+с новым id. Поэтому «что изменилось после токена N» - это строки
+пользователя с id > N, не больше одной на событие, в том числе удаления
+(tombstones: событие удалено или пользователь исключен из участников).
+
+Номер изменения выдается при вставке, а видна строка после фиксации
+транзакции, поэтому строки моложе CALENDAR_SYNC_SETTLE отдаются, но токен за
+них не продвигается: если рядом фиксируется транзакция с меньшим номером, ее
+изменение придет в следующий раз, а уже полученные повторятся (upsert и
+delete идемпотентны).
+
+Токен - подписанный номер изменения с меткой времени. Удаления хранятся
+CALENDAR_SYNC_TOKEN_TTL, столько же действует токен: по более старому токену
+удаление могло быть уже стерто, и клиент получает SyncTokenExpired (полная
+синхронизация). Серия передается одним событием с правилом и изменениями
+повторений, как в iCalendar (RRULE, EXDATE, RECURRENCE-ID).
+
+Внешние сервисы подключаются классами из CALENDAR_SYNC_CLIENTS с методами
+replace_all(events), upsert(event) и delete(uid); LocalCalendarClient -
+клиент в памяти для проверки без обращений к Google или Outlook.
+"""
+from datetime import timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import CalendarEvent, CalendarChange, CalendarSyncState, CustomUser
+from .calendar_feed import calendar_version, window_filter
+
+SYNC_PAGE_SIZE = 500
+SYNC_TOKEN_SALT = 'crm.calendar_sync'
+# Окно ICS-ленты от текущего момента
+ICS_PAST = timedelta(days=90)
+ICS_FUTURE = timedelta(days=2 * 365)
+ICS_PRODID = '-//Legal CRM//Calendar//RU'
+ICS_LINE_LENGTH = 75
+
+class SyncTokenError(ValueError):
+    pass
+
+class SyncTokenExpired(SyncTokenError):
+    pass
+
+def record_calendar_changes(event_ids, user_ids, deleted=False):
+    """Изменение (или удаление) событий event_ids в календарях user_ids - новые номера изменений"""
+    event_ids, user_ids = set(event_ids), set(user_ids) - {None}
+    if not event_ids or not user_ids:
+        return
+    with transaction.atomic():
+        CalendarChange.objects.filter(event_id__in=event_ids, user_id__in=user_ids).delete()
+        CalendarChange.objects.bulk_create([
+            CalendarChange(user_id=user_id, event_id=event_id, deleted=deleted)
+            for event_id in sorted(event_ids) for user_id in sorted(user_ids)
+        ])
+
+def prune_calendar_tombstones():
+    """Удаление tombstones старше срока жизни токена"""
+    deleted, _ = CalendarChange.objects.filter(
+        deleted=True, changed_at__lt=timezone.now() - timedelta(seconds=settings.CALENDAR_SYNC_TOKEN_TTL)
+    ).delete()
+    return deleted
+
+def make_sync_token(sequence):
+    return signing.TimestampSigner(salt=SYNC_TOKEN_SALT).sign(str(sequence))
+
+def parse_sync_token(token):
+    """Номер изменения из токена; SyncTokenExpired для просроченного, SyncTokenError для чужого"""
+    try:
+        return int(signing.TimestampSigner(salt=SYNC_TOKEN_SALT).unsign(
+            token, max_age=settings.CALENDAR_SYNC_TOKEN_TTL
+        ))
+    except signing.SignatureExpired:
+        raise SyncTokenExpired('Токен устарел, нужна полная синхронизация')
+    except (signing.BadSignature, ValueError):
+        raise SyncTokenError('Некорректный токен синхронизации')
+
+def visible_events(user):
+    participation = CalendarEvent.participants.through.objects.filter(customuser=user).values('calendarevent_id')
+    return CalendarEvent.objects.filter(
+        Q(created_by=user) | Q(pk__in=participation)
+    ).prefetch_related('overrides').order_by('pk')
+
+def event_uid(event_id):
+    return f'event-{event_id}@legal-crm'
+
+def _moment(value):
+    return timezone.localtime(value).isoformat() if value else None
+
+def serialize_series(event):
+    """Событие (серия целиком) для синхронизации"""
+    return {
+        'uid': event_uid(event.pk),
+        'id': event.pk,
+        'sequence': event.sequence,
+        'title': event.title,
+        'description': event.description,
+        'location': event.location,
+        'type': event.event_type,
+        'start': _moment(event.start_time),
+        'end': _moment(event.end_time),
+        'all_day': event.is_all_day,
+        'recurrence_rule': event.recurrence_rule or None,
+        'overrides': [
+            {
+                'original_start': _moment(override.original_start),
+                'cancelled': override.is_cancelled,
+                'title': override.title or None,
+                'description': override.description or None,
+                'location': override.location or None,
+                'start': _moment(override.start_time),
+                'end': _moment(override.end_time),
+            }
+            for override in event.overrides.all()
+        ],
+    }
+
+def calendar_delta(user, token=None, limit=SYNC_PAGE_SIZE):
+    """
+    Изменения календаря user после token:
+    {'token', 'full', 'more', 'changes': [{'action': 'upsert', 'uid', 'event'} | {'action': 'delete', 'uid'}]}.
+    Без токена - полная выгрузка (full), при more - запросить еще раз с новым токеном.
+    """
+    settled = timezone.now() - timedelta(seconds=settings.CALENDAR_SYNC_SETTLE)
+    if not token:
+        # Номер фиксируется до выгрузки: изменения во время нее придут в следующий раз повторно
+        sequence = CalendarChange.objects.filter(
+            user=user, changed_at__lt=settled
+        ).aggregate(last=Max('id'))['last'] or 0
+        return {
+            'token': make_sync_token(sequence),
+            'full': True,
+            'more': False,
+            'changes': [
+                {'action': 'upsert', 'uid': event_uid(event.pk), 'event': serialize_series(event)}
+                for event in visible_events(user)
+            ],
+        }
+
+    sequence = parse_sync_token(token)
+    rows = list(CalendarChange.objects.filter(user=user, id__gt=sequence).order_by('id')[:limit + 1])
+    more = len(rows) > limit
+    rows = rows[:limit]
+    events = visible_events(user).in_bulk([row.event_id for row in rows if not row.deleted])
+
+    changes = []
+    for row in rows:
+        event = events.get(row.event_id)
+        if event is None:
+            # Удалено или больше не видно пользователю после записи изменения
+            changes.append({'action': 'delete', 'uid': event_uid(row.event_id)})
+        else:
+            changes.append({'action': 'upsert', 'uid': event_uid(event.pk), 'event': serialize_series(event)})
+    # Токен продвигается только по устоявшимся строкам
+    for row in rows:
+        if row.changed_at >= settled:
+            more = False
+            break
+        sequence = row.id
+    return {
+        'token': make_sync_token(sequence),
+        'full': False,
+        'more': more,
+        'changes': changes,
+    }
+
+def _ics_escape(text):
+    return (text or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r', '').replace('\n', '\\n')
+
+def _ics_datetime(value):
+    return value.astimezone(dt_timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+def _ics_fold(line):
+    """Перенос строк длиннее 75 октетов (RFC 5545, 3.1)"""
+    encoded = line.encode()
+    if len(encoded) <= ICS_LINE_LENGTH:
+        return line
+    parts, current = [], ''
+    for char in line:
+        limit = ICS_LINE_LENGTH if not parts else ICS_LINE_LENGTH - 1
+        if len((current + char).encode()) > limit:
+            parts.append(current)
+            current = ''
+        current += char
+    parts.append(current)
+    return '\r\n '.join(parts)
+
+def _vevent(event, stamp, override=None):
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:{event_uid(event.pk)}',
+        f'DTSTAMP:{stamp}',
+        f'SEQUENCE:{event.sequence}',
+    ]
+    if override:
+        duration = event.end_time - event.start_time
+        start = override.start_time or override.original_start
+        lines += [
+            f'RECURRENCE-ID:{_ics_datetime(override.original_start)}',
+            f'DTSTART:{_ics_datetime(start)}',
+            f'DTEND:{_ics_datetime(override.end_time or start + duration)}',
+        ]
+    else:
+        lines += [f'DTSTART:{_ics_datetime(event.start_time)}', f'DTEND:{_ics_datetime(event.end_time)}']
+        if event.recurrence_rule:
+            lines.append(f'RRULE:{event.rule}')
+            lines += [
+                f'EXDATE:{_ics_datetime(item.original_start)}'
+                for item in event.overrides.all() if item.is_cancelled
+            ]
+    lines += [
+        f'SUMMARY:{_ics_escape(override and override.title or event.title)}',
+        f'DESCRIPTION:{_ics_escape(override and override.description or event.description)}',
+        f'LOCATION:{_ics_escape(override and override.location or event.location)}',
+        f'CATEGORIES:{_ics_escape(event.get_event_type_display())}',
+        'END:VEVENT',
+    ]
+    return lines
+
+def ics_calendar(user):
+    """ICS-лента пользователя: события с ICS_PAST назад, серии целиком, с изменениями повторений"""
+    now = timezone.now()
+    stamp = _ics_datetime(now)
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        f'PRODID:{ICS_PRODID}',
+        'CALSCALE:GREGORIAN',
+        f'X-WR-CALNAME:{_ics_escape(user.get_full_name() or user.username)}',
+    ]
+    for event in visible_events(user).filter(window_filter(now - ICS_PAST, now + ICS_FUTURE)):
+        lines += _vevent(event, stamp)
+        for override in event.overrides.all():
+            if not override.is_cancelled:
+                lines += _vevent(event, stamp, override)
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(_ics_fold(line) for line in lines) + '\r\n'
+
+def ics_etag(request, token):
+    """ETag ICS-ленты по версии календаря владельца (см. crm.calendar_feed)"""
+    user_id = CustomUser.objects.filter(calendar_token=token, is_active=True).values_list('pk', flat=True).first()
+    return f'ics-{user_id}-{calendar_version(user_id)}' if user_id else None
+
+class LocalCalendarClient:
+    """
+    Внешний календарь в памяти процесса (по пользователю) - заменяет Google
+    или Outlook при проверке синхронизации.
+    """
+    stores = {}
+
+    def __init__(self, user):
+        self.events = self.stores.setdefault(user.pk, {})
+
+    def replace_all(self, events):
+        self.events.clear()
+        self.events.update({event['uid']: event for event in events})
+
+    def upsert(self, event):
+        self.events[event['uid']] = event
+
+    def delete(self, uid):
+        self.events.pop(uid, None)
+
+def sync_external(user, service, client=None):
+    """
+    Отправка изменений календаря user во внешний сервис service с последнего
+    сохраненного токена (CalendarSyncState). Возвращает число изменений.
+    """
+    if client is None:
+        client_path = settings.CALENDAR_SYNC_CLIENTS.get(service)
+        if not client_path:
+            raise LookupError(f'Клиент календаря {service} не настроен')
+        client = import_string(client_path)(user)
+    state, _ = CalendarSyncState.objects.get_or_create(user=user, service=service)
+
+    try:
+        delta = calendar_delta(user, state.token or None)
+    except SyncTokenError:
+        delta = calendar_delta(user)
+    applied = 0
+    while True:
+        if delta['full']:
+            client.replace_all([change['event'] for change in delta['changes']])
+        else:
+            for change in delta['changes']:
+                if change['action'] == 'delete':
+                    client.delete(change['uid'])
+                else:
+                    client.upsert(change['event'])
+        applied += len(delta['changes'])
+        # Токен сохраняется после каждой порции: сбой не повторяет уже отправленное
+        state.token = delta['token']
+        state.last_synced_at = timezone.now()
+        state.save(update_fields=['token', 'last_synced_at'])
+        if not delta['more']:
+            return applied
+        delta = calendar_delta(user, delta['token'])
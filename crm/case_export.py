@@ -0,0 +1,198 @@
+"""
+Выгрузка отчета по делу в PDF и XLSX (задача Celery export_case_report).
+
+Файл хранится в default_storage под именем из id дела и метки его изменения
+Case.updated_at (ее обновляют и изменения платежей, времени, задач, документов
+и коммуникаций дела), поэтому повторная выгрузка неизмененного дела отдается
+готовым файлом, а после изменения строится новый, старые версии удаляются.
+
+Строки разделов читаются потоком (iterator) с JOIN пользователей, файл
+собирается во временном файле. XLSX пишется в write-only режиме openpyxl;
+PDF рисуется на canvas построчно, без списка flowables, поэтому память не
+растет с числом объектов (reportlab держит в памяти только готовые страницы).
+
+Статус построения (pending/failed) хранится в кэше по имени файла.
+"""
+import os
+import tempfile
+from datetime import timezone as dt_timezone
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import default_storage
+from .models import Case
+from .utils import (
+    CASE_REPORT_SECTIONS, CASE_INFO_LABELS, CASE_STATISTICS_LABELS,
+    case_report_header, iter_case_report_rows,
+)
+
+REPORT_FORMATS = ('pdf', 'xlsx')
+REPORT_CHUNK_SIZE = 500
+
+PDF_FONT_NAME = 'CaseReport'
+PDF_FONT_SIZE = 8
+PDF_MARGIN = 36
+PDF_LINE_HEIGHT = 11
+
+def report_directory(case_id):
+    return f'reports/case_{case_id}'
+
+def report_file_name(case, report_format):
+    """Имя файла текущей версии дела"""
+    version = case.updated_at.astimezone(dt_timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+    return f'{report_directory(case.pk)}/case_{case.pk}_{version}.{report_format}'
+
+def _status_key(file_name):
+    return f'case_report:{file_name}'
+
+def report_status(case, report_format):
+    """ready - файл текущей версии готов; pending, failed или missing - нет"""
+    file_name = report_file_name(case, report_format)
+    if default_storage.exists(file_name):
+        return 'ready'
+    return cache.get(_status_key(file_name), 'missing')
+
+def mark_report_pending(case, report_format):
+    cache.set(_status_key(report_file_name(case, report_format)), 'pending', settings.CASE_REPORT_STATUS_TTL)
+
+def write_case_report_xlsx(case, output):
+    """Лист «Дело» со сведениями и статистикой и по листу на раздел"""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    case_info, statistics = case_report_header(case)
+    sheet = workbook.create_sheet('Дело')
+    for key, value in case_info.items():
+        sheet.append([CASE_INFO_LABELS[key], value])
+    sheet.append([])
+    for key, value in statistics.items():
+        sheet.append([CASE_STATISTICS_LABELS[key], value])
+
+    for key, title, _, columns, _ in CASE_REPORT_SECTIONS:
+        sheet = workbook.create_sheet(title)
+        sheet.append([label for _, label in columns])
+        for row in iter_case_report_rows(case, key, REPORT_CHUNK_SIZE):
+            sheet.append([row[column] for column, _ in columns])
+    workbook.save(output)
+    return output
+
+def _pdf_font():
+    """TTF-шрифт с кириллицей из CASE_REPORT_FONT (без него - Helvetica)"""
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    path = settings.CASE_REPORT_FONT
+    if not path or not os.path.exists(path):
+        return 'Helvetica'
+    if PDF_FONT_NAME not in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.registerFont(TTFont(PDF_FONT_NAME, path))
+    return PDF_FONT_NAME
+
+class PdfReportWriter:
+    """Вывод строк и таблиц на canvas с переходом на новую страницу"""
+
+    def __init__(self, output):
+        from reportlab.lib.pagesizes import A4, landscape
+        from reportlab.pdfgen import canvas
+
+        self.width, self.height = landscape(A4)
+        self.canvas = canvas.Canvas(output, pagesize=(self.width, self.height), pageCompression=1)
+        self.font = _pdf_font()
+        self.header = None
+        self.y = self.height - PDF_MARGIN
+
+    def _fit(self, text, width):
+        from reportlab.pdfbase.pdfmetrics import stringWidth
+
+        text = '' if text is None else str(text).replace('\n', ' ')
+        # Грубая обрезка по числу символов, затем точная по ширине
+        text = text[:int(width / (PDF_FONT_SIZE * 0.3))]
+        while text and stringWidth(text, self.font, PDF_FONT_SIZE) > width:
+            text = text[:-2] + '…' if len(text) > 1 else ''
+        return text
+
+    def _next_line(self):
+        if self.y < PDF_MARGIN + PDF_LINE_HEIGHT:
+            self.canvas.showPage()
+            self.y = self.height - PDF_MARGIN
+            if self.header:
+                self._draw_row(self.header)
+        self.y -= PDF_LINE_HEIGHT
+
+    def _draw_row(self, values):
+        self._next_line()
+        self.canvas.setFont(self.font, PDF_FONT_SIZE)
+        width = (self.width - 2 * PDF_MARGIN) / len(values)
+        for index, value in enumerate(values):
+            self.canvas.drawString(PDF_MARGIN + index * width, self.y, self._fit(value, width - 4))
+
+    def line(self, text, size=PDF_FONT_SIZE):
+        self.header = None
+        self._next_line()
+        self.canvas.setFont(self.font, size)
+        self.canvas.drawString(PDF_MARGIN, self.y, self._fit(text, self.width - 2 * PDF_MARGIN))
+
+    def table(self, header, rows):
+        self.header = None
+        self._draw_row(header)
+        self.header = header
+        for values in rows:
+            self._draw_row(values)
+        self.header = None
+
+    def save(self):
+        self.canvas.save()
+
+def write_case_report_pdf(case, output):
+    writer = PdfReportWriter(output)
+    case_info, statistics = case_report_header(case)
+    writer.line(f'Отчет по делу {case.case_number}', size=12)
+    for key, value in case_info.items():
+        writer.line(f'{CASE_INFO_LABELS[key]}: {value}')
+    for key, value in statistics.items():
+        writer.line(f'{CASE_STATISTICS_LABELS[key]}: {value}')
+
+    for key, title, _, columns, _ in CASE_REPORT_SECTIONS:
+        writer.line('')
+        writer.line(title, size=10)
+        writer.table(
+            [label for _, label in columns],
+            ([row[column] for column, _ in columns] for row in iter_case_report_rows(case, key, REPORT_CHUNK_SIZE)),
+        )
+    writer.save()
+    return output
+
+REPORT_WRITERS = {
+    'pdf': write_case_report_pdf,
+    'xlsx': write_case_report_xlsx,
+}
+
+def _remove_old_versions(case_id, keep):
+    """Удаление файлов того же формата от прежних версий дела"""
+    directory = report_directory(case_id)
+    if not default_storage.exists(directory):
+        return
+    extension = os.path.splitext(keep)[1]
+    for name in default_storage.listdir(directory)[1]:
+        path = f'{directory}/{name}'
+        if path != keep and path.endswith(extension):
+            default_storage.delete(path)
+
+def build_case_report(case_id, report_format):
+    """Имя файла отчета текущей версии дела; файл строится, только если его нет"""
+    case = Case.objects.select_related('client__user', 'lawyer').get(pk=case_id)
+    file_name = report_file_name(case, report_format)
+    if default_storage.exists(file_name):
+        return file_name
+
+    try:
+        with tempfile.TemporaryFile() as output:
+            REPORT_WRITERS[report_format](case, output)
+            output.seek(0)
+            _remove_old_versions(case.pk, file_name)
+            saved = default_storage.save(file_name, File(output))
+    except Exception:
+        cache.set(_status_key(file_name), 'failed', settings.CASE_REPORT_STATUS_TTL)
+        raise
+    cache.delete(_status_key(file_name))
+    return saved
@@ -0,0 +1,87 @@
+"""
+Сводка по делу в полях Case: оплачено, задолженность, часы, себестоимость,
+задачи и документы.
+
+Значения пересчитываются из исходных строк одним UPDATE с подзапросами, а не
+прибавлением разницы: параллельные изменения не теряются, а повторный пересчет
+безопасен. Сигналы вызывают пересчет для затронутого дела (и для прежнего,
+если строку перенесли в другое дело); массовые операции сигналы не вызывают -
+для них refresh_case_summaries и команда repair_case_summaries.
+
+Пересчет отмечает дело измененным (updated_at): по этой метке кэшируются
+выгрузки отчета по делу (crm.case_export).
+"""
+from django.db import models
+from django.db.models import Q, Sum, Count
+from django.db.models.functions import Round
+from django.utils import timezone
+from .models import Case, Payment, TimeEntry, Task, Document, _subquery_total
+from .utils import TIME_ENTRY_COST
+
+MONEY = models.DecimalField(max_digits=15, decimal_places=2)
+COUNT = models.IntegerField()
+
+def _total(queryset, aggregate, output_field):
+    return _subquery_total(queryset, 'case', aggregate, output_field)
+
+# Поля сводки по моделям-источникам
+SUMMARY_SOURCES = {
+    Payment: lambda: {
+        'total_paid': _total(Payment.objects.filter(is_paid=True), Sum('amount'), MONEY),
+        'total_outstanding': _total(Payment.objects.filter(is_paid=False), Sum('amount'), MONEY),
+    },
+    TimeEntry: lambda: {
+        'total_hours': _total(TimeEntry.objects.all(), Sum('duration'), MONEY),
+        'actual_cost': _total(
+            TimeEntry.objects.filter(billable=True), Round(Sum(TIME_ENTRY_COST), 2), MONEY
+        ),
+    },
+    Task: lambda: {
+        'tasks_done': _total(Task.objects.filter(status='done'), Count('pk'), COUNT),
+        'tasks_pending': _total(Task.objects.filter(status__in=['todo', 'in_progress']), Count('pk'), COUNT),
+    },
+    Document: lambda: {
+        'documents_count': _total(Document.objects.all(), Count('pk'), COUNT),
+    },
+}
+
+# Те же поля Case.save() не записывает
+SUMMARY_FIELDS = [field for source in SUMMARY_SOURCES.values() for field in source()]
+
+def summary_expressions(sources=None):
+    expressions = {}
+    for source in sources or SUMMARY_SOURCES:
+        expressions.update(SUMMARY_SOURCES[source]())
+    return expressions
+
+def refresh_case_summaries(cases, sources=None):
+    """Пересчет сводки дел queryset cases (только полей источников sources)"""
+    return cases.update(updated_at=timezone.now(), **summary_expressions(sources))
+
+def summary_drift(cases):
+    """[(case_id, поле, сохранено, фактически)] для дел queryset cases"""
+    actual = {f'actual_{field}': expression for field, expression in summary_expressions().items()}
+    drift = []
+    for row in cases.order_by().annotate(**actual).values('pk', *SUMMARY_FIELDS, *actual):
+        for field in SUMMARY_FIELDS:
+            if row[field] != row[f'actual_{field}']:
+                drift.append((row['pk'], field, row[field], row[f'actual_{field}']))
+    return drift
+
+def repair_case_summaries(cases=None, batch_size=1000, check_only=False):
+    """
+    Сверка сводки с исходными строками порциями по первичному ключу.
+    Возвращает список расхождений; без check_only расходящиеся дела пересчитываются.
+    """
+    cases = Case.objects.all() if cases is None else cases
+    drift = []
+    last_pk = 0
+    while True:
+        batch = list(cases.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not batch:
+            return drift
+        batch_drift = summary_drift(Case.objects.filter(pk__in=batch))
+        if batch_drift and not check_only:
+            refresh_case_summaries(Case.objects.filter(pk__in={case_id for case_id, *_ in batch_drift}))
+        drift.extend(batch_drift)
+        last_pk = batch[-1]
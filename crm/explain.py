@@ -0,0 +1,92 @@
+"""
+Проверка планов запросов (EXPLAIN): не читает ли запрос таблицу целиком.
+
+Запросы собираются во время работы представления, затем для каждого SELECT,
+затрагивающего перечисленные таблицы, выполняется EXPLAIN текущей СУБД.
+Полным чтением считается SCAN без индекса (SQLite), access_type ALL (MySQL)
+и Seq Scan (PostgreSQL). На MySQL и PostgreSQL планировщик выбирает полное
+чтение маленьких таблиц сам, поэтому там проверку стоит запускать на данных
+seed_firm.
+"""
+import json
+import re
+from contextlib import contextmanager
+from django.db import connection
+
+ALIAS_PATTERN = re.compile(r'"?(\w+)"?\s+(?:AS\s+)?"?([UT]\d+)"?\b')
+
+def _tables_with_aliases(sql, tables):
+    """Имена таблиц и их псевдонимы в подзапросах Django (U0, T3)"""
+    names = set(tables)
+    for table, alias in ALIAS_PATTERN.findall(sql):
+        if table in tables:
+            names.add(alias)
+    return names
+
+def explain(sql, params=()):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return [row[-1] for row in cursor.fetchall()]
+        if connection.vendor == 'mysql':
+            cursor.execute(f'EXPLAIN FORMAT=JSON {sql}', params)
+            return [cursor.fetchone()[0]]
+        cursor.execute(f'EXPLAIN {sql}', params)
+        return [row[0] for row in cursor.fetchall()]
+
+def _mysql_full_scans(node, names):
+    if isinstance(node, dict):
+        table = node.get('table')
+        if isinstance(table, dict) and table.get('table_name') in names and table.get('access_type') == 'ALL':
+            yield f"{table['table_name']}: access_type ALL"
+        for value in node.values():
+            yield from _mysql_full_scans(value, names)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _mysql_full_scans(value, names)
+
+def full_scans(sql, params=(), tables=()):
+    """Строки плана с полным чтением таблиц tables"""
+    names = _tables_with_aliases(sql, tables)
+    plan = explain(sql, params)
+    if connection.vendor == 'mysql':
+        return list(_mysql_full_scans(json.loads(plan[0]), names))
+    if connection.vendor == 'sqlite':
+        return [
+            line for line in plan
+            if line.startswith('SCAN ') and line.split()[1] in names and 'INDEX' not in line
+        ]
+    return [
+        line for line in plan
+        if 'Seq Scan on' in line and line.split('Seq Scan on')[1].split()[0] in names
+    ]
+
+@contextmanager
+def capture_selects():
+    """Список (sql, params) всех SELECT внутри блока"""
+    queries = []
+
+    def wrapper(execute, sql, params, many, context):
+        if sql.lstrip().upper().startswith('SELECT'):
+            queries.append((sql, params))
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(wrapper):
+        yield queries
+
+class IndexUsageTestMixin:
+    """assertUsesIndexes: запросы блока не читают указанные таблицы целиком"""
+
+    @contextmanager
+    def assertUsesIndexes(self, tables):
+        with capture_selects() as queries:
+            yield queries
+        problems = []
+        for sql, params in queries:
+            if not any(f'"{table}"' in sql or f'`{table}`' in sql for table in tables):
+                continue
+            scans = full_scans(sql, params, tables)
+            if scans:
+                problems.append(f'{sql}\n  -> {"; ".join(scans)}')
+        if problems:
+            self.fail('Полное чтение таблицы без индекса:\n' + '\n'.join(problems))
@@ -0,0 +1,208 @@
+"""
+Выгрузка списков (дела, задачи, записи времени, платежи) в CSV и XLSX.
+
+Строки читаются порциями по первичному ключу (values_list, без создания
+моделей): на MySQL iterator() не ограничивает память - драйвер все равно
+загружает весь результат, а порция по pk > последнего - это отдельный
+короткий запрос по индексу. CSV отдается StreamingHttpResponse по мере
+чтения, XLSX пишется openpyxl в write-only режиме во временный файл и
+отдается из него, поэтому память процесса не зависит от числа строк.
+"""
+import csv
+import tempfile
+from django.db.models import Value
+from django.db.models.functions import Concat
+from django.http import StreamingHttpResponse, FileResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from .models import Case, Task, TimeEntry, Payment
+from .utils import filter_case_list, local_day_range
+
+EXPORT_FORMATS = ('csv', 'xlsx')
+EXPORT_CHUNK_SIZE = 2000
+# Excel в русской локали ожидает ; и распознает UTF-8 по BOM
+CSV_DELIMITER = ';'
+
+def _full_name(prefix):
+    return Concat(f'{prefix}__first_name', Value(' '), f'{prefix}__last_name')
+
+def _choices(model, field):
+    labels = dict(model._meta.get_field(field).choices)
+    return lambda value: labels.get(value, value)
+
+def _datetime(value):
+    return timezone.localtime(value).strftime('%d.%m.%Y %H:%M') if value else None
+
+def _date(value):
+    return value.strftime('%d.%m.%Y') if value else None
+
+def _yes_no(value):
+    return 'Да' if value else 'Нет'
+
+def _name(value):
+    return (value or '').strip()
+
+def _date_range(params, field):
+    """Фильтр по датам ?date_from=&date_to= (включительно) для поля даты/времени field"""
+    date_from = parse_date(params.get('date_from') or '')
+    date_to = parse_date(params.get('date_to') or '')
+    if not date_from and not date_to:
+        return {}
+    start, end = local_day_range(date_from or date_to, date_to or date_from)
+    return {
+        **({f'{field}__gte': start} if date_from else {}),
+        **({f'{field}__lt': end} if date_to else {}),
+    }
+
+def _payment_dates(params):
+    date_from = parse_date(params.get('date_from') or '')
+    date_to = parse_date(params.get('date_to') or '')
+    return {
+        **({'payment_date__gte': date_from} if date_from else {}),
+        **({'payment_date__lte': date_to} if date_to else {}),
+    }
+
+def _cases(params):
+    return filter_case_list(
+        Case.objects.filter(is_active=True).annotate(lawyer_name=_full_name('lawyer')), params
+    )
+
+def _tasks(params):
+    tasks = Task.objects.annotate(assigned_to_name=_full_name('assigned_to'))
+    if params.get('status'):
+        tasks = tasks.filter(status=params['status'])
+    if params.get('assigned_to'):
+        tasks = tasks.filter(assigned_to_id=params['assigned_to'])
+    return tasks.filter(**_date_range(params, 'due_date'))
+
+def _time_entries(params):
+    entries = TimeEntry.objects.annotate(lawyer_name=_full_name('lawyer'))
+    if params.get('lawyer'):
+        entries = entries.filter(lawyer_id=params['lawyer'])
+    if params.get('case'):
+        entries = entries.filter(case_id=params['case'])
+    return entries.filter(**_date_range(params, 'start_time'))
+
+def _payments(params):
+    payments = Payment.objects.filter(**_payment_dates(params))
+    if params.get('is_paid') in ['0', '1']:
+        payments = payments.filter(is_paid=params['is_paid'] == '1')
+    return payments
+
+# Выгрузки: заголовок, queryset по параметрам запроса, колонки (подпись, поле, формат)
+EXPORTS = {
+    'cases': {
+        'title': 'Дела',
+        'queryset': _cases,
+        'columns': [
+            ('Номер', 'case_number', None),
+            ('Название', 'title', None),
+            ('Клиент', 'client__company_name', None),
+            ('Юрист', 'lawyer_name', _name),
+            ('Тип', 'case_type', _choices(Case, 'case_type')),
+            ('Стадия', 'stage', _choices(Case, 'stage')),
+            ('Начало', 'start_date', _date),
+            ('Окончание', 'end_date', _date),
+            ('Бюджет', 'budget', None),
+            ('Оплачено', 'total_paid', None),
+            ('Задолженность', 'total_outstanding', None),
+            ('Часы', 'total_hours', None),
+            ('Себестоимость', 'actual_cost', None),
+        ],
+    },
+    'tasks': {
+        'title': 'Задачи',
+        'queryset': _tasks,
+        'columns': [
+            ('Задача', 'title', None),
+            ('Дело', 'case__case_number', None),
+            ('Исполнитель', 'assigned_to_name', _name),
+            ('Статус', 'status', _choices(Task, 'status')),
+            ('Приоритет', 'priority', _choices(Task, 'priority')),
+            ('Срок', 'due_date', _datetime),
+            ('Выполнена', 'completed_at', _datetime),
+            ('Оценка, ч', 'estimated_hours', None),
+            ('Факт, ч', 'actual_hours', None),
+        ],
+    },
+    'time_entries': {
+        'title': 'Учет времени',
+        'queryset': _time_entries,
+        'columns': [
+            ('Юрист', 'lawyer_name', _name),
+            ('Дело', 'case__case_number', None),
+            ('Описание', 'description', None),
+            ('Начало', 'start_time', _datetime),
+            ('Часы', 'duration', None),
+            ('Оплачиваемое', 'billable', _yes_no),
+        ],
+    },
+    'payments': {
+        'title': 'Платежи',
+        'queryset': _payments,
+        'columns': [
+            ('Дело', 'case__case_number', None),
+            ('Клиент', 'case__client__company_name', None),
+            ('Сумма', 'amount', None),
+            ('Тип', 'payment_type', _choices(Payment, 'payment_type')),
+            ('Дата', 'payment_date', _date),
+            ('Оплачен', 'is_paid', _yes_no),
+            ('Дата оплаты', 'paid_date', _date),
+            ('Счет', 'invoice_number', None),
+        ],
+    },
+}
+
+def iter_export_rows(queryset, columns, chunk_size=EXPORT_CHUNK_SIZE):
+    """Отформатированные строки queryset порциями по chunk_size в порядке pk"""
+    fields = [field for _, field, _ in columns]
+    formats = [fmt for _, _, fmt in columns]
+    queryset = queryset.order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk).values_list('pk', *fields)[:chunk_size])
+        if not batch:
+            return
+        for pk, *values in batch:
+            yield [fmt(value) if fmt else value for fmt, value in zip(formats, values)]
+        last_pk = batch[-1][0]
+
+class _Echo:
+    """Файлоподобный объект для csv.writer: writerow возвращает строку, а не пишет ее"""
+
+    def write(self, value):
+        return value
+
+def iter_csv(header, rows):
+    writer = csv.writer(_Echo(), delimiter=CSV_DELIMITER)
+    yield '\ufeff' + writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+def write_export_xlsx(title, header, rows, output):
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title)
+    sheet.append(header)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(output)
+    return output
+
+def export_response(kind, export_format, params):
+    """Ответ с выгрузкой kind ('cases', 'tasks', ...) в формате csv или xlsx"""
+    export = EXPORTS[kind]
+    header = [label for label, _, _ in export['columns']]
+    rows = iter_export_rows(export['queryset'](params), export['columns'])
+    file_name = f'{kind}_{timezone.localdate().strftime("%Y%m%d")}.{export_format}'
+
+    if export_format == 'csv':
+        response = StreamingHttpResponse(iter_csv(header, rows), content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="{file_name}"'
+        return response
+
+    output = tempfile.TemporaryFile()
+    write_export_xlsx(export['title'], header, rows, output)
+    output.seek(0)
+    return FileResponse(output, as_attachment=True, filename=file_name)
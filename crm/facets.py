@@ -0,0 +1,89 @@
+"""
+Счетчики фасетов списка дел: стадия, тип, юрист и статус клиента.
+
+Счетчик значения фасета считается с учетом всех остальных фильтров, но без
+фильтра по самому фасету - выбранная стадия не обнуляет счетчики соседних
+стадий. Для этого достаточно двух сгруппированных запросов:
+
+- по (stage, case_type, client__status) без фильтров этих трех фасетов -
+  счетчик каждого из них получается суммированием строк, подходящих под
+  фильтры двух других;
+- по юристу без фильтра по юристу.
+
+Поиск (?search=) - подзапрос по индексу в обоих запросах. Результат
+кэшируется на CASE_FACETS_CACHE_TTL по набору фильтров.
+"""
+import hashlib
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from .models import Case, Client
+from .utils import CASE_LIST_FILTERS, filter_case_list
+from .search import matching_ids
+
+# Фасеты из одного сгруппированного запроса: параметр -> (поле, варианты)
+GROUPED_FACETS = {
+    'stage': ('stage', Case.STAGE_CHOICES),
+    'case_type': ('case_type', Case.TYPE_CHOICES),
+    'client_status': ('client__status', Client.STATUS_CHOICES),
+}
+
+def _cache_key(params):
+    signature = '&'.join(
+        f'{param}={params.get(param)}' for param in [*CASE_LIST_FILTERS, 'search'] if params.get(param)
+    )
+    return 'case_facets:' + hashlib.md5(signature.encode()).hexdigest()
+
+def _grouped_facets(queryset, params):
+    fields = [field for field, _ in GROUPED_FACETS.values()]
+    rows = list(
+        filter_case_list(queryset, params, exclude=[*GROUPED_FACETS, 'search']).order_by()
+        .values(*fields).annotate(count=Count('pk')).values_list(*fields, 'count')
+    )
+    selected = {param: params.get(param) for param in GROUPED_FACETS}
+
+    facets = {}
+    for index, (param, (_, choices)) in enumerate(GROUPED_FACETS.items()):
+        counts = {}
+        for row in rows:
+            # Строка учитывается, если подходит под выбранные значения остальных фасетов
+            if all(
+                not selected[other] or row[other_index] == selected[other]
+                for other_index, other in enumerate(GROUPED_FACETS) if other != param
+            ):
+                counts[row[index]] = counts.get(row[index], 0) + row[-1]
+        facets[param] = [
+            {'value': value, 'label': label, 'count': counts.get(value, 0), 'selected': value == selected[param]}
+            for value, label in choices
+        ]
+    return facets
+
+def _lawyer_facet(queryset, params):
+    rows = (
+        filter_case_list(queryset, params, exclude=['lawyer', 'search']).order_by()
+        .values('lawyer', 'lawyer__first_name', 'lawyer__last_name').annotate(count=Count('pk'))
+        .order_by('lawyer__last_name', 'lawyer__first_name', 'lawyer')
+    )
+    return [
+        {
+            'value': row['lawyer'],
+            'label': f"{row['lawyer__first_name']} {row['lawyer__last_name']}".strip() if row['lawyer'] else 'Не назначен',
+            'count': row['count'],
+            'selected': str(row['lawyer']) == params.get('lawyer'),
+        }
+        for row in rows
+    ]
+
+def case_facets(params):
+    """{фасет: [{'value', 'label', 'count', 'selected'}]} для фильтров params списка активных дел"""
+    key = _cache_key(params)
+    facets = cache.get(key)
+    if facets is None:
+        queryset = Case.objects.filter(is_active=True)
+        if params.get('search'):
+            # Все совпадения, а не лучшие SEARCH_RESULT_LIMIT: счетчики сходятся со списком
+            queryset = queryset.filter(pk__in=matching_ids('case', params['search']))
+        facets = _grouped_facets(queryset, params)
+        facets['lawyer'] = _lawyer_facet(queryset, params)
+        cache.set(key, facets, settings.CASE_FACETS_CACHE_TTL)
+    return facets
@@ -1,6 +1,8 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
+from django.utils import timezone
 from .models import *
+from .free_busy import event_conflicts
 
 class CustomUserCreationForm(UserCreationForm):
     class Meta:
@@ -62,15 +64,61 @@ class DocumentForm(forms.ModelForm):
         }
 
 class CalendarEventForm(forms.ModelForm):
+    """
+    Событие с проверкой пересечений по занятости автора и участников
+    (crm.free_busy); пересечения можно принять флажком ignore_conflicts.
+    """
+    MAX_CONFLICT_MESSAGES = 5
+    
+    ignore_conflicts = forms.BooleanField(required=False, label='Сохранить, несмотря на пересечения')
+    
+    def __init__(self, *args, user=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Автор нового события; у существующего - сохраненный автор
+        self.user = user
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        start, end = cleaned_data.get('start_time'), cleaned_data.get('end_time')
+        if not start or not end or self.errors:
+            return cleaned_data
+        if end <= start:
+            self.add_error('end_time', 'Событие должно заканчиваться после начала')
+            return cleaned_data
+        if cleaned_data.get('ignore_conflicts'):
+            return cleaned_data
+        
+        users = {user.pk: user for user in cleaned_data.get('participants') or []}
+        creator = self.instance.created_by if self.instance.created_by_id else self.user
+        if creator:
+            users[creator.pk] = creator
+        conflicts = event_conflicts(
+            list(users), start, end, cleaned_data.get('recurrence_rule') or '', exclude_event=self.instance.pk
+        )
+        if conflicts:
+            messages = [
+                f'{users[user_id].get_full_name() or users[user_id].username}: {interval.title} '
+                f'{timezone.localtime(interval.start):%d.%m.%Y %H:%M}–{timezone.localtime(interval.end):%H:%M}'
+                for user_id, interval in conflicts[:self.MAX_CONFLICT_MESSAGES]
+            ]
+            if len(conflicts) > self.MAX_CONFLICT_MESSAGES:
+                messages.append(f'и еще {len(conflicts) - self.MAX_CONFLICT_MESSAGES}')
+            raise forms.ValidationError(['Пересечения с занятостью участников:', *messages])
+        return cleaned_data
+    
     class Meta:
         model = CalendarEvent
         fields = ['title', 'description', 'event_type', 'start_time', 
-                 'end_time', 'case', 'participants', 'location', 'is_all_day', 'color']
+                 'end_time', 'case', 'participants', 'location', 'is_all_day', 'color', 'recurrence_rule']
         widgets = {
             'description': forms.Textarea(attrs={'rows': 3}),
             'start_time': forms.DateTimeInput(attrs={'type': 'datetime-local'}),
             'end_time': forms.DateTimeInput(attrs={'type': 'datetime-local'}),
             'participants': forms.SelectMultiple(attrs={'class': 'form-control select2'}),
+            'recurrence_rule': forms.TextInput(attrs={'placeholder': 'FREQ=WEEKLY;BYDAY=MO,WE;COUNT=10'}),
+        }
+        labels = {
+            'recurrence_rule': 'Повторение (RRULE)',
         }
 
 class TimeEntryForm(forms.ModelForm):
@@ -0,0 +1,222 @@
+"""
+Занятость юристов: интервалы занятости, свободные окна и пересечения.
+
+Занятость складывается из событий календаря (автор и участники, с
+развернутыми сериями), открытых задач (estimated_hours до срока, не больше
+TASK_BUSY_MAX) и запланированных коммуникаций (scheduled_for на duration
+минут, автор и участники). Все строки выбираются одним запросом UNION ALL по
+пяти источникам, изменения повторений серий - еще одним, если в окне есть
+серии. Дальше работа в памяти: интервалы сортируются, и слияние, свободные
+окна и пересечения получаются одним проходом по отсортированному списку.
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+from django.db.models import F, Q, Value, IntegerField, CharField
+from django.db.models.functions import Cast, Coalesce
+from django.utils import timezone
+from .models import CalendarEvent, Task, Communication
+from .calendar_feed import MAX_WINDOW, window_filter, expand_occurrences
+from .recurrence import RecurrenceRule
+
+BusyInterval = namedtuple('BusyInterval', ['start', 'end', 'kind', 'object_id', 'title'])
+
+# Задача занимает estimated_hours до срока, но не больше
+TASK_BUSY_MAX = timedelta(hours=8)
+TASK_BUSY_STATUSES = ('todo', 'in_progress')
+# Длительность коммуникации без duration и самая длинная учитываемая
+COMMUNICATION_DEFAULT_MINUTES = 60
+COMMUNICATION_BUSY_MAX = timedelta(days=1)
+# Рабочее время для свободных окон: часы и рабочие дни (пн-пт)
+WORKDAY_HOURS = (9, 19)
+WORKDAYS = (0, 1, 2, 3, 4)
+MAX_FREE_BUSY_USERS = 100
+# Повторения новой серии проверяются на пересечения на этот срок вперед
+CONFLICT_HORIZON = MAX_WINDOW
+
+# Столбцы UNION в одном порядке для всех источников
+BUSY_COLUMNS = ('busy_kind', 'busy_id', 'busy_user', 'busy_start', 'busy_end', 'busy_rule', 'busy_minutes', 'busy_title')
+
+def _busy_rows(queryset, kind, object_id, user, start, end, rule, minutes, title):
+    return queryset.annotate(**dict(zip(BUSY_COLUMNS, [
+        Value(kind, output_field=CharField()), F(object_id), F(user),
+        F(start), F(end),
+        rule if rule is not None else Value('', output_field=CharField()),
+        minutes if minutes is not None else Value(0, output_field=IntegerField()),
+        F(title),
+    ]))).order_by().values_list(*BUSY_COLUMNS)
+
+def _busy_queryset(user_ids, start, end, exclude_event=None):
+    """UNION ALL строк занятости пользователей user_ids в окне [start, end)"""
+    owned_events = CalendarEvent.objects.filter(window_filter(start, end), created_by_id__in=user_ids)
+    event_participants = CalendarEvent.participants.through.objects.filter(
+        window_filter(start, end, prefix='calendarevent__'), customuser_id__in=user_ids
+    )
+    if exclude_event:
+        owned_events = owned_events.exclude(pk=exclude_event)
+        event_participants = event_participants.exclude(calendarevent_id=exclude_event)
+
+    tasks = Task.objects.filter(
+        assigned_to_id__in=user_ids, status__in=TASK_BUSY_STATUSES,
+        due_date__gt=start, due_date__lt=end + TASK_BUSY_MAX,
+    )
+    communication_window = Q(scheduled_for__lt=end, scheduled_for__gt=start - COMMUNICATION_BUSY_MAX)
+    communications = Communication.objects.filter(communication_window, created_by_id__in=user_ids)
+    communication_participants = Communication.participants.through.objects.filter(
+        Q(communication__scheduled_for__lt=end, communication__scheduled_for__gt=start - COMMUNICATION_BUSY_MAX),
+        customuser_id__in=user_ids,
+    )
+
+    return _busy_rows(
+        owned_events, 'event', 'pk', 'created_by_id', 'start_time', 'end_time', F('recurrence_rule'), None, 'title'
+    ).union(
+        _busy_rows(
+            event_participants, 'event', 'calendarevent_id', 'customuser_id', 'calendarevent__start_time',
+            'calendarevent__end_time', F('calendarevent__recurrence_rule'), None, 'calendarevent__title'
+        ),
+        _busy_rows(
+            tasks, 'task', 'pk', 'assigned_to_id', 'due_date', 'due_date', None,
+            Cast(F('estimated_hours') * 60, IntegerField()), 'title'
+        ),
+        _busy_rows(
+            communications, 'communication', 'pk', 'created_by_id', 'scheduled_for', 'scheduled_for', None,
+            Coalesce('duration', Value(COMMUNICATION_DEFAULT_MINUTES)), 'subject'
+        ),
+        _busy_rows(
+            communication_participants, 'communication', 'communication_id', 'customuser_id',
+            'communication__scheduled_for', 'communication__scheduled_for', None,
+            Coalesce('communication__duration', Value(COMMUNICATION_DEFAULT_MINUTES)), 'communication__subject'
+        ),
+        all=True,
+    )
+
+def busy_intervals(user_ids, start, end, exclude_event=None):
+    """
+    {пользователь: [BusyInterval]} - занятость в окне [start, end), по началу.
+    exclude_event - id события, которое не учитывается (при его изменении).
+    """
+    busy = {user_id: [] for user_id in user_ids}
+    events, event_users = {}, {}
+    seen = set()
+    for kind, object_id, user_id, busy_start, busy_end, rule, minutes, title in _busy_queryset(
+        user_ids, start, end, exclude_event
+    ):
+        # Автор, он же участник, приходит из двух ветвей UNION ALL
+        if (kind, object_id, user_id) in seen:
+            continue
+        seen.add((kind, object_id, user_id))
+        if rule:
+            # Серии разворачиваются ниже, один раз на серию для всех ее пользователей
+            events.setdefault(object_id, CalendarEvent(
+                pk=object_id, title=title, start_time=busy_start, end_time=busy_end, recurrence_rule=rule
+            ))
+            event_users.setdefault(object_id, set()).add(user_id)
+            continue
+        if kind == 'task':
+            busy_start = busy_end - min(timedelta(minutes=minutes or 0), TASK_BUSY_MAX)
+        elif kind == 'communication':
+            busy_end = busy_start + timedelta(minutes=minutes)
+        if busy_start < end and busy_end > start:
+            busy[user_id].append(BusyInterval(busy_start, busy_end, kind, object_id, title))
+
+    for occurrence in expand_occurrences(events.values(), start, end):
+        for user_id in event_users[occurrence.event.pk]:
+            busy[user_id].append(BusyInterval(
+                occurrence.start_time, occurrence.end_time, 'event', occurrence.event.pk, occurrence.title
+            ))
+    for intervals in busy.values():
+        intervals.sort()
+    return busy
+
+def merge_intervals(intervals):
+    """Слияние отсортированных по началу интервалов в непересекающиеся [(start, end)]"""
+    merged = []
+    for interval in intervals:
+        if merged and interval.start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], interval.end)
+        else:
+            merged.append([interval.start, interval.end])
+    return [tuple(item) for item in merged]
+
+def working_hours(start, end):
+    """Рабочие интервалы (местное время) внутри [start, end)"""
+    day = timezone.localtime(start).date()
+    while True:
+        day_start = timezone.make_aware(datetime.combine(day, datetime.min.time()) + timedelta(hours=WORKDAY_HOURS[0]))
+        if day_start >= end:
+            return
+        day_end = timezone.make_aware(datetime.combine(day, datetime.min.time()) + timedelta(hours=WORKDAY_HOURS[1]))
+        if day.weekday() in WORKDAYS and day_end > start:
+            yield max(day_start, start), min(day_end, end)
+        day += timedelta(days=1)
+
+def free_slots(busy, start, end, min_duration=timedelta(minutes=30), only_working_hours=True):
+    """
+    Общие свободные окна всех пользователей busy ({пользователь: [BusyInterval]})
+    в [start, end) длительностью от min_duration.
+    """
+    merged = merge_intervals(sorted(interval for intervals in busy.values() for interval in intervals))
+    periods = working_hours(start, end) if only_working_hours else [(start, end)]
+
+    slots = []
+    index = 0
+    for period_start, period_end in periods:
+        cursor = period_start
+        # Занятые интервалы, закончившиеся до периода, больше не нужны
+        while index < len(merged) and merged[index][1] <= period_start:
+            index += 1
+        position = index
+        while position < len(merged) and merged[position][0] < period_end:
+            busy_start, busy_end = merged[position]
+            if busy_start - cursor >= min_duration:
+                slots.append((cursor, busy_start))
+            cursor = max(cursor, busy_end)
+            position += 1
+        if period_end - cursor >= min_duration:
+            slots.append((cursor, period_end))
+    return slots
+
+def find_conflicts(busy, start, end):
+    """{пользователь: [BusyInterval]} - занятость, пересекающаяся с [start, end)"""
+    conflicts = {}
+    for user_id, intervals in busy.items():
+        overlapping = [interval for interval in intervals if interval.start < end and interval.end > start]
+        if overlapping:
+            conflicts[user_id] = overlapping
+    return conflicts
+
+def serialize_interval(start, end):
+    return {'start': timezone.localtime(start).isoformat(), 'end': timezone.localtime(end).isoformat()}
+
+def free_busy(user_ids, start, end, min_duration=timedelta(minutes=30), only_working_hours=True):
+    """Занятость пользователей (слитые интервалы) и их общие свободные окна в [start, end)"""
+    busy = busy_intervals(user_ids, start, end)
+    return {
+        'busy': {user_id: merge_intervals(intervals) for user_id, intervals in busy.items()},
+        'free': free_slots(busy, start, end, min_duration, only_working_hours),
+    }
+
+def event_conflicts(user_ids, start, end, recurrence_rule='', exclude_event=None):
+    """
+    Пересечения события [start, end) (для серии - ее повторений в пределах
+    CONFLICT_HORIZON) с занятостью пользователей: [(пользователь, BusyInterval)].
+    """
+    duration = end - start
+    if recurrence_rule:
+        occurrences = [
+            (occurrence, occurrence + duration)
+            for occurrence in RecurrenceRule.parse(recurrence_rule).occurrences(
+                start, duration, start, start + CONFLICT_HORIZON
+            )
+        ]
+    else:
+        occurrences = [(start, end)]
+    if not occurrences or not user_ids:
+        return []
+
+    busy = busy_intervals(user_ids, occurrences[0][0], occurrences[-1][1], exclude_event)
+    return [
+        (user_id, interval)
+        for occurrence_start, occurrence_end in occurrences
+        for user_id, intervals in find_conflicts(busy, occurrence_start, occurrence_end).items()
+        for interval in intervals
+    ]
@@ -0,0 +1,26 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from crm.utils import backfill_analytics
+
+
+class Command(BaseCommand):
+    help = 'Заполнение таблицы Analytics дневными срезами и свертками за прошедшие дни'
+
+    def add_arguments(self, parser):
+        parser.add_argument('date_from', help='Начало диапазона, YYYY-MM-DD')
+        parser.add_argument('date_to', nargs='?', help='Конец диапазона, YYYY-MM-DD (по умолчанию вчера)')
+        parser.add_argument('--chunk-days', type=int, default=31, help='Дней в одной порции')
+
+    def handle(self, *args, **options):
+        date_from = parse_date(options['date_from'])
+        if options['date_to']:
+            date_to = parse_date(options['date_to'])
+        else:
+            date_to = timezone.localdate() - timedelta(days=1)
+        if not date_from or not date_to or date_from > date_to:
+            raise CommandError('Некорректный диапазон дат')
+
+        days = backfill_analytics(date_from, date_to, options['chunk_days'])
+        self.stdout.write(self.style.SUCCESS(f'Построено {days} дневных срезов'))
@@ -0,0 +1,48 @@
+from pathlib import Path
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from crm.benchmarks import run_benchmarks, compare_with_baseline, load_baseline, save_baseline
+from .seed_firm import SCALE_TIERS
+
+
+class Command(BaseCommand):
+    help = 'Замер горячих путей (время, запросы, пиковая память) и сравнение с эталоном'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tier', choices=SCALE_TIERS, default='small', help='Масштаб данных')
+        parser.add_argument('--seed', action='store_true', help='Пересоздать синтетическую фирму перед замером')
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--only', nargs='*', help='Замерить только указанные пути')
+        parser.add_argument('--baseline', default=str(Path(settings.BASE_DIR) / 'benchmarks' / 'baseline.json'))
+        parser.add_argument('--save-baseline', action='store_true', help='Сохранить результат как эталон')
+        parser.add_argument('--tolerance', type=float, default=0.25, help='Допустимое ухудшение времени и памяти')
+
+    def handle(self, *args, **options):
+        tier = options['tier']
+        if options['seed']:
+            call_command('seed_firm', tier=tier, flush=True, stdout=self.stdout)
+
+        results = run_benchmarks(repeat=options['repeat'], only=options['only'])
+
+        self.stdout.write(f'СУБД: {connection.vendor}, масштаб: {tier}')
+        self.stdout.write(f'{"путь":<28}{"время, мс":>12}{"запросов":>10}{"память, КБ":>12}')
+        for name, metrics in results.items():
+            self.stdout.write(f'{name:<28}{metrics["wall_ms"]:>12}{metrics["queries"]:>10}{metrics["peak_kb"]:>12}')
+
+        baseline_path = Path(options['baseline'])
+        if options['save_baseline']:
+            save_baseline(baseline_path, tier, results)
+            self.stdout.write(self.style.SUCCESS(f'Эталон сохранен в {baseline_path}'))
+            return
+
+        baseline = load_baseline(baseline_path, tier)
+        if not baseline:
+            self.stdout.write(self.style.WARNING('Эталон для этой СУБД и масштаба не найден'))
+            return
+
+        regressions = compare_with_baseline(results, baseline, options['tolerance'])
+        if regressions:
+            raise CommandError('Регрессии производительности:\n' + '\n'.join(regressions))
+        self.stdout.write(self.style.SUCCESS('Регрессий нет'))
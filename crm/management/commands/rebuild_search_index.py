@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from crm.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Полная перестройка поискового индекса дел, клиентов, задач и документов (после массовых вставок)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        counts = rebuild_search_index(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Проиндексировано: клиентов {counts['client']}, дел {counts['case']}, "
+            f"задач {counts['task']}, документов {counts['document']}"
+        ))
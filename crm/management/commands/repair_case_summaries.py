@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from crm.case_summary import repair_case_summaries
+
+
+class Command(BaseCommand):
+    help = 'Сверка сводки по делам (оплачено, часы, себестоимость, задачи, документы) с исходными данными'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='Только проверить, ошибка при расхождениях')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        drift = repair_case_summaries(batch_size=options['batch_size'], check_only=options['check'])
+        for case_id, field, stored, actual in drift[:50]:
+            self.stdout.write(f'Дело {case_id}: {field} = {stored}, должно быть {actual}')
+        cases = len({case_id for case_id, *_ in drift})
+        if options['check'] and drift:
+            raise CommandError(f'Расхождения в сводке: дел {cases}, полей {len(drift)}')
+        if drift:
+            self.stdout.write(self.style.SUCCESS(f'Исправлено дел: {cases}'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Расхождений нет'))
@@ -0,0 +1,286 @@
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from crm.models import *
+from crm.search import index_objects
+from crm.case_summary import repair_case_summaries
+
+# Масштабы синтетической фирмы
+SCALE_TIERS = {
+    'tiny': {'lawyers': 5, 'clients': 20, 'cases': 50, 'time_entries': 500, 'notifications': 200},
+    'small': {'lawyers': 20, 'clients': 500, 'cases': 2000, 'time_entries': 50000, 'notifications': 20000},
+    'medium': {'lawyers': 100, 'clients': 5000, 'cases': 20000, 'time_entries': 400000, 'notifications': 100000},
+    'large': {'lawyers': 500, 'clients': 20000, 'cases': 100000, 'time_entries': 2000000, 'notifications': 500000},
+}
+
+SYNTHETIC_PREFIX = 'synthetic'
+
+
+@contextmanager
+def manual_timestamps(*model_classes):
+    """Отключение auto_now/auto_now_add, чтобы bulk_create сохранил заданные даты"""
+    fields = [
+        field for model_class in model_classes for field in model_class._meta.fields
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+    ]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = 'Создание синтетической юридической фирмы заданного масштаба (массовые вставки)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tier', choices=SCALE_TIERS, default='tiny', help='Готовый масштаб')
+        for name in SCALE_TIERS['tiny']:
+            parser.add_argument(f'--{name.replace("_", "-")}', type=int, help=f'Переопределить количество: {name}')
+        parser.add_argument('--days', type=int, default=730, help='Глубина истории в днях')
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=42, help='Зерно генератора случайных чисел')
+        parser.add_argument('--flush', action='store_true', help='Удалить ранее созданные синтетические данные')
+
+    def handle(self, *args, **options):
+        scale = dict(SCALE_TIERS[options['tier']])
+        for name in scale:
+            if options.get(name) is not None:
+                scale[name] = options[name]
+        if scale['lawyers'] < 1 or scale['clients'] < 1:
+            raise CommandError('Нужен хотя бы один юрист и один клиент')
+
+        if options['flush']:
+            deleted, _ = CustomUser.objects.filter(username__startswith=f'{SYNTHETIC_PREFIX}_').delete()
+            self.stdout.write(f'Удалено объектов: {deleted}')
+
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.now = timezone.now()
+        self.days = options['days']
+        self.password = make_password(None)
+
+        with manual_timestamps(CustomUser, Client, Case, Task, Communication, Document,
+                               CalendarEvent, TimeEntry, Payment, Notification):
+            lawyer_ids = self.create_users('lawyer', scale['lawyers'])
+            client_user_ids = self.create_users('client', scale['clients'])
+            client_ids = self.create_clients(client_user_ids, lawyer_ids)
+            cases = self.create_cases(scale['cases'], client_ids, lawyer_ids)
+            self.create_case_children(cases)
+            self.create_time_entries(scale['time_entries'], cases)
+            self.create_calendar_events(lawyer_ids, cases)
+            self.create_notifications(scale['notifications'], lawyer_ids)
+
+        # bulk_create не вызывает сигналы - индекс поиска и сводку по делам строим явно
+        if client_ids:
+            index_objects('client', Client.objects.filter(id__gte=client_ids[0]), self.batch_size)
+        if cases:
+            index_objects('case', Case.objects.filter(id__gte=cases[0][0]), self.batch_size)
+            index_objects('task', Task.objects.filter(case_id__gte=cases[0][0]), self.batch_size)
+            index_objects('document', Document.objects.filter(case_id__gte=cases[0][0]), self.batch_size)
+            repair_case_summaries(Case.objects.filter(id__gte=cases[0][0]), self.batch_size)
+
+        self.stdout.write(self.style.SUCCESS(
+            'Создано: ' + ', '.join(f'{name}={count}' for name, count in scale.items())
+        ))
+
+    def past(self, days=None):
+        """Случайный момент в пределах истории"""
+        return self.now - timedelta(seconds=self.random.randint(0, (days or self.days) * 86400))
+
+    def bulk(self, model_class, objects):
+        """Вставка порциями из генератора, без накопления всех объектов в памяти"""
+        batch = []
+        for obj in objects:
+            batch.append(obj)
+            if len(batch) >= self.batch_size:
+                with transaction.atomic():
+                    model_class.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            with transaction.atomic():
+                model_class.objects.bulk_create(batch)
+
+    def new_ids(self, model_class, start_id):
+        return list(model_class.objects.filter(id__gt=start_id).order_by('id').values_list('id', flat=True))
+
+    def last_id(self, model_class):
+        return model_class.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+    def create_users(self, role, count):
+        start_id = self.last_id(CustomUser)
+        run = self.random.randint(0, 10 ** 9)
+        self.bulk(CustomUser, (
+            CustomUser(
+                username=f'{SYNTHETIC_PREFIX}_{role}_{run}_{index}',
+                password=self.password,
+                first_name=f'{role.capitalize()}',
+                last_name=str(index),
+                email=f'{role}{index}@example.com',
+                role=role,
+                hourly_rate=Decimal(self.random.randrange(150000, 900000)) / 100 if role == 'lawyer' else 0,
+                date_joined=self.now,
+                created_at=self.past(),
+            )
+            for index in range(count)
+        ))
+        return self.new_ids(CustomUser, start_id)
+
+    def create_clients(self, user_ids, lawyer_ids):
+        start_id = self.last_id(Client)
+        statuses = [status for status, _ in Client.STATUS_CHOICES]
+        self.bulk(Client, (
+            Client(
+                user_id=user_id,
+                company_name=f'ООО «Синтетика {index}»',
+                inn=f'{self.random.randrange(10 ** 9, 10 ** 10)}',
+                status=self.random.choice(statuses),
+                created_by_id=self.random.choice(lawyer_ids),
+                created_at=self.past(),
+                updated_at=self.now,
+            )
+            for index, user_id in enumerate(user_ids)
+        ))
+        return self.new_ids(Client, start_id)
+
+    def create_cases(self, count, client_ids, lawyer_ids):
+        """Возвращает список (id, lawyer_id, created_at) созданных дел"""
+        start_id = self.last_id(Case)
+        run = self.random.randint(0, 10 ** 9)
+        stages = [stage for stage, _ in Case.STAGE_CHOICES]
+        types = [case_type for case_type, _ in Case.TYPE_CHOICES]
+
+        def cases():
+            for index in range(count):
+                created_at = self.past()
+                stage = self.random.choice(stages)
+                yield Case(
+                    case_number=f'SYN-{run}-{index}',
+                    title=f'Синтетическое дело {index}',
+                    client_id=self.random.choice(client_ids),
+                    lawyer_id=self.random.choice(lawyer_ids),
+                    case_type=self.random.choice(types),
+                    stage=stage,
+                    description='Сгенерировано для нагрузочного тестирования',
+                    budget=Decimal(self.random.randrange(5000000, 500000000)) / 100,
+                    start_date=created_at.date(),
+                    end_date=(created_at + timedelta(days=self.random.randint(10, 400))).date() if stage == 'closed' else None,
+                    is_active=stage != 'closed' or self.random.random() < 0.3,
+                    created_at=created_at,
+                    updated_at=self.now,
+                )
+
+        self.bulk(Case, cases())
+        return list(Case.objects.filter(id__gt=start_id).order_by('id').values_list('id', 'lawyer_id', 'created_at'))
+
+    def create_case_children(self, cases):
+        """Задачи, платежи, коммуникации и документы: по несколько на дело"""
+        statuses = [status for status, _ in Task.STATUS_CHOICES]
+        priorities = [priority for priority, _ in Task.PRIORITY_CHOICES]
+        payment_types = [payment_type for payment_type, _ in Payment.PAYMENT_TYPE_CHOICES]
+        categories = [category for category, _ in Document.CATEGORY_CHOICES]
+        communication_types = [kind for kind, _ in Communication.TYPE_CHOICES]
+
+        def tasks():
+            for case_id, lawyer_id, created_at in cases:
+                for index in range(self.random.randint(1, 5)):
+                    status = self.random.choice(statuses)
+                    due_date = created_at + timedelta(days=self.random.randint(1, 120))
+                    yield Task(
+                        title=f'Задача {index}', description='', case_id=case_id,
+                        assigned_to_id=lawyer_id, assigned_by_id=lawyer_id,
+                        priority=self.random.choice(priorities), status=status, due_date=due_date,
+                        completed_at=due_date if status == 'done' else None, created_at=created_at,
+                    )
+
+        def payments():
+            for case_id, _, created_at in cases:
+                for index in range(self.random.randint(0, 4)):
+                    payment_date = min(created_at + timedelta(days=self.random.randint(0, 365)), self.now).date()
+                    is_paid = self.random.random() < 0.8
+                    yield Payment(
+                        case_id=case_id, amount=Decimal(self.random.randrange(500000, 50000000)) / 100,
+                        payment_type=self.random.choice(payment_types), payment_date=payment_date,
+                        is_paid=is_paid, paid_date=payment_date if is_paid else None,
+                        invoice_number=f'INV-{case_id}-{index}', created_at=created_at,
+                    )
+
+        def communications():
+            for case_id, lawyer_id, created_at in cases:
+                for index in range(self.random.randint(0, 4)):
+                    yield Communication(
+                        case_id=case_id, communication_type=self.random.choice(communication_types),
+                        subject=f'Коммуникация {index}', content='', created_by_id=lawyer_id,
+                        created_at=created_at + timedelta(days=index),
+                    )
+
+        def documents():
+            for case_id, lawyer_id, created_at in cases:
+                for index in range(self.random.randint(0, 3)):
+                    yield Document(
+                        case_id=case_id, title=f'Документ {index}', category=self.random.choice(categories),
+                        file=f'documents/synthetic/{case_id}_{index}.pdf', uploaded_by_id=lawyer_id,
+                        uploaded_at=created_at + timedelta(days=index),
+                    )
+
+        self.bulk(Task, tasks())
+        self.bulk(Payment, payments())
+        self.bulk(Communication, communications())
+        self.bulk(Document, documents())
+
+    def create_time_entries(self, count, cases):
+        def entries():
+            for _ in range(count):
+                case_id, lawyer_id, created_at = self.random.choice(cases)
+                start_time = created_at + (self.now - created_at) * self.random.random()
+                duration = Decimal(self.random.randint(10, 800)) / 100
+                yield TimeEntry(
+                    lawyer_id=lawyer_id, case_id=case_id, description='Работа по делу',
+                    start_time=start_time, end_time=start_time + timedelta(hours=float(duration)),
+                    duration=duration, billable=self.random.random() < 0.85, created_at=start_time,
+                )
+
+        if cases:
+            self.bulk(TimeEntry, entries())
+
+    def create_calendar_events(self, lawyer_ids, cases):
+        """По 50 событий на юриста, участники вставляются через промежуточную таблицу"""
+        start_id = self.last_id(CalendarEvent)
+        event_types = [event_type for event_type, _ in CalendarEvent.EVENT_TYPE_CHOICES]
+
+        def events():
+            for lawyer_id in lawyer_ids:
+                for index in range(50):
+                    start_time = self.past(days=365) + timedelta(days=self.random.randint(0, 60))
+                    yield CalendarEvent(
+                        title=f'Событие {index}', event_type=self.random.choice(event_types),
+                        start_time=start_time, end_time=start_time + timedelta(hours=self.random.randint(1, 3)),
+                        case_id=self.random.choice(cases)[0] if cases else None,
+                        created_by_id=lawyer_id, created_at=start_time - timedelta(days=7),
+                    )
+
+        self.bulk(CalendarEvent, events())
+        Participant = CalendarEvent.participants.through
+        self.bulk(Participant, (
+            Participant(calendarevent_id=event_id, customuser_id=created_by_id)
+            for event_id, created_by_id in CalendarEvent.objects.filter(id__gt=start_id).values_list('id', 'created_by_id')
+        ))
+
+    def create_notifications(self, count, lawyer_ids):
+        types = [kind for kind, _ in Notification.NOTIFICATION_TYPES]
+        self.bulk(Notification, (
+            Notification(
+                user_id=self.random.choice(lawyer_ids), title='Синтетическое уведомление', message='',
+                notification_type=self.random.choice(types), is_read=self.random.random() < 0.7,
+                created_at=self.past(days=180),
+            )
+            for _ in range(count)
+        ))
@@ -1,8 +1,78 @@
 from django.db import models
-from django.contrib.auth.models import User, AbstractUser
+from django.db.models.functions import Coalesce
+from django.contrib.auth.models import User, AbstractUser, UserManager
 from django.core.validators import MinValueValidator, MaxValueValidator
+from datetime import datetime, timedelta
 import uuid
 from django.utils import timezone
+from .recurrence import RecurrenceRule, validate_recurrence_rule
+
+STATISTICS_DECIMAL = models.DecimalField(max_digits=15, decimal_places=2)
+EFFICIENCY_DECIMAL = models.DecimalField(max_digits=15, decimal_places=4)
+
+def _day_start(value):
+    """Начало дня для даты (локальная зона) или сама дата-время"""
+    if isinstance(value, datetime) or value is None:
+        return value
+    return timezone.make_aware(datetime.combine(value, datetime.min.time()))
+
+def _subquery_total(queryset, group_field, aggregate, output_field):
+    totals = queryset.filter(**{group_field: models.OuterRef('pk')}).order_by().values(
+        group_field
+    ).annotate(total=aggregate).values('total')
+    return Coalesce(models.Subquery(totals, output_field=output_field), models.Value(0), output_field=output_field)
+
+class CustomUserQuerySet(models.QuerySet):
+    def lawyers(self):
+        return self.filter(role='lawyer', is_active=True)
+    
+    def with_statistics(self, date_from=None, date_to=None, cases=None, closed_cases=None):
+        """
+        Статистика юристов одним запросом: cases_count, closed_cases_count,
+        revenue, total_hours и efficiency (выручка / (часы * ставка)).
+        Каждая метрика считается своим коррелированным подзапросом,
+        поэтому соединения не размножают строки.
+        
+        date_from/date_to (date или datetime, включительно) ограничивают платежи
+        и записи времени; cases и closed_cases задают, какие дела считать.
+        """
+        cases = Case.objects.all() if cases is None else cases
+        closed_cases = cases.filter(stage='closed') if closed_cases is None else closed_cases
+        
+        payments = Payment.objects.filter(is_paid=True)
+        time_entries = TimeEntry.objects.all()
+        if date_from:
+            payments = payments.filter(payment_date__gte=date_from)
+            time_entries = time_entries.filter(start_time__gte=_day_start(date_from))
+        if date_to:
+            payments = payments.filter(payment_date__lte=date_to)
+            if isinstance(date_to, datetime):
+                time_entries = time_entries.filter(start_time__lte=date_to)
+            else:
+                time_entries = time_entries.filter(start_time__lt=_day_start(date_to + timedelta(days=1)))
+        
+        return self.annotate(
+            cases_count=_subquery_total(cases, 'lawyer', models.Count('pk'), models.IntegerField()),
+            closed_cases_count=_subquery_total(closed_cases, 'lawyer', models.Count('pk'), models.IntegerField()),
+            revenue=_subquery_total(payments, 'case__lawyer', models.Sum('amount'), STATISTICS_DECIMAL),
+            total_hours=_subquery_total(time_entries, 'lawyer', models.Sum('duration'), STATISTICS_DECIMAL),
+        ).annotate(
+            efficiency=models.Case(
+                models.When(
+                    total_hours__gt=0,
+                    hourly_rate__gt=0,
+                    then=models.ExpressionWrapper(
+                        models.F('revenue') / (models.F('total_hours') * models.F('hourly_rate')),
+                        output_field=EFFICIENCY_DECIMAL
+                    )
+                ),
+                default=models.Value(0),
+                output_field=EFFICIENCY_DECIMAL
+            )
+        )
+
+class CustomUserManager(UserManager.from_queryset(CustomUserQuerySet)):
+    pass
 
 class CustomUser(AbstractUser):
     ROLE_CHOICES = (
@@ -19,6 +89,48 @@ class CustomUser(AbstractUser):
     hourly_rate = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Секрет адреса ICS-ленты календаря (подписка без входа в систему)
+    calendar_token = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    
+    objects = CustomUserManager()
+
+class ClientQuerySet(models.QuerySet):
+    RANKING_FIELDS = {
+        'revenue': 'revenue',
+        'cases': 'cases_count',
+        'outstanding': 'outstanding',
+    }
+    
+    def with_totals(self, date_from=None, date_to=None):
+        """
+        revenue - оплаченные платежи за период, outstanding - неоплаченные платежи,
+        cases_count - все дела клиента. Подзапросы не размножают строки.
+        """
+        payments = Payment.objects.filter(is_paid=True)
+        if date_from:
+            payments = payments.filter(payment_date__gte=date_from)
+        if date_to:
+            payments = payments.filter(payment_date__lte=date_to)
+        
+        return self.annotate(
+            revenue=_subquery_total(payments, 'case__client', models.Sum('amount'), STATISTICS_DECIMAL),
+            outstanding=_subquery_total(
+                Payment.objects.filter(is_paid=False), 'case__client', models.Sum('amount'), STATISTICS_DECIMAL
+            ),
+            cases_count=_subquery_total(Case.objects.all(), 'client', models.Count('pk'), models.IntegerField()),
+        )
+    
+    def ranked(self, by='revenue', date_from=None, date_to=None):
+        """
+        Рейтинг клиентов по выручке, количеству дел или задолженности.
+        Сортировка и LIMIT/OFFSET срезов выполняются в БД.
+        """
+        if by not in self.RANKING_FIELDS:
+            raise ValueError(f'Неизвестный рейтинг: {by}')
+        field = self.RANKING_FIELDS[by]
+        return self.with_totals(date_from, date_to).filter(
+            **{f'{field}__gt': 0}
+        ).select_related('user').order_by(f'-{field}', 'id')
 
 class Client(models.Model):
     STATUS_CHOICES = (
@@ -28,6 +140,12 @@ class Client(models.Model):
         ('lost', 'Утерян'),
     )
     
+    RANKING_CHOICES = (
+        ('revenue', 'По выручке'),
+        ('cases', 'По количеству дел'),
+        ('outstanding', 'По задолженности'),
+    )
+    
     user = models.OneToOneField(CustomUser, on_delete=models.CASCADE, related_name='client_profile')
     company_name = models.CharField(max_length=200, blank=True)
     inn = models.CharField(max_length=12, blank=True)
@@ -38,6 +156,8 @@ class Client(models.Model):
     created_by = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True, related_name='clients_created')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    
+    objects = ClientQuerySet.as_manager()
 
 class Case(models.Model):
     STAGE_CHOICES = (
@@ -77,6 +197,42 @@ class Case(models.Model):
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    
+    # Сводка по делу (вместе с actual_cost - себестоимостью оплачиваемых часов).
+    # Пересчитывается сигналами при изменении платежей, часов, задач и документов
+    # (crm.case_summary), расхождения исправляет команда repair_case_summaries
+    total_paid = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    total_outstanding = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    total_hours = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    tasks_done = models.PositiveIntegerField(default=0)
+    tasks_pending = models.PositiveIntegerField(default=0)
+    documents_count = models.PositiveIntegerField(default=0)
+    SUMMARY_FIELDS = (
+        'actual_cost', 'total_paid', 'total_outstanding', 'total_hours',
+        'tasks_done', 'tasks_pending', 'documents_count',
+    )
+    
+    class Meta:
+        indexes = [
+            # Логические поля не первые: в SQLite filter(is_active=True) - это
+            # WHERE "is_active" без сравнения, и индекс с него не используется
+            models.Index(fields=['stage', 'is_active', 'created_at']),
+            models.Index(fields=['lawyer', 'is_active']),
+            # Список дел по дате (чтение индекса в обратном порядке до LIMIT) и аналитика
+            models.Index(fields=['created_at']),
+            # Покрывающий индекс счетчиков фасетов (crm.facets): группировка без чтения таблицы
+            models.Index(fields=['stage', 'case_type', 'client', 'is_active']),
+        ]
+    
+    def save(self, *args, **kwargs):
+        # Сводку пишет только пересчет (crm.case_summary): экземпляр, загруженный
+        # до изменения платежей или часов, не должен затирать ее прежними значениями
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.SUMMARY_FIELDS
+            ]
+        super().save(*args, **kwargs)
 
 class Task(models.Model):
     PRIORITY_CHOICES = (
@@ -105,6 +261,12 @@ class Task(models.Model):
     estimated_hours = models.DecimalField(max_digits=5, decimal_places=2, default=1)
     actual_hours = models.DecimalField(max_digits=5, decimal_places=2, default=0)
     created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'due_date']),
+            models.Index(fields=['assigned_to', 'status']),
+        ]
 
 class Communication(models.Model):
     TYPE_CHOICES = (
@@ -169,6 +331,93 @@ class CalendarEvent(models.Model):
     color = models.CharField(max_length=7, default='#3788d8')
     created_by = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Серия: start_time/end_time - первое повторение, правило RRULE (см. crm.recurrence)
+    recurrence_rule = models.CharField(max_length=255, blank=True, validators=[validate_recurrence_rule])
+    # Конец последнего повторения серии (None - бесконечная серия или не серия)
+    recurrence_end = models.DateTimeField(null=True, blank=True, editable=False)
+    # Номер версии события (SEQUENCE в iCalendar), растет при каждом изменении
+    sequence = models.PositiveIntegerField(default=0, editable=False)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['start_time', 'end_time']),
+            models.Index(fields=['recurrence_end', 'start_time']),
+        ]
+    
+    @property
+    def rule(self):
+        return RecurrenceRule.parse(self.recurrence_rule) if self.recurrence_rule else None
+    
+    def save(self, *args, **kwargs):
+        self.recurrence_end = None
+        if self.recurrence_rule:
+            last = self.rule.last_occurrence(self.start_time)
+            self.recurrence_end = last + (self.end_time - self.start_time) if last else None
+        if self.pk:
+            self.sequence += 1
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            extra = {'sequence'}
+            if {'start_time', 'end_time', 'recurrence_rule'} & set(update_fields):
+                extra.add('recurrence_end')
+            kwargs['update_fields'] = {*update_fields, *extra}
+        super().save(*args, **kwargs)
+
+class CalendarEventOverride(models.Model):
+    """
+    Изменение одного повторения серии: перенос, другое название, место или
+    описание, либо отмена (исключение). Пустые поля берутся из серии.
+    """
+    event = models.ForeignKey(CalendarEvent, on_delete=models.CASCADE, related_name='overrides')
+    # Начало повторения по правилу серии
+    original_start = models.DateTimeField()
+    is_cancelled = models.BooleanField(default=False)
+    title = models.CharField(max_length=200, blank=True)
+    description = models.TextField(blank=True)
+    location = models.CharField(max_length=200, blank=True)
+    start_time = models.DateTimeField(null=True, blank=True)
+    end_time = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['event', 'original_start'], name='unique_event_occurrence_override'),
+        ]
+        indexes = [
+            models.Index(fields=['start_time', 'end_time']),
+        ]
+
+class CalendarChange(models.Model):
+    """
+    Журнал изменений календаря пользователя для синхронизации: по строке на
+    пару (пользователь, событие) с последним изменением. id - возрастающий номер
+    изменения (токен синхронизации); deleted - событие удалено или больше не
+    видно пользователю (tombstone, хранится CALENDAR_SYNC_TOKEN_TTL).
+    event_id без внешнего ключа: строка переживает удаление события.
+    """
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='calendar_changes')
+    event_id = models.PositiveIntegerField()
+    deleted = models.BooleanField(default=False)
+    changed_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'event_id'], name='unique_user_calendar_change'),
+        ]
+        indexes = [
+            models.Index(fields=['deleted', 'changed_at']),
+        ]
+
+class CalendarSyncState(models.Model):
+    """Последний токен синхронизации календаря пользователя с внешним сервисом"""
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='calendar_sync_states')
+    service = models.CharField(max_length=50)
+    token = models.CharField(max_length=200, blank=True)
+    last_synced_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'service'], name='unique_user_calendar_sync'),
+        ]
 
 class TimeEntry(models.Model):
     lawyer = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='time_entries')
@@ -181,6 +430,13 @@ class TimeEntry(models.Model):
     billable = models.BooleanField(default=True)
     billed = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['lawyer', 'start_time']),
+            # Себестоимость (billable) и часы в аналитике за период
+            models.Index(fields=['start_time', 'billable']),
+        ]
 
 class Payment(models.Model):
     PAYMENT_TYPE_CHOICES = (
@@ -201,6 +457,11 @@ class Payment(models.Model):
     invoice_number = models.CharField(max_length=50, blank=True)
     notes = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['payment_date', 'is_paid']),
+        ]
 
 class Analytics(models.Model):
     period = models.CharField(max_length=20)  # 'daily', 'weekly', 'monthly', 'yearly'
@@ -212,6 +473,7 @@ class Analytics(models.Model):
     new_clients = models.IntegerField(default=0)
     lawyer_performance = models.JSONField(default=dict)  # Статистика по юристам
     case_type_distribution = models.JSONField(default=dict)
+    is_stale = models.BooleanField(default=False)  # Исходные данные изменились, ждет пересчета
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
@@ -252,4 +514,55 @@ class Notification(models.Model):
         self.save()
     
     def __str__(self):
-        return f"{self.title} - {self.user.username}"
\ No newline at end of file
+        return f"{self.title} - {self.user.username}"
+
+class EndpointProfile(models.Model):
+    """Накопленная SQL-статистика представления или задачи Celery (см. crm.profiling)"""
+    endpoint = models.CharField(max_length=200, unique=True)
+    calls = models.PositiveIntegerField(default=0)
+    total_queries = models.PositiveIntegerField(default=0)
+    max_queries = models.PositiveIntegerField(default=0)
+    total_db_time_ms = models.FloatField(default=0)
+    max_db_time_ms = models.FloatField(default=0)
+    duplicate_queries = models.PositiveIntegerField(default=0)
+    n_plus_one_calls = models.PositiveIntegerField(default=0)
+    over_budget_calls = models.PositiveIntegerField(default=0)
+    query_budget = models.PositiveIntegerField(null=True, blank=True)
+    last_seen = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-max_queries']
+    
+    @property
+    def avg_queries(self):
+        return round(self.total_queries / self.calls, 1) if self.calls else 0
+    
+    @property
+    def avg_db_time_ms(self):
+        return round(self.total_db_time_ms / self.calls, 2) if self.calls else 0
+    
+    def __str__(self):
+        return self.endpoint
+
+class SearchEntry(models.Model):
+    """Токен поискового индекса дел, клиентов, задач и документов (см. crm.search)"""
+    KIND_CHOICES = (
+        ('case', 'Дело'),
+        ('client', 'Клиент'),
+        ('task', 'Задача'),
+        ('document', 'Документ'),
+    )
+    
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.PositiveIntegerField()
+    token = models.CharField(max_length=64)
+    weight = models.PositiveSmallIntegerField(default=1)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['kind', 'token']),
+            models.Index(fields=['kind', 'object_id']),
+        ]
+    
+    def __str__(self):
+        return f"{self.kind}:{self.object_id} {self.token}"
@@ -0,0 +1,167 @@
+"""
+Постраничный вывод по курсору (keyset) для списков и API.
+
+Страница выбирается условием «после последней записи предыдущей страницы»
+по полям сортировки (по умолчанию created_at, id), поэтому глубокие страницы
+стоят столько же, сколько первая, а COUNT(*) не выполняется на каждый запрос:
+общее количество берется из кэша (cached_count).
+"""
+import base64
+import hashlib
+import json
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.http import Http404
+
+class InvalidCursor(ValueError):
+    pass
+
+def _dump(value):
+    # isoformat сохраняет микросекунды, которые DjangoJSONEncoder отбрасывает
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+def encode_cursor(values):
+    data = json.dumps([_dump(value) for value in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError as error:
+        raise InvalidCursor(str(error))
+    if not isinstance(values, list):
+        raise InvalidCursor('Курсор должен быть списком значений')
+    return values
+
+def cached_count(queryset, timeout=None):
+    """Количество строк queryset из кэша (приблизительное в пределах LIST_COUNT_CACHE_TTL)"""
+    sql, params = queryset.query.sql_with_params()
+    key = 'list_count:' + hashlib.md5(f'{sql}|{params!r}'.encode()).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, timeout if timeout is not None else settings.LIST_COUNT_CACHE_TTL)
+    return count
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor, per_page):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.per_page = per_page
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+class KeysetPaginator:
+    """
+    ordering - поля сортировки, последнее должно быть уникальным (обычно id);
+    '-' перед именем - по убыванию.
+    """
+
+    def __init__(self, queryset, per_page, ordering=('-created_at', '-id')):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = ordering
+        self.fields = [field.lstrip('-') for field in ordering]
+
+    @property
+    def count(self):
+        return cached_count(self.queryset.order_by())
+
+    def _after(self, values):
+        """(a, b) после (va, vb) при убывании: a < va ИЛИ (a = va И b < vb)"""
+        if len(values) != len(self.fields):
+            raise InvalidCursor('Курсор не соответствует сортировке')
+        model_fields = [self.queryset.model._meta.get_field(field) for field in self.fields]
+        try:
+            values = [field.to_python(value) for field, value in zip(model_fields, values)]
+        except (ValidationError, TypeError) as error:
+            raise InvalidCursor(str(error))
+
+        condition = Q()
+        for index, order in enumerate(self.ordering):
+            lookup = 'lt' if order.startswith('-') else 'gt'
+            step = Q(**{f'{self.fields[index]}__{lookup}': values[index]})
+            for previous in range(index):
+                step &= Q(**{self.fields[previous]: values[previous]})
+            condition |= step
+        return condition
+
+    def page(self, cursor=None):
+        queryset = self.queryset.order_by(*self.ordering)
+        if cursor:
+            queryset = queryset.filter(self._after(decode_cursor(cursor)))
+
+        rows = list(queryset[:self.per_page + 1])
+        next_cursor = None
+        if len(rows) > self.per_page:
+            rows = rows[:self.per_page]
+            next_cursor = encode_cursor([getattr(rows[-1], field) for field in self.fields])
+        return KeysetPage(rows, next_cursor, self.per_page)
+
+def keyset_results(request, queryset, serialize, ordering=('-created_at', '-id'), default_page_size=20):
+    """
+    Данные ответа списочного API: ?cursor=&page_size= ->
+    {'results', 'next_cursor', 'count'}. Некорректный курсор - InvalidCursor.
+    """
+    try:
+        page_size = min(max(int(request.GET.get('page_size', default_page_size)), 1), 100)
+    except ValueError:
+        page_size = default_page_size
+    paginator = KeysetPaginator(queryset, page_size, ordering)
+    page = paginator.page(request.GET.get('cursor'))
+    return {
+        'results': [serialize(obj) for obj in page],
+        'next_cursor': page.next_cursor,
+        'count': paginator.count,
+    }
+
+class KeysetPaginationMixin:
+    """
+    Режим курсора для ListView: включается параметром ?cursor= (пустое значение -
+    первая страница). Без параметра работает обычная постраничная навигация.
+    Для htmx-запросов в режиме курсора отдается keyset_partial_template -
+    строки списка с элементом, подгружающим next_page_url (бесконечная прокрутка).
+    """
+    keyset_ordering = ('-created_at', '-id')
+    keyset_partial_template = None
+
+    def keyset_mode(self):
+        return 'cursor' in self.request.GET
+
+    def get_template_names(self):
+        if self.keyset_partial_template and self.keyset_mode() and getattr(self.request, 'htmx', False):
+            return [self.keyset_partial_template]
+        return super().get_template_names()
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.keyset_mode():
+            return super().paginate_queryset(queryset, page_size)
+
+        cursor = self.request.GET.get('cursor')
+        paginator = KeysetPaginator(queryset, page_size, self.keyset_ordering)
+        try:
+            page = paginator.page(cursor)
+        except InvalidCursor:
+            raise Http404('Некорректный курсор')
+        return paginator, page, page.object_list, page.has_next or bool(cursor)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        page = context.get('page_obj')
+        if isinstance(page, KeysetPage):
+            context['next_page_url'] = None
+            if page.has_next:
+                params = self.request.GET.copy()
+                params['cursor'] = page.next_cursor
+                context['next_page_url'] = f'{self.request.path}?{params.urlencode()}'
+        return context
@@ -0,0 +1,211 @@
+"""
+Профилирование SQL по запросам и задачам Celery.
+
+Включается настройкой SQL_PROFILING (по умолчанию выключено). Для каждого
+представления и задачи считаются запросы, время в БД, точные дубликаты
+(тот же SQL с теми же параметрами) и похожие запросы (тот же SQL с другими
+параметрами - типичный признак N+1). Результат отдается в заголовках ответа,
+пишется в лог crm.profiling и копится в EndpointProfile (раздел админки).
+"""
+import json
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import IntegrityError, connections, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.urls import resolve
+from django.utils import timezone
+
+logger = logging.getLogger('crm.profiling')
+
+# Сколько повторов одного шаблона SQL считать признаком N+1
+SIMILAR_QUERY_THRESHOLD = 3
+
+def query_budget(budget):
+    """Декоратор для функций-представлений: допустимое число запросов"""
+    def decorator(view_func):
+        view_func.query_budget = budget
+        return view_func
+    return decorator
+
+def get_query_budget(view_func):
+    budget = getattr(view_func, 'query_budget', None)
+    if budget is None and hasattr(view_func, 'view_class'):
+        budget = getattr(view_func.view_class, 'query_budget', None)
+    return budget
+
+class QueryProfile:
+    """Сбор всех SQL-запросов через execute_wrapper на всех подключениях"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, repr(params), time.perf_counter() - started))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def db_time_ms(self):
+        return round(sum(duration for _, _, duration in self.queries) * 1000, 2)
+
+    def duplicates(self):
+        """Точные повторы: {sql: сколько лишних выполнений}"""
+        counts = Counter((sql, params) for sql, params, _ in self.queries)
+        return {sql: count - 1 for (sql, _), count in counts.items() if count > 1}
+
+    def similar(self, threshold=SIMILAR_QUERY_THRESHOLD):
+        """Один шаблон SQL с разными параметрами, не реже threshold раз"""
+        counts = Counter(sql for sql, _, _ in self.queries)
+        return {sql: count for sql, count in counts.items() if count >= threshold}
+
+    def summary(self):
+        return {
+            'queries': self.count,
+            'db_time_ms': self.db_time_ms,
+            'duplicates': sum(self.duplicates().values()),
+            'similar': self.similar(),
+        }
+
+    def report(self):
+        lines = [f'Запросов: {self.count}, время в БД: {self.db_time_ms} мс']
+        for sql, count in sorted(self.similar().items(), key=lambda item: -item[1]):
+            lines.append(f'  x{count}: {sql[:300]}')
+        return '\n'.join(lines)
+
+@contextmanager
+def profile_queries():
+    profile = QueryProfile()
+    wrappers = [connection.execute_wrapper(profile) for connection in connections.all()]
+    for wrapper in wrappers:
+        wrapper.__enter__()
+    try:
+        yield profile
+    finally:
+        for wrapper in reversed(wrappers):
+            wrapper.__exit__(None, None, None)
+
+def record_profile(endpoint, profile, budget=None):
+    """Структурированный лог и накопление статистики по точке входа"""
+    from .models import EndpointProfile
+
+    summary = profile.summary()
+    over_budget = budget is not None and summary['queries'] > budget
+    payload = {
+        'endpoint': endpoint,
+        'queries': summary['queries'],
+        'db_time_ms': summary['db_time_ms'],
+        'duplicates': summary['duplicates'],
+        'n_plus_one': len(summary['similar']),
+        'budget': budget,
+    }
+    level = logging.WARNING if over_budget or summary['similar'] else logging.INFO
+    logger.log(level, json.dumps(payload, ensure_ascii=False), extra={'sql_profile': payload})
+
+    def accumulate():
+        return EndpointProfile.objects.filter(endpoint=endpoint).update(
+            calls=F('calls') + 1,
+            total_queries=F('total_queries') + summary['queries'],
+            max_queries=Greatest('max_queries', summary['queries']),
+            total_db_time_ms=F('total_db_time_ms') + summary['db_time_ms'],
+            max_db_time_ms=Greatest('max_db_time_ms', summary['db_time_ms']),
+            duplicate_queries=F('duplicate_queries') + summary['duplicates'],
+            n_plus_one_calls=F('n_plus_one_calls') + (1 if summary['similar'] else 0),
+            over_budget_calls=F('over_budget_calls') + (1 if over_budget else 0),
+            query_budget=budget,
+            last_seen=timezone.now(),
+        )
+
+    if not accumulate():
+        try:
+            # В точке сохранения: ошибка вставки не прерывает транзакцию запроса
+            with transaction.atomic():
+                EndpointProfile.objects.create(
+                    endpoint=endpoint,
+                    calls=1,
+                    total_queries=summary['queries'],
+                    max_queries=summary['queries'],
+                    total_db_time_ms=summary['db_time_ms'],
+                    max_db_time_ms=summary['db_time_ms'],
+                    duplicate_queries=summary['duplicates'],
+                    n_plus_one_calls=1 if summary['similar'] else 0,
+                    over_budget_calls=1 if over_budget else 0,
+                    query_budget=budget,
+                )
+        except IntegrityError:
+            # Строку точки входа между UPDATE и INSERT создал параллельный запрос
+            accumulate()
+    return payload
+
+class SQLProfilingMiddleware:
+    """Профилирование SQL каждого запроса; заголовки X-DB-* в ответе"""
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'SQL_PROFILING', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with profile_queries() as profile:
+            response = self.get_response(request)
+
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return response
+
+        budget = get_query_budget(match.func)
+        payload = record_profile(match.view_name or match._func_path, profile, budget)
+        response['X-DB-Queries'] = payload['queries']
+        response['X-DB-Time-Ms'] = payload['db_time_ms']
+        response['X-DB-Duplicates'] = payload['duplicates']
+        response['X-DB-N-Plus-One'] = payload['n_plus_one']
+        if budget is not None:
+            response['X-DB-Query-Budget'] = budget
+        return response
+
+def connect_celery_profiling():
+    """Профилирование задач Celery через сигналы task_prerun/task_postrun"""
+    from celery.signals import task_prerun, task_postrun
+
+    active = {}
+
+    @task_prerun.connect(weak=False)
+    def start_task_profile(task_id=None, task=None, **kwargs):
+        context = profile_queries()
+        active[task_id] = (context, context.__enter__())
+
+    @task_postrun.connect(weak=False)
+    def finish_task_profile(task_id=None, task=None, **kwargs):
+        if task_id not in active:
+            return
+        context, profile = active.pop(task_id)
+        context.__exit__(None, None, None)
+        record_profile(f'task:{task.name}', profile, getattr(task, 'query_budget', None))
+
+class QueryBudgetTestMixin:
+    """Проверки для TestCase: запрос к представлению не превышает заявленный бюджет"""
+
+    @contextmanager
+    def assertQueryBudget(self, budget):
+        with profile_queries() as profile:
+            yield profile
+        if profile.count > budget:
+            self.fail(f'Превышен бюджет запросов: {profile.count} > {budget}\n{profile.report()}')
+
+    def assertWithinQueryBudget(self, path, data=None, method='get'):
+        budget = get_query_budget(resolve(path).func)
+        if budget is None:
+            self.fail(f'Для {path} не задан query_budget')
+        with self.assertQueryBudget(budget):
+            response = getattr(self.client, method)(path, data or {})
+        return response
@@ -0,0 +1,172 @@
+"""
+Правила повторения событий календаря - подмножество RRULE (RFC 5545):
+
+    FREQ=DAILY|WEEKLY|MONTHLY;INTERVAL=n;BYDAY=MO,WE (только WEEKLY);
+    COUNT=n или UNTIL=YYYYMMDD[THHMMSS[Z]]
+
+Серия хранится одной строкой CalendarEvent, повторения не сохраняются, а
+вычисляются только для запрошенного окна: правило сразу переходит к периоду
+(дню, неделе, месяцу), в котором начинается окно, и число пропущенных
+повторений для COUNT считается без перебора (кроме месячных правил - там
+перебор месяцев). Повторения строятся в местном времени, поэтому еженедельная
+встреча в 10:00 остается в 10:00 и после перехода на летнее время.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+
+FREQUENCIES = ('DAILY', 'WEEKLY', 'MONTHLY')
+WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+MAX_COUNT = 1000
+
+class RecurrenceError(ValueError):
+    pass
+
+def _parse_until(value):
+    for fmt in ('%Y%m%dT%H%M%SZ', '%Y%m%dT%H%M%S', '%Y%m%d'):
+        try:
+            moment = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if fmt.endswith('Z'):
+            return moment.replace(tzinfo=dt_timezone.utc)
+        if fmt == '%Y%m%d':
+            # Дата включительно - до конца дня
+            moment += timedelta(days=1, microseconds=-1)
+        return timezone.make_aware(moment)
+    raise RecurrenceError(f'Некорректное UNTIL: {value}')
+
+def _add_months(day, months):
+    month_index = day.year * 12 + day.month - 1 + months
+    return month_index // 12, month_index % 12 + 1
+
+class RecurrenceRule:
+    def __init__(self, freq, interval=1, byday=(), count=None, until=None):
+        self.freq = freq
+        self.interval = interval
+        self.byday = tuple(sorted(set(byday)))
+        self.count = count
+        self.until = until
+
+    @classmethod
+    def parse(cls, text):
+        """Правило из строки RRULE (с префиксом «RRULE:» или без)"""
+        parts = {}
+        for part in text.strip().removeprefix('RRULE:').split(';'):
+            key, separator, value = part.partition('=')
+            if not separator or not value:
+                raise RecurrenceError(f'Некорректная часть правила: {part}')
+            parts[key.strip().upper()] = value.strip().upper()
+
+        unknown = set(parts) - {'FREQ', 'INTERVAL', 'BYDAY', 'COUNT', 'UNTIL'}
+        if unknown:
+            raise RecurrenceError(f'Не поддерживается: {", ".join(sorted(unknown))}')
+        freq = parts.get('FREQ')
+        if freq not in FREQUENCIES:
+            raise RecurrenceError('FREQ должно быть DAILY, WEEKLY или MONTHLY')
+        if 'COUNT' in parts and 'UNTIL' in parts:
+            raise RecurrenceError('COUNT и UNTIL нельзя задавать вместе')
+        try:
+            interval = int(parts.get('INTERVAL', 1))
+            count = int(parts['COUNT']) if 'COUNT' in parts else None
+        except ValueError:
+            raise RecurrenceError('INTERVAL и COUNT должны быть числами')
+        if interval < 1 or count is not None and not 1 <= count <= MAX_COUNT:
+            raise RecurrenceError(f'INTERVAL от 1, COUNT от 1 до {MAX_COUNT}')
+
+        byday = []
+        if 'BYDAY' in parts:
+            if freq != 'WEEKLY':
+                raise RecurrenceError('BYDAY поддерживается только для WEEKLY')
+            for day in parts['BYDAY'].split(','):
+                if day not in WEEKDAYS:
+                    raise RecurrenceError(f'Некорректный день недели: {day}')
+                byday.append(WEEKDAYS.index(day))
+        until = _parse_until(parts['UNTIL']) if 'UNTIL' in parts else None
+        return cls(freq, interval, byday, count, until)
+
+    def __str__(self):
+        parts = [f'FREQ={self.freq}']
+        if self.interval != 1:
+            parts.append(f'INTERVAL={self.interval}')
+        if self.byday:
+            parts.append('BYDAY=' + ','.join(WEEKDAYS[day] for day in self.byday))
+        if self.count:
+            parts.append(f'COUNT={self.count}')
+        if self.until:
+            parts.append('UNTIL=' + self.until.astimezone(dt_timezone.utc).strftime('%Y%m%dT%H%M%SZ'))
+        return ';'.join(parts)
+
+    def _period_starts(self, first, period):
+        """Начала повторений периода period (местное время без зоны), не раньше first"""
+        if self.freq == 'DAILY':
+            return [first + timedelta(days=period * self.interval)]
+        if self.freq == 'WEEKLY':
+            week = first.date() - timedelta(days=first.weekday()) + timedelta(weeks=period * self.interval)
+            days = self.byday or (first.weekday(),)
+            starts = [datetime.combine(week + timedelta(days=day), first.time()) for day in days]
+            return [start for start in starts if start >= first]
+        year, month = _add_months(first, period * self.interval)
+        try:
+            return [first.replace(year=year, month=month)]
+        except ValueError:
+            # В месяце нет такого числа (31-е, 29 февраля) - повторение пропускается
+            return []
+
+    def _period_of(self, first, moment):
+        """Номер периода, в котором находится moment (местное время без зоны)"""
+        if self.freq == 'DAILY':
+            elapsed = (moment.date() - first.date()).days
+        elif self.freq == 'WEEKLY':
+            elapsed = ((moment.date() - timedelta(days=moment.weekday()))
+                       - (first.date() - timedelta(days=first.weekday()))).days // 7
+        else:
+            elapsed = (moment.year - first.year) * 12 + moment.month - first.month
+        return max(0, elapsed // self.interval)
+
+    def _count_before(self, first, period):
+        """Число повторений в периодах до period"""
+        if not period:
+            return 0
+        if self.freq == 'DAILY':
+            return period
+        if self.freq == 'WEEKLY':
+            return len(self._period_starts(first, 0)) + (period - 1) * len(self.byday or (first.weekday(),))
+        return sum(len(self._period_starts(first, index)) for index in range(period))
+
+    def occurrences(self, dtstart, duration, start=None, end=None):
+        """
+        Начала повторений серии с первым повторением dtstart и длительностью
+        duration, пересекающихся с окном [start, end). Без end - до конца серии.
+        """
+        first = timezone.make_naive(dtstart)
+        period = self._period_of(first, timezone.make_naive(start - duration)) if start else 0
+        number = self._count_before(first, period)
+        while True:
+            for local_start in self._period_starts(first, period):
+                if self.count and number >= self.count:
+                    return
+                number += 1
+                occurrence = timezone.make_aware(local_start)
+                if self.until and occurrence > self.until or end and occurrence >= end:
+                    return
+                if not start or occurrence + duration > start:
+                    yield occurrence
+            period += 1
+
+    def last_occurrence(self, dtstart):
+        """Начало последнего повторения или None для бесконечной серии"""
+        if not self.count and not self.until:
+            return None
+        last = None
+        for last in self.occurrences(dtstart, timedelta(0)):
+            pass
+        return last
+
+def validate_recurrence_rule(value):
+    if not value:
+        return
+    try:
+        RecurrenceRule.parse(value)
+    except RecurrenceError as error:
+        raise ValidationError(str(error))
@@ -0,0 +1,315 @@
+"""
+Поиск дел, клиентов, задач и документов по индексу токенов.
+
+Каждый объект раскладывается на слова в нижнем регистре (SearchEntry)
+с весом поля. Поиск - префиксное совпадение каждого слова запроса по индексу
+(kind, token), поэтому работает одинаково на MySQL и SQLite без сканирования
+исходных таблиц. Индекс обновляется сигналами при сохранении, а после
+массовых вставок - командой rebuild_search_index.
+
+search_cases и search_clients (списки, выгрузки, фасеты) возвращают все
+совпадения - фильтр подзапросом по индексу без ограничения числа.
+
+global_search - подсказки при вводе (typeahead): несколько лучших объектов
+каждого типа, с кэшем по пользователю и запросу на GLOBAL_SEARCH_CACHE_TTL.
+"""
+import hashlib
+import re
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, models, transaction
+from django.db.models import Q, F, Max, OuterRef, Subquery, Value, When
+from django.urls import reverse
+from django.utils.http import urlencode
+from .models import Case, Client, Task, Document, SearchEntry
+
+# Веса полей: точное совпадение токена удваивает вес
+CASE_WEIGHTS = {'case_number': 10, 'title': 5, 'inn': 4, 'company_name': 3, 'client_name': 3}
+CLIENT_WEIGHTS = {'company_name': 10, 'inn': 10, 'client_name': 6}
+TASK_WEIGHTS = {'title': 5}
+DOCUMENT_WEIGHTS = {'title': 5}
+
+MAX_QUERY_TERMS = 5
+# Ранжирование лучших совпадений (ranked_ids): сколько вернуть
+SEARCH_RESULT_LIMIT = 200
+# Сколько совпадений считать при выборе самого избирательного слова запроса
+SELECTIVITY_SAMPLE = 1000
+# Сколько объектов-кандидатов ранжировать
+CANDIDATE_LIMIT = 2000
+TOKEN_LENGTH = 64
+
+# Подсказки: объектов каждого типа в ответе, кандидатов на тип, минимальная длина запроса
+TYPEAHEAD_LIMIT = 5
+TYPEAHEAD_CANDIDATES = 200
+TYPEAHEAD_MIN_LENGTH = 2
+
+def tokenize(text):
+    return [token[:TOKEN_LENGTH] for token in re.findall(r'\w+', (text or '').lower())]
+
+def _add(tokens, text, weight):
+    for token in tokenize(text):
+        tokens[token] = max(tokens.get(token, 0), weight)
+
+def case_tokens(case):
+    """Токены дела: части номера, название, данные клиента"""
+    tokens = {}
+    _add(tokens, case.case_number, CASE_WEIGHTS['case_number'])
+    _add(tokens, case.title, CASE_WEIGHTS['title'])
+    _add(tokens, case.client.inn, CASE_WEIGHTS['inn'])
+    _add(tokens, case.client.company_name, CASE_WEIGHTS['company_name'])
+    _add(tokens, case.client.user.first_name, CASE_WEIGHTS['client_name'])
+    _add(tokens, case.client.user.last_name, CASE_WEIGHTS['client_name'])
+    return tokens
+
+def client_tokens(client):
+    tokens = {}
+    _add(tokens, client.company_name, CLIENT_WEIGHTS['company_name'])
+    _add(tokens, client.inn, CLIENT_WEIGHTS['inn'])
+    _add(tokens, client.user.first_name, CLIENT_WEIGHTS['client_name'])
+    _add(tokens, client.user.last_name, CLIENT_WEIGHTS['client_name'])
+    return tokens
+
+def task_tokens(task):
+    tokens = {}
+    _add(tokens, task.title, TASK_WEIGHTS['title'])
+    return tokens
+
+def document_tokens(document):
+    tokens = {}
+    _add(tokens, document.title, DOCUMENT_WEIGHTS['title'])
+    return tokens
+
+INDEXERS = {
+    'case': (lambda queryset: queryset.select_related('client__user'), case_tokens),
+    'client': (lambda queryset: queryset.select_related('user'), client_tokens),
+    'task': (lambda queryset: queryset.only('title'), task_tokens),
+    'document': (lambda queryset: queryset.only('title'), document_tokens),
+}
+
+def index_objects(kind, queryset, batch_size=2000):
+    """Переиндексация объектов queryset порциями по первичному ключу"""
+    prepare, tokens_of = INDEXERS[kind]
+    queryset = prepare(queryset).order_by('pk')
+    indexed = 0
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return indexed
+        with transaction.atomic():
+            SearchEntry.objects.filter(kind=kind, object_id__in=[obj.pk for obj in batch]).delete()
+            SearchEntry.objects.bulk_create([
+                SearchEntry(kind=kind, object_id=obj.pk, token=token, weight=weight)
+                for obj in batch
+                for token, weight in tokens_of(obj).items()
+            ], batch_size=batch_size)
+        indexed += len(batch)
+        last_pk = batch[-1].pk
+
+def index_cases(queryset, batch_size=2000):
+    return index_objects('case', queryset, batch_size)
+
+def index_clients(queryset, batch_size=2000):
+    """Клиенты и их дела (в токены дела входят данные клиента)"""
+    indexed = index_objects('client', queryset, batch_size)
+    index_cases(Case.objects.filter(client__in=queryset.values('pk')), batch_size)
+    return indexed
+
+def remove_from_index(kind, object_id):
+    SearchEntry.objects.filter(kind=kind, object_id=object_id).delete()
+
+def rebuild_search_index(batch_size=2000):
+    SearchEntry.objects.all().delete()
+    return {
+        'client': index_objects('client', Client.objects.all(), batch_size),
+        'case': index_objects('case', Case.objects.all(), batch_size),
+        'task': index_objects('task', Task.objects.all(), batch_size),
+        'document': index_objects('document', Document.objects.all(), batch_size),
+    }
+
+def _prefix(term):
+    """
+    Условие «токен начинается с term», использующее индекс (kind, token).
+    В MySQL это LIKE 'term%' (без BINARY). В SQLite LIKE не учитывает регистр
+    и индекс не использует, поэтому префикс задается диапазоном
+    [term, term со следующим последним символом) - при бинарном порядке строк
+    это то же самое.
+    """
+    if connection.vendor == 'mysql':
+        return Q(token__istartswith=term)
+    return Q(token__gte=term, token__lt=term[:-1] + chr(ord(term[-1]) + 1))
+
+def _driving_term(kind, terms):
+    """Слово с наименьшим числом совпадений (подсчет ограничен SELECTIVITY_SAMPLE)"""
+    if len(terms) == 1:
+        return terms[0]
+    return min(terms, key=lambda term: SearchEntry.objects.filter(
+        _prefix(term), kind=kind
+    ).values('pk')[:SELECTIVITY_SAMPLE].count())
+
+def ranked_ids(kind, query, queryset=None, limit=SEARCH_RESULT_LIMIT, candidate_limit=CANDIDATE_LIMIT,
+               driving_term=None):
+    """
+    [(object_id, rank)] по убыванию релевантности. Должно совпасть каждое слово
+    запроса (префикс токена); ранг - сумма лучших весов по словам.
+    
+    Кандидаты - не более candidate_limit объектов, совпавших по самому редкому
+    слову, в порядке индекса (точное совпадение токена идет первым). Так время
+    ответа ограничено и для очень частых слов вроде «ооо». driving_term задает
+    это слово без подсчета совпадений.
+    """
+    terms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return []
+    
+    candidates = SearchEntry.objects.filter(_prefix(driving_term or _driving_term(kind, terms)), kind=kind)
+    if queryset is not None:
+        candidates = candidates.filter(object_id__in=queryset.order_by().values('pk'))
+    # Отдельным запросом: MySQL не поддерживает LIMIT в подзапросе IN
+    candidate_ids = list(dict.fromkeys(
+        candidates.order_by('token').values_list('object_id', flat=True)[:candidate_limit]
+    ))
+    if not candidate_ids:
+        return []
+    
+    # Все токены кандидатов по индексу (kind, object_id); совпадение слов
+    # проверяется в агрегатах _scored
+    entries = SearchEntry.objects.filter(kind=kind, object_id__in=candidate_ids)
+    return list(
+        _scored(entries, terms).order_by('-rank', '-object_id').values_list('object_id', 'rank')[:limit]
+    )
+
+def _scored(entries, terms):
+    """
+    Строки индекса entries, сгруппированные по объекту: только объекты, у которых
+    совпало каждое слово, с рангом rank - суммой лучших весов по словам
+    """
+    term_scores = {
+        f'term_{index}': Max(models.Case(
+            When(token=term, then=F('weight') * 2),
+            When(_prefix(term), then=F('weight')),
+            default=Value(0),
+            output_field=models.IntegerField(),
+        ))
+        for index, term in enumerate(terms)
+    }
+    rank = sum((F(name) for name in term_scores), Value(0))
+    return entries.order_by().values('object_id').annotate(**term_scores).filter(
+        **{f'{name}__gt': 0 for name in term_scores}
+    ).annotate(rank=rank)
+
+def _matched(kind, query):
+    terms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    matching = Q(pk__in=[])
+    for term in terms:
+        matching |= _prefix(term)
+    return _scored(SearchEntry.objects.filter(matching, kind=kind), terms)
+
+def matching_ids(kind, query):
+    """
+    Подзапрос object_id всех объектов, совпавших по каждому слову запроса, -
+    для фильтра pk__in без ограничения числа результатов (по индексу (kind, token))
+    """
+    return _matched(kind, query).values('object_id')
+
+def filter_by_search(kind, query, queryset):
+    """
+    Все объекты queryset, совпавшие по запросу, с рангом search_rank
+    (коррелированный подзапрос по индексу (kind, object_id)).
+    Порядок не задается: его выбирает вызывающий код.
+    """
+    matched = _matched(kind, query)
+    return queryset.filter(pk__in=matched.values('object_id')).annotate(
+        search_rank=Subquery(matched.filter(object_id=OuterRef('pk')).values('rank')[:1])
+    )
+
+def search_cases(query, queryset=None):
+    """
+    Все дела из queryset, найденные по запросу, в порядке релевантности
+    (атрибут search_rank), при равном ранге - сначала новые
+    """
+    queryset = Case.objects.all() if queryset is None else queryset
+    return filter_by_search('case', query, queryset).order_by('-search_rank', '-created_at', '-id')
+
+def search_clients(query, queryset=None):
+    queryset = Client.objects.all() if queryset is None else queryset
+    return filter_by_search('client', query, queryset).order_by('-search_rank', '-created_at', '-id')
+
+def _typeahead_querysets(user):
+    """Объекты, доступные пользователю в подсказках; None - все объекты типа"""
+    if user.role == 'client':
+        return {
+            'case': Case.objects.filter(client__user=user),
+            'document': Document.objects.filter(case__client__user=user),
+        }
+    return {'case': None, 'client': None, 'task': None, 'document': None}
+
+# Загрузка найденных объектов и краткое представление для подсказки
+TYPEAHEAD_ITEMS = {
+    'case': (
+        lambda ids: Case.objects.select_related('client').in_bulk(ids),
+        lambda case: {
+            'id': case.pk,
+            'title': f'{case.case_number} {case.title}',
+            'subtitle': case.client.company_name,
+            'url': reverse('case_detail', kwargs={'pk': case.pk}),
+        },
+    ),
+    'client': (
+        lambda ids: Client.objects.select_related('user').in_bulk(ids),
+        lambda client: {
+            'id': client.pk,
+            'title': client.company_name or client.user.get_full_name(),
+            'subtitle': client.inn,
+            'url': f"{reverse('case_list')}?{urlencode({'search': client.company_name or client.user.last_name})}",
+        },
+    ),
+    'task': (
+        lambda ids: Task.objects.select_related('case').in_bulk(ids),
+        lambda task: {
+            'id': task.pk,
+            'title': task.title,
+            'subtitle': task.get_status_display(),
+            'url': reverse('case_detail', kwargs={'pk': task.case_id}) if task.case_id else None,
+        },
+    ),
+    'document': (
+        lambda ids: Document.objects.select_related('case').in_bulk(ids),
+        lambda document: {
+            'id': document.pk,
+            'title': document.title,
+            'subtitle': document.case.case_number,
+            'url': reverse('case_detail', kwargs={'pk': document.case_id}),
+        },
+    ),
+}
+
+def typeahead_query(query):
+    """Запрос в нормальной форме: регистр и разделители не меняют ключ кэша"""
+    return ' '.join(list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS])
+
+def global_search(user, query, limit=TYPEAHEAD_LIMIT):
+    """
+    {тип: [{'id', 'title', 'subtitle', 'url'}]} - до limit лучших объектов каждого
+    типа. Ранжируются первые TYPEAHEAD_CANDIDATES кандидатов (точные совпадения
+    токена идут первыми), а не все совпадения, и кандидаты выбираются по самому
+    длинному слову без подсчета избирательности: подсказке нужна скорость.
+    """
+    query = typeahead_query(query)
+    if len(query) < TYPEAHEAD_MIN_LENGTH:
+        return {}
+    
+    key = f'global_search:{user.pk}:' + hashlib.md5(f'{query}|{limit}'.encode()).hexdigest()
+    results = cache.get(key)
+    if results is not None:
+        return results
+    
+    results = {}
+    driving_term = max(query.split(), key=len)
+    for kind, queryset in _typeahead_querysets(user).items():
+        ranked = ranked_ids(kind, query, queryset, limit, TYPEAHEAD_CANDIDATES, driving_term)
+        load, serialize = TYPEAHEAD_ITEMS[kind]
+        objects = load([object_id for object_id, _ in ranked]) if ranked else {}
+        results[kind] = [serialize(objects[object_id]) for object_id, _ in ranked if object_id in objects]
+    cache.set(key, results, settings.GLOBAL_SEARCH_CACHE_TTL)
+    return results
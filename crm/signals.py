@@ -0,0 +1,152 @@
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from .models import Payment, TimeEntry, Task, Document, Communication, CalendarEvent, CalendarEventOverride, Case, Client, CustomUser
+from .analytics_cache import invalidate_analytics_cache
+from .utils import mark_analytics_stale
+from .case_summary import refresh_case_summaries
+from .calendar_feed import bump_calendar_versions
+from .calendar_sync import record_calendar_changes
+from . import search
+
+# Поле, по дню которого строка попадает в дневной срез аналитики
+ANALYTICS_DATE_FIELDS = {
+    Payment: 'payment_date',
+    TimeEntry: 'start_time',
+    Case: 'created_at',
+    Client: 'created_at',
+}
+
+@receiver([post_save, post_delete], sender=Payment)
+@receiver([post_save, post_delete], sender=TimeEntry)
+@receiver([post_save, post_delete], sender=Case)
+@receiver([post_save, post_delete], sender=Client)
+def invalidate_analytics(sender, instance, **kwargs):
+    """
+    Данные аналитики изменились: срезы прежнего и нового дня строки устарели
+    сразу (в той же транзакции), кэш - после ее фиксации
+    """
+    field = ANALYTICS_DATE_FIELDS[sender]
+    mark_analytics_stale([instance.__dict__.get(field), getattr(instance, '_analytics_day', None)])
+    instance._analytics_day = instance.__dict__.get(field)
+    transaction.on_commit(invalidate_analytics_cache)
+
+@receiver(post_init, sender=Payment)
+@receiver(post_init, sender=TimeEntry)
+@receiver(post_init, sender=Case)
+@receiver(post_init, sender=Client)
+def remember_analytics_day(sender, instance, **kwargs):
+    """День среза на момент загрузки: при переносе строки на другой день устаревают оба"""
+    instance._analytics_day = instance.__dict__.get(ANALYTICS_DATE_FIELDS[sender])
+
+@receiver(post_save, sender=Case)
+def index_case(sender, instance, **kwargs):
+    search.index_cases(Case.objects.filter(pk=instance.pk))
+
+@receiver(post_save, sender=Client)
+def index_client(sender, instance, **kwargs):
+    search.index_clients(Client.objects.filter(pk=instance.pk))
+
+@receiver(post_save, sender=CustomUser)
+def index_client_user(sender, instance, update_fields=None, **kwargs):
+    """Имя пользователя входит в токены его клиента и дел (вход в систему обновляет только last_login)"""
+    if update_fields and not {'first_name', 'last_name'} & set(update_fields):
+        return
+    if instance.role == 'client':
+        search.index_clients(Client.objects.filter(user=instance))
+
+@receiver(post_save, sender=Task)
+@receiver(post_save, sender=Document)
+def index_title(sender, instance, update_fields=None, **kwargs):
+    """Задачи и документы индексируются по названию (смена статуса его не меняет)"""
+    if update_fields and 'title' not in update_fields:
+        return
+    search.index_objects(sender._meta.model_name, sender.objects.filter(pk=instance.pk))
+
+@receiver(post_delete, sender=Case)
+def unindex_case(sender, instance, **kwargs):
+    search.remove_from_index('case', instance.pk)
+
+@receiver(post_delete, sender=Client)
+def unindex_client(sender, instance, **kwargs):
+    search.remove_from_index('client', instance.pk)
+
+@receiver(post_delete, sender=Task)
+@receiver(post_delete, sender=Document)
+def unindex_title(sender, instance, **kwargs):
+    search.remove_from_index(sender._meta.model_name, instance.pk)
+
+@receiver(post_init, sender=Payment)
+@receiver(post_init, sender=TimeEntry)
+@receiver(post_init, sender=Task)
+@receiver(post_init, sender=Document)
+def remember_summary_case(sender, instance, **kwargs):
+    """Дело на момент загрузки: при переносе строки пересчитываются оба дела"""
+    # Через __dict__, чтобы отложенное поле не вызывало запрос
+    instance._summary_case_id = instance.__dict__.get('case_id')
+
+@receiver([post_save, post_delete], sender=Payment)
+@receiver([post_save, post_delete], sender=TimeEntry)
+@receiver([post_save, post_delete], sender=Task)
+@receiver([post_save, post_delete], sender=Document)
+def refresh_case_summary(sender, instance, **kwargs):
+    case_ids = {instance.case_id, getattr(instance, '_summary_case_id', None)} - {None}
+    if case_ids:
+        refresh_case_summaries(Case.objects.filter(pk__in=case_ids), sources=[sender])
+    instance._summary_case_id = instance.case_id
+
+@receiver([post_save, post_delete], sender=Communication)
+def touch_case(sender, instance, **kwargs):
+    """Коммуникации входят в отчет по делу, но не в сводку - только отметка изменения дела"""
+    Case.objects.filter(pk=instance.case_id).update(updated_at=timezone.now())
+
+@receiver(post_save, sender=CalendarEvent)
+@receiver(pre_delete, sender=CalendarEvent)
+def bump_event_calendars(sender, instance, created=False, **kwargs):
+    """
+    Изменилось событие - новая версия календаря у автора и участников и
+    запись в журнал синхронизации (при удалении - tombstone)
+    """
+    participants = [] if created else list(instance.participants.values_list('pk', flat=True))
+    users = [instance.created_by_id, *participants]
+    bump_calendar_versions(users)
+    record_calendar_changes([instance.pk], users, deleted=kwargs.get('signal') is pre_delete)
+
+@receiver(m2m_changed, sender=CalendarEvent.participants.through)
+def bump_participant_calendars(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Участники добавлены или удалены - у них меняется календарь; исключенным
+    из участников (кроме автора) событие приходит в синхронизации удалением
+    """
+    if action not in ['pre_clear', 'post_add', 'post_remove']:
+        return
+    if reverse:
+        # user.calendar_events.add/remove/clear
+        event_ids = pk_set if action != 'pre_clear' else set(instance.calendar_events.values_list('pk', flat=True))
+        bump_calendar_versions([instance.pk])
+        if action == 'post_add':
+            record_calendar_changes(event_ids, [instance.pk])
+        else:
+            record_calendar_changes(
+                CalendarEvent.objects.filter(pk__in=event_ids).exclude(created_by=instance).values_list('pk', flat=True),
+                [instance.pk], deleted=True
+            )
+        return
+    
+    user_ids = set(pk_set or []) if action != 'pre_clear' else set(instance.participants.values_list('pk', flat=True))
+    bump_calendar_versions([instance.created_by_id, *user_ids])
+    if action == 'post_add':
+        record_calendar_changes([instance.pk], user_ids)
+    else:
+        record_calendar_changes([instance.pk], user_ids - {instance.created_by_id}, deleted=True)
+
+@receiver([post_save, post_delete], sender=CalendarEventOverride)
+def bump_override_calendars(sender, instance, **kwargs):
+    """Изменено или отменено повторение серии"""
+    if isinstance(kwargs.get('origin'), CalendarEvent):
+        # Каскад удаления серии - ее удаление уже записано
+        return
+    event = CalendarEvent.objects.filter(pk=instance.event_id).first()
+    if event:
+        bump_event_calendars(CalendarEvent, event)
@@ -0,0 +1,164 @@
+"""
+Массовые операции с задачами: смена статуса, переназначение, сдвиг срока и
+смена приоритета по списку id или фильтру.
+
+Все в одной транзакции: выборка затронутых строк с блокировкой
+(select_for_update), один UPDATE по множеству id, пересчет сводки дел при
+смене статуса, при остальных операциях - отметка изменения дел (UPDATE не
+вызывает сигналы, а по updated_at кэшируется отчет по делу) и уведомления
+одним bulk_create - по одному на получателя с числом задач, а не на каждую задачу.
+"""
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import Case, Task, CustomUser, Notification
+from .case_summary import refresh_case_summaries
+
+MAX_BULK_TASKS = 1000
+BULK_TASK_OPERATIONS = ('status', 'assign', 'shift_due', 'priority')
+# Фильтры выборки задач: ключ -> поле
+BULK_TASK_FILTERS = {
+    'status': 'status',
+    'priority': 'priority',
+    'assigned_to': 'assigned_to_id',
+    'case': 'case_id',
+}
+
+class BulkTaskError(ValueError):
+    pass
+
+def _accessible_tasks(user):
+    tasks = Task.objects.all()
+    if user.role not in ['admin', 'manager']:
+        tasks = tasks.filter(Q(assigned_to=user) | Q(assigned_by=user))
+    return tasks
+
+def _changes(operation, value, now):
+    """(поля UPDATE, проверка «задача уже в нужном состоянии» по строке выборки)"""
+    if operation == 'status':
+        if value not in dict(Task.STATUS_CHOICES):
+            raise BulkTaskError('Неизвестный статус')
+        # Уже выполненные задачи не меняются, поэтому completed_at не перезаписывается
+        changes = {'status': value, 'completed_at': now} if value == 'done' else {'status': value}
+        return changes, lambda row: row['status'] == value
+    if operation == 'priority':
+        if value not in dict(Task.PRIORITY_CHOICES):
+            raise BulkTaskError('Неизвестный приоритет')
+        return {'priority': value}, lambda row: row['priority'] == value
+    if operation == 'assign':
+        assignee = CustomUser.objects.filter(
+            pk=value, is_active=True
+        ).exclude(role='client').first() if str(value).isdigit() else None
+        if assignee is None:
+            raise BulkTaskError('Исполнитель не найден')
+        return {'assigned_to': assignee}, lambda row: row['assigned_to_id'] == assignee.pk
+    if operation == 'shift_due':
+        try:
+            days = int(value)
+        except (TypeError, ValueError):
+            raise BulkTaskError('Сдвиг срока задается целым числом дней')
+        return {'due_date': F('due_date') + timedelta(days=days)}, lambda row: not days
+    raise BulkTaskError('Неизвестная операция')
+
+def _filter_lookup(filters):
+    """Условия выборки по фильтру {ключ: значение} с проверкой ключей и значений"""
+    if not isinstance(filters, dict):
+        raise BulkTaskError('Фильтр задается объектом {ключ: значение}')
+    unknown = set(filters) - set(BULK_TASK_FILTERS)
+    if unknown:
+        raise BulkTaskError(f'Неизвестные фильтры: {", ".join(sorted(unknown))}')
+    
+    lookup = {}
+    for key, value in filters.items():
+        field = BULK_TASK_FILTERS[key]
+        choices = Task._meta.get_field(field).choices
+        if choices:
+            if value not in dict(choices):
+                raise BulkTaskError(f'Некорректное значение фильтра {key}')
+        else:
+            # Фильтры по связям - id числом
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise BulkTaskError(f'Фильтр {key} задается числом')
+        lookup[field] = value
+    return lookup
+
+def _notifications(operation, value, rows, user):
+    """Уведомления по получателям: исполнителям, а о выполнении - постановщикам"""
+    recipients = {}
+    for row in rows:
+        if operation == 'status' and value == 'done':
+            recipient = row['assigned_by_id']
+        elif operation == 'assign':
+            recipient = int(value)
+        else:
+            recipient = row['assigned_to_id']
+        if recipient and recipient != user.pk:
+            recipients.setdefault(recipient, []).append(row['pk'])
+
+    titles = {
+        'status': f'Статус задач изменен: {dict(Task.STATUS_CHOICES).get(value)}',
+        'assign': 'Вам назначены задачи',
+        'shift_due': 'Сроки задач перенесены',
+        'priority': f'Приоритет задач изменен: {dict(Task.PRIORITY_CHOICES).get(value)}',
+    }
+    return [
+        Notification(
+            user_id=recipient,
+            title=titles[operation],
+            message=f'Задач: {len(task_ids)} (изменил {user.get_full_name() or user.username})',
+            notification_type='task',
+            related_object_id=task_ids[0] if len(task_ids) == 1 else None,
+            related_object_type='task' if len(task_ids) == 1 else None,
+        )
+        for recipient, task_ids in recipients.items()
+    ]
+
+def bulk_update_tasks(user, operation, value, ids=None, filters=None):
+    """
+    Операция operation со значением value над задачами по списку ids или
+    фильтру filters (см. BULK_TASK_FILTERS). Возвращает {id: результат}:
+    updated, unchanged (уже в нужном состоянии) или not_found (нет или нет доступа).
+    """
+    if operation not in BULK_TASK_OPERATIONS:
+        raise BulkTaskError('Неизвестная операция')
+    tasks = _accessible_tasks(user)
+    if ids is not None:
+        try:
+            ids = list(dict.fromkeys(int(task_id) for task_id in ids))
+        except (TypeError, ValueError):
+            raise BulkTaskError('id задач должны быть числами')
+        tasks = tasks.filter(pk__in=ids)
+    elif filters:
+        tasks = tasks.filter(**_filter_lookup(filters))
+    else:
+        raise BulkTaskError('Нужен список ids или фильтр')
+    if ids is not None and len(ids) > MAX_BULK_TASKS:
+        raise BulkTaskError(f'Не более {MAX_BULK_TASKS} задач за раз')
+    
+    changes, unchanged = _changes(operation, value, timezone.now())
+    with transaction.atomic():
+        rows = list(
+            tasks.select_for_update().order_by('pk')
+            .values('pk', 'status', 'priority', 'assigned_to_id', 'assigned_by_id', 'case_id')[:MAX_BULK_TASKS + 1]
+        )
+        if len(rows) > MAX_BULK_TASKS:
+            raise BulkTaskError(f'Выборке соответствует больше {MAX_BULK_TASKS} задач')
+        changed = [row for row in rows if not unchanged(row)]
+
+        if changed:
+            Task.objects.filter(pk__in=[row['pk'] for row in changed]).update(**changes)
+            cases = Case.objects.filter(pk__in={row['case_id'] for row in changed} - {None})
+            if operation == 'status':
+                refresh_case_summaries(cases, sources=[Task])
+            else:
+                # Исполнитель, срок и приоритет входят в отчет по делу: его кэш - по updated_at
+                cases.update(updated_at=timezone.now())
+            Notification.objects.bulk_create(_notifications(operation, value, changed, user))
+
+    results = {task_id: 'not_found' for task_id in ids or []}
+    results.update({row['pk']: 'unchanged' for row in rows})
+    results.update({row['pk']: 'updated' for row in changed})
+    return results
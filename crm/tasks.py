@@ -0,0 +1,72 @@
+from celery import shared_task
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from datetime import timedelta
+from io import BytesIO
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from .models import Notification
+from . import utils, case_export, calendar_sync
+
+@shared_task
+def send_task_reminders():
+    """Ежедневные напоминания о задачах"""
+    return utils.send_task_reminders()
+
+@shared_task
+def send_event_reminders():
+    """Ежедневные напоминания о событиях календаря"""
+    return utils.send_event_reminders()
+
+@shared_task
+def generate_daily_analytics(day=None):
+    """
+    Дневные срезы аналитики за вчера и предыдущие ANALYTICS_REFRESH_DAYS дней,
+    пересчет устаревших дней (см. crm.signals) и содержащих их сверток
+    """
+    day = parse_date(day) if day else timezone.localdate() - timedelta(days=1)
+    days = utils.refresh_analytics(day)
+    return f"Аналитика по {day.strftime('%d.%m.%Y')} сохранена, пересчитано дней: {days}"
+
+@shared_task
+def backfill_analytics(date_from, date_to, chunk_days=31):
+    """Заполнение истории аналитики порциями по chunk_days дней"""
+    days = utils.backfill_analytics(parse_date(date_from), parse_date(date_to), chunk_days)
+    return f"Построено {days} дневных срезов"
+
+@shared_task
+def generate_payroll(period_start, period_end):
+    """Ведомость бонусов всех юристов за период (даты YYYY-MM-DD включительно) в XLSX"""
+    start, end = utils.payroll_bounds(parse_date(period_start), parse_date(period_end))
+    
+    output = BytesIO()
+    utils.write_payroll_xlsx(utils.calculate_payroll(start, end), output)
+    
+    file_name = utils.payroll_file_name(start, end)
+    if default_storage.exists(file_name):
+        default_storage.delete(file_name)
+    return default_storage.save(file_name, ContentFile(output.getvalue()))
+
+@shared_task
+def export_case_report(case_id, report_format):
+    """Отчет по делу в PDF или XLSX; готовый файл текущей версии дела не перестраивается"""
+    return case_export.build_case_report(case_id, report_format)
+
+@shared_task
+def cleanup_old_notifications():
+    """Удаление прочитанных уведомлений старше 90 дней"""
+    deleted, _ = Notification.objects.filter(
+        is_read=True,
+        created_at__lt=timezone.now() - timedelta(days=90)
+    ).delete()
+    return f"Удалено {deleted} уведомлений"
+
+@shared_task
+def sync_calendar_with_external(user_id, service):
+    """Отправка изменений календаря пользователя во внешний сервис"""
+    return utils.sync_calendar_with_external(user_id, service)
+
+@shared_task
+def prune_calendar_tombstones():
+    """Удаление записей об удаленных событиях старше срока жизни токена синхронизации"""
+    return f"Удалено {calendar_sync.prune_calendar_tombstones()} записей"
@@ -1,3 +1,1618 @@
-from django.test import TestCase
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from io import BytesIO, StringIO
 
-# Create your tests here.
+from django.db.models import Sum
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.exceptions import ValidationError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from .models import *
+from .benchmarks import run_benchmarks, compare_with_baseline
+from .profiling import QueryBudgetTestMixin, profile_queries, record_profile
+from .search import search_cases, search_clients, global_search, index_cases, SEARCH_RESULT_LIMIT
+from .pagination import KeysetPaginator, encode_cursor
+from .benchmarks import _view_context
+from django.http import Http404
+from django.test.client import RequestFactory
+from .views import CaseListView, DashboardView, CaseDetailView, CaseSectionView, CalendarView
+from .explain import IndexUsageTestMixin
+from .case_summary import summary_drift, SUMMARY_FIELDS
+from .case_export import build_case_report, report_status, report_file_name
+from .exports import EXPORTS, iter_export_rows
+from .facets import case_facets
+from .task_bulk import bulk_update_tasks
+from .recurrence import RecurrenceRule, RecurrenceError
+from .free_busy import busy_intervals, free_slots, event_conflicts
+from .forms import CalendarEventForm
+from .calendar_sync import LocalCalendarClient, event_uid
+from .analytics_cache import get_cached_analytics, analytics_cache_stats
+from .utils import (
+    generate_case_report, generate_analytics, backfill_analytics, compose_analytics, collect_daily_metrics,
+    refresh_analytics,
+    total_cost, cost_by_lawyer, cost_by_case, lawyer_daily_costs, calculate_lawyer_bonus,
+    revenue_series, hours_series, calculate_payroll, payroll_bounds, write_payroll_xlsx, send_event_reminders,
+    sync_calendar_with_external,
+)
+
+
+def make_firm(lawyers_count, clients_per_lawyer=2):
+    """Небольшая фирма для тестов: юристы, клиенты, дела, платежи и часы"""
+    now = timezone.now()
+    lawyers = []
+    for i in range(lawyers_count):
+        lawyer = CustomUser.objects.create_user(
+            username=f'lawyer{i}', role='lawyer', hourly_rate=Decimal('1000.00'),
+            first_name='Юрист', last_name=str(i)
+        )
+        lawyers.append(lawyer)
+        for j in range(clients_per_lawyer):
+            client_user = CustomUser.objects.create_user(username=f'client{i}_{j}')
+            client = Client.objects.create(user=client_user, company_name=f'ООО {i}-{j}')
+            case = Case.objects.create(
+                case_number=f'{i}-{j}', title=f'Дело {i}-{j}', client=client, lawyer=lawyer,
+                case_type='civil', stage='closed' if j == 0 else 'court',
+                description='', budget=Decimal('100000.00'), start_date=date.today() - timedelta(days=10),
+                end_date=date.today() if j == 0 else None,
+            )
+            Payment.objects.create(
+                case=case, amount=Decimal('5000.00') * (i + 1), payment_type='advance',
+                payment_date=date.today() - timedelta(days=2), is_paid=True
+            )
+            TimeEntry.objects.create(
+                lawyer=lawyer, case=case, description='Работа',
+                start_time=now - timedelta(days=1), duration=Decimal('2.50')
+            )
+    return lawyers
+
+
+def make_supply_cases(client, lawyer, count):
+    """count активных дел «Договор поставки N» одного клиента (больше, чем SEARCH_RESULT_LIMIT)"""
+    Case.objects.bulk_create([
+        Case(
+            case_number=f'П-{i}', title=f'Договор поставки {i}', client=client, lawyer=lawyer,
+            case_type='arbitration', stage='court', description='', budget=Decimal('1000.00'),
+            start_date=date.today()
+        )
+        for i in range(count)
+    ])
+    index_cases(Case.objects.filter(title__startswith='Договор поставки'))
+
+
+class GenerateAnalyticsTests(TestCase):
+    def test_query_count_does_not_depend_on_firm_size(self):
+        make_firm(2)
+        with self.assertNumQueries(10):
+            generate_analytics('year')
+        for i in range(10):
+            CustomUser.objects.create_user(
+                username=f'extra{i}', role='lawyer', hourly_rate=Decimal('500.00')
+            )
+        with self.assertNumQueries(10):
+            generate_analytics('year')
+
+    def test_sections_match_expected_values(self):
+        make_firm(3)
+        analytics = generate_analytics('month')
+
+        self.assertEqual(analytics['total_revenue'], Decimal('60000.00'))
+        self.assertEqual(analytics['total_expenses'], Decimal('15000.0000'))
+        self.assertEqual(analytics['active_cases'], 6)
+        self.assertEqual(analytics['case_success_rate'], 50.0)
+        self.assertEqual(analytics['case_type_distribution']['Гражданское дело']['count'], 6)
+        self.assertEqual(analytics['stage_distribution']['Закрыто']['count'], 3)
+
+        top_lawyer = analytics['lawyer_productivity'][0]
+        self.assertEqual(top_lawyer['name'], 'Юрист 2')
+        self.assertEqual(top_lawyer['cases_count'], 2)
+        self.assertEqual(top_lawyer['revenue'], Decimal('30000.00'))
+        self.assertEqual(top_lawyer['worked_hours'], Decimal('5.00'))
+        self.assertEqual(top_lawyer['success_rate'], 50.0)
+
+        self.assertEqual(len(analytics['top_clients']), 6)
+        self.assertEqual(analytics['top_clients'][0]['revenue'], Decimal('15000.00'))
+        self.assertEqual(analytics['top_clients'][0]['cases_count'], 1)
+        self.assertEqual(sum(bucket['revenue'] for bucket in analytics['revenue_by_month']), Decimal('60000.00'))
+
+
+class AnalyticsRollupTests(TestCase):
+    def setUp(self):
+        make_firm(3)
+        self.today = timezone.localdate()
+        self.year_ago = self.today - timedelta(days=365)
+
+    def test_backfill_writes_daily_and_rolled_up_rows(self):
+        backfill_analytics(self.year_ago, self.today - timedelta(days=1), chunk_days=40)
+
+        self.assertEqual(Analytics.objects.filter(period='daily').count(), 365)
+        yesterday = Analytics.objects.get(period='daily', period_date=self.today - timedelta(days=1))
+        self.assertEqual(yesterday.total_expenses, Decimal('15000.00'))
+        monthly_revenue = Analytics.objects.filter(period='monthly').aggregate(total=Sum('total_revenue'))['total']
+        self.assertEqual(monthly_revenue, Decimal('60000.00'))
+        self.assertTrue(Analytics.objects.filter(period='weekly').exists())
+        self.assertTrue(Analytics.objects.filter(period='yearly').exists())
+
+    def test_composed_range_matches_raw_tables(self):
+        backfill_analytics(self.year_ago, self.today - timedelta(days=1))
+        raw = collect_daily_metrics(self.year_ago, self.today)
+
+        analytics = compose_analytics(date_from=self.year_ago, date_to=self.today)
+
+        self.assertEqual(analytics['total_revenue'], sum(day['total_revenue'] for day in raw.values()))
+        self.assertEqual(analytics['total_expenses'], Decimal('15000.00'))
+        self.assertEqual(analytics['active_cases'], 6)
+        self.assertEqual(analytics['new_clients'], 6)
+        self.assertEqual(analytics['case_type_distribution']['Гражданское дело']['count'], 6)
+        self.assertEqual(analytics['lawyer_productivity'][0]['revenue'], Decimal('30000.00'))
+
+    def test_changed_past_payment_reaches_composed_total(self):
+        backfill_analytics(self.year_ago, self.today - timedelta(days=1))
+        payment = Payment.objects.create(
+            case=Case.objects.first(), amount=Decimal('777.00'), payment_type='advance',
+            payment_date=self.today - timedelta(days=5), is_paid=False
+        )
+        before = compose_analytics('month')['total_revenue']
+
+        payment.is_paid = True
+        payment.save()
+
+        self.assertTrue(Analytics.objects.get(period='daily', period_date=payment.payment_date).is_stale)
+        self.assertEqual(compose_analytics('month')['total_revenue'], before + Decimal('777.00'))
+        refresh_analytics()
+        self.assertFalse(Analytics.objects.filter(is_stale=True).exists())
+        self.assertEqual(compose_analytics('month')['total_revenue'], before + Decimal('777.00'))
+        self.assertEqual(compose_analytics('month')['total_revenue'], generate_analytics('month')['total_revenue'])
+
+    def test_stale_days_outside_trailing_window_are_rebuilt(self):
+        old_day = self.today - timedelta(days=200)
+        Payment.objects.create(
+            case=Case.objects.first(), amount=Decimal('1000.00'), payment_type='advance',
+            payment_date=self.today - timedelta(days=100), is_paid=True
+        )
+        case = Case.objects.filter(is_active=True).first()
+        Case.objects.filter(pk=case.pk).update(created_at=timezone.now() - timedelta(days=50))
+        backfill_analytics(self.year_ago, self.today - timedelta(days=1))
+        payment = Payment.objects.get(amount=Decimal('1000.00'))
+        case.refresh_from_db()
+
+        # Перенос на другой день устаревает оба дня, закрытие дела - день его создания
+        payment.payment_date = old_day
+        payment.save()
+        case.is_active = False
+        case.save()
+        stale_days = set(Analytics.objects.filter(period='daily', is_stale=True).values_list('period_date', flat=True))
+        self.assertEqual(stale_days, {old_day, self.today - timedelta(days=100), timezone.localdate(case.created_at)})
+
+        refresh_analytics(trailing_days=1)
+
+        self.assertFalse(Analytics.objects.filter(is_stale=True).exists())
+        self.assertEqual(Analytics.objects.get(period='daily', period_date=old_day).total_revenue, Decimal('1000.00'))
+        analytics = compose_analytics(date_from=self.year_ago, date_to=self.today)
+        self.assertEqual(analytics['total_revenue'], Decimal('61000.00'))
+        self.assertEqual(analytics['active_cases'], 5)
+
+    def test_year_costs_the_same_as_a_day(self):
+        backfill_analytics(self.year_ago, self.today - timedelta(days=1))
+
+        # Срезы одним запросом, сегодняшний день - по запросу на таблицу, разделы по делам
+        # и топ клиентов - три запроса, имена юристов - один
+        with self.assertNumQueries(9):
+            compose_analytics(date_from=self.year_ago, date_to=self.today)
+        with self.assertNumQueries(9):
+            compose_analytics(date_from=self.today - timedelta(days=1), date_to=self.today)
+
+    def test_composed_analytics_has_the_same_sections_as_generated(self):
+        backfill_analytics(self.year_ago, self.today - timedelta(days=1))
+        composed = compose_analytics('month')
+        generated = generate_analytics('month')
+
+        self.assertEqual(set(composed), set(generated))
+        self.assertTrue(set(generated['lawyer_productivity'][0]) <= set(composed['lawyer_productivity'][0]))
+        self.assertEqual(composed['stage_distribution'], generated['stage_distribution'])
+        self.assertEqual(composed['case_success_rate'], generated['case_success_rate'])
+        self.assertEqual(composed['avg_case_duration'], generated['avg_case_duration'])
+        self.assertEqual(
+            [(row['client'], row['revenue']) for row in composed['top_clients']],
+            [(row['client'], row['revenue']) for row in generated['top_clients']]
+        )
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class AnalyticsCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.calls = 0
+
+    def compute(self, **kwargs):
+        self.calls += 1
+        return {'calls': self.calls, **kwargs}
+
+    def test_hit_after_miss(self):
+        first = get_cached_analytics('month', compute=self.compute)
+        second = get_cached_analytics('month', compute=self.compute)
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.calls, 1)
+        stats = analytics_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_keys_include_period_and_range(self):
+        get_cached_analytics('month', compute=self.compute)
+        get_cached_analytics('year', compute=self.compute)
+        get_cached_analytics('month', date_from='2026-01-01', date_to='2026-01-31', compute=self.compute)
+
+        self.assertEqual(self.calls, 3)
+
+    def test_write_to_tracked_model_invalidates(self):
+        get_cached_analytics('month', compute=self.compute)
+        with self.captureOnCommitCallbacks(execute=True):
+            make_firm(1, clients_per_lawyer=1)
+
+        data = get_cached_analytics('month', compute=self.compute)
+
+        self.assertEqual(data['calls'], 2)
+        self.assertEqual(analytics_cache_stats()['refreshes'], 1)
+
+    def test_stale_value_served_while_another_worker_refreshes(self):
+        get_cached_analytics('month', compute=self.compute)
+        with self.captureOnCommitCallbacks(execute=True):
+            make_firm(1, clients_per_lawyer=1)
+        cache.add('analytics:entry:month:::lock', 1)
+
+        data = get_cached_analytics('month', compute=self.compute)
+
+        self.assertEqual(data['calls'], 1)
+        self.assertEqual(analytics_cache_stats()['stale_hits'], 1)
+
+
+class ExpenseAggregationTests(TestCase):
+    def setUp(self):
+        self.lawyers = make_firm(3)
+        now = timezone.now()
+        rates = ['1333.33', '999.99', '0.00']
+        for lawyer, rate in zip(self.lawyers, rates):
+            lawyer.hourly_rate = Decimal(rate)
+            lawyer.save()
+            case = lawyer.cases.first()
+            for minutes in (7, 13, 59, 101):
+                TimeEntry.objects.create(
+                    lawyer=lawyer, case=case, description='Работа', start_time=now - timedelta(hours=minutes),
+                    duration=(Decimal(minutes) / 60).quantize(Decimal('0.01')), billable=minutes != 13
+                )
+
+    def python_cost(self, entries):
+        total = 0
+        for entry in entries.filter(billable=True).select_related('lawyer'):
+            if entry.lawyer.hourly_rate:
+                total += entry.duration * entry.lawyer.hourly_rate
+        return total
+
+    def test_firm_lawyer_and_case_costs_match_python_arithmetic(self):
+        entries = TimeEntry.objects.all()
+        cent = Decimal('0.01')
+
+        self.assertEqual(Decimal(total_cost(entries)).quantize(cent), self.python_cost(entries).quantize(cent))
+        for lawyer_id, cost in cost_by_lawyer(entries).items():
+            self.assertEqual(cost.quantize(cent), Decimal(self.python_cost(entries.filter(lawyer_id=lawyer_id))).quantize(cent))
+        for case_id, cost in cost_by_case(entries).items():
+            self.assertEqual(cost.quantize(cent), Decimal(self.python_cost(entries.filter(case_id=case_id))).quantize(cent))
+
+    def test_daily_rollup_is_one_query_and_matches_totals(self):
+        with self.assertNumQueries(1):
+            rows = list(lawyer_daily_costs(TimeEntry.objects.all()))
+
+        self.assertEqual(sum(row['cost'] or 0 for row in rows), total_cost(TimeEntry.objects.all()))
+        self.assertEqual(sum(row['hours'] for row in rows), TimeEntry.objects.aggregate(total=Sum('duration'))['total'])
+
+    def test_bonus_uses_daily_rollup_hours(self):
+        lawyer = self.lawyers[0]
+        now = timezone.now()
+
+        bonus = calculate_lawyer_bonus(lawyer.id, now - timedelta(days=30), now)
+
+        expected_hours = TimeEntry.objects.filter(lawyer=lawyer).aggregate(total=Sum('duration'))['total']
+        self.assertEqual(bonus['hours'], round(expected_hours, 2))
+        self.assertEqual(bonus['cost'], round(self.python_cost(TimeEntry.objects.filter(lawyer=lawyer)), 2))
+
+
+class LawyerStatisticsTests(TestCase):
+    def test_single_query_regardless_of_lawyer_count(self):
+        make_firm(3)
+        with self.assertNumQueries(1):
+            list(CustomUser.objects.lawyers().with_statistics())
+        extra_lawyers = [
+            CustomUser.objects.create_user(username=f'more{i}', role='lawyer') for i in range(20)
+        ]
+        with self.assertNumQueries(1):
+            stats = list(CustomUser.objects.lawyers().with_statistics())
+        self.assertEqual(len(stats), 3 + len(extra_lawyers))
+
+    def test_annotations_do_not_multiply_rows(self):
+        lawyer = make_firm(1)[0]
+        lawyer.hourly_rate = Decimal('3000.00')
+        lawyer.save()
+
+        stats = CustomUser.objects.lawyers().with_statistics().get(id=lawyer.id)
+
+        self.assertEqual(stats.cases_count, 2)
+        self.assertEqual(stats.closed_cases_count, 1)
+        self.assertEqual(stats.revenue, Decimal('10000.00'))
+        self.assertEqual(stats.total_hours, Decimal('5.00'))
+        self.assertAlmostEqual(float(stats.efficiency), 10000 / (5 * 3000), places=4)
+
+    def test_date_range_limits_payments_and_hours(self):
+        lawyer = make_firm(1)[0]
+        today = timezone.localdate()
+
+        stats = CustomUser.objects.lawyers().with_statistics(date_from=today, date_to=today).get(id=lawyer.id)
+
+        self.assertEqual(stats.revenue, 0)
+        self.assertEqual(stats.total_hours, 0)
+        self.assertEqual(stats.efficiency, 0)
+
+
+class ClientRankingTests(TestCase):
+    def setUp(self):
+        make_firm(4)
+        for client in Client.objects.all()[:3]:
+            Payment.objects.create(
+                case=client.cases.first(), amount=Decimal('700.00') * client.id, payment_type='final',
+                payment_date=date.today(), is_paid=False
+            )
+
+    def test_top_n_is_a_single_limited_query(self):
+        with self.assertNumQueries(1):
+            top = list(Client.objects.ranked('revenue')[:3])
+
+        revenues = [client.revenue for client in top]
+        self.assertEqual(revenues, sorted(revenues, reverse=True))
+        self.assertEqual(top[0].revenue, Decimal('20000.00'))
+
+    def test_rankings_by_cases_and_outstanding(self):
+        by_outstanding = list(Client.objects.ranked('outstanding'))
+        self.assertEqual(len(by_outstanding), 3)
+        self.assertEqual(by_outstanding[0].outstanding, Decimal('700.00') * by_outstanding[0].id)
+        self.assertEqual(Client.objects.ranked('cases').count(), 8)
+        with self.assertRaises(ValueError):
+            Client.objects.ranked('unknown')
+
+    def test_api_paginates_past_top_ten(self):
+        manager = CustomUser.objects.create_user(username='manager', password='pass', role='manager')
+        self.client.force_login(manager)
+
+        response = self.client.get('/api/clients/top/', {'by': 'revenue', 'page_size': 5, 'page': 2})
+
+        data = response.json()
+        self.assertEqual(data['count'], 8)
+        self.assertEqual(data['page'], 2)
+        self.assertEqual([row['rank'] for row in data['results']], [6, 7, 8])
+
+
+class TimeSeriesTests(TestCase):
+    def setUp(self):
+        self.lawyer = make_firm(1, clients_per_lawyer=1)[0]
+        self.case = self.lawyer.cases.first()
+        for payment_date in (date(2024, 1, 1), date(2024, 1, 7), date(2024, 1, 8), date(2025, 11, 30)):
+            Payment.objects.create(
+                case=self.case, amount=Decimal('100.00'), payment_type='installment',
+                payment_date=payment_date, is_paid=True
+            )
+
+    def test_weeks_follow_calendar_weeks(self):
+        series = revenue_series(date(2024, 1, 1), date(2024, 1, 21), 'week')
+
+        self.assertEqual([bucket['start_date'] for bucket in series], [date(2024, 1, 1), date(2024, 1, 8), date(2024, 1, 15)])
+        self.assertEqual([bucket['value'] for bucket in series], [Decimal('200.00'), Decimal('100.00'), 0])
+
+    def test_multi_year_series_is_one_query_with_gaps_filled(self):
+        with self.assertNumQueries(1):
+            series = revenue_series(date(2024, 1, 1), date(2025, 12, 31), 'month')
+
+        self.assertEqual(len(series), 24)
+        self.assertEqual(series[0]['value'], Decimal('300.00'))
+        self.assertEqual(series[1]['value'], 0)
+        self.assertEqual(series[-2]['value'], Decimal('100.00'))
+
+        quarters = revenue_series(date(2024, 1, 1), date(2025, 12, 31), 'quarter')
+        self.assertEqual(len(quarters), 8)
+        self.assertEqual(quarters[-1]['label'], '4 кв. 2025')
+
+    def test_hours_use_moscow_day_boundaries(self):
+        TimeEntry.objects.all().delete()
+        # 22:30 UTC 1 января - это уже 01:30 2 января по Москве
+        TimeEntry.objects.create(
+            lawyer=self.lawyer, case=self.case, description='Работа', duration=Decimal('1.50'),
+            start_time=datetime(2024, 1, 1, 22, 30, tzinfo=dt_timezone.utc)
+        )
+
+        series = hours_series(date(2024, 1, 1), date(2024, 1, 2), 'day')
+
+        self.assertEqual([bucket['value'] for bucket in series], [0, Decimal('1.50')])
+
+    def test_api_case_distribution_uses_moscow_day_boundaries(self):
+        # 21:30 UTC 31 декабря - уже 1 января по Москве, 21:30 UTC 2 января - уже 3 января
+        Case.objects.filter(pk=self.case.pk).update(created_at=datetime(2023, 12, 31, 21, 30, tzinfo=dt_timezone.utc))
+        late = Case.objects.create(
+            case_number='П-2', title='Позднее', client=self.case.client, lawyer=self.lawyer, case_type='criminal',
+            description='', budget=Decimal('1.00'), start_date=date(2024, 1, 2)
+        )
+        Case.objects.filter(pk=late.pk).update(created_at=datetime(2024, 1, 2, 21, 30, tzinfo=dt_timezone.utc))
+        manager = CustomUser.objects.create_user(username='manager', role='manager')
+        self.client.force_login(manager)
+
+        data = self.client.get('/api/analytics/', {'start_date': '2024-01-01', 'end_date': '2024-01-02'}).json()
+
+        self.assertEqual(data['case_distribution'], {'labels': ['Гражданское дело'], 'values': [1]})
+
+
+class PayrollTests(TestCase):
+    def setUp(self):
+        self.lawyers = make_firm(3)
+        self.lawyers[2].hourly_rate = Decimal('7000.00')
+        self.lawyers[2].save()
+        today = timezone.localdate()
+        self.period = payroll_bounds(today - timedelta(days=30), today)
+
+    def test_batch_matches_single_lawyer_bonus(self):
+        payroll = calculate_payroll(*self.period)
+
+        self.assertEqual(len(payroll), 3)
+        for row in payroll:
+            single = calculate_lawyer_bonus(row['lawyer_id'], *self.period)
+            self.assertEqual({key: row[key] for key in single}, single)
+        self.assertEqual(payroll[0]['total_bonus'], Decimal('1000.00'))
+
+    def test_fixed_number_of_queries(self):
+        with self.assertNumQueries(2):
+            calculate_payroll(*self.period)
+        extra_lawyers = [CustomUser.objects.create_user(username=f'p{i}', role='lawyer') for i in range(15)]
+        with self.assertNumQueries(2):
+            payroll = calculate_payroll(*self.period)
+        self.assertEqual(len(payroll), 3 + len(extra_lawyers))
+
+    def test_xlsx_sheet_has_a_row_per_lawyer_and_total(self):
+        from io import BytesIO
+        from openpyxl import load_workbook
+
+        output = write_payroll_xlsx(calculate_payroll(*self.period), BytesIO())
+
+        rows = list(load_workbook(output).active.values)
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[-1][0], 'Итого')
+
+
+class SyntheticFirmAndBenchmarkTests(TestCase):
+    def test_seed_creates_requested_scale(self):
+        call_command('seed_firm', tier='tiny', cases=30, time_entries=200, notifications=50, stdout=StringIO())
+
+        self.assertEqual(CustomUser.objects.filter(role='lawyer').count(), 5)
+        self.assertEqual(Client.objects.count(), 20)
+        self.assertEqual(Case.objects.count(), 30)
+        self.assertEqual(TimeEntry.objects.count(), 200)
+        self.assertEqual(Notification.objects.count(), 50)
+        self.assertGreater(Case.objects.dates('created_at', 'month').count(), 1)
+
+    def test_benchmarks_report_every_hot_path(self):
+        call_command('seed_firm', tier='tiny', stdout=StringIO())
+
+        results = run_benchmarks(repeat=1)
+
+        self.assertEqual(set(results), {
+            'dashboard', 'case_list', 'case_list_search', 'case_detail', 'case_detail_time_entries',
+            'generate_analytics_year', 'generate_case_report',
+        })
+        for metrics in results.values():
+            self.assertGreater(metrics['queries'], 0)
+            self.assertGreater(metrics['peak_kb'], 0)
+
+    def test_baseline_comparison_flags_regressions(self):
+        baseline = {'case_list': {'wall_ms': 10.0, 'queries': 3, 'peak_kb': 100.0}}
+
+        self.assertEqual(compare_with_baseline({'case_list': {'wall_ms': 12.0, 'queries': 3, 'peak_kb': 90.0}}, baseline), [])
+        regressions = compare_with_baseline({'case_list': {'wall_ms': 20.0, 'queries': 4, 'peak_kb': 90.0}}, baseline)
+        self.assertEqual(len(regressions), 2)
+
+
+class SQLProfilingTests(QueryBudgetTestMixin, TestCase):
+    def setUp(self):
+        make_firm(3)
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass', role='manager')
+        self.client.force_login(self.manager)
+
+    def test_api_views_stay_within_declared_budget(self):
+        self.assertWithinQueryBudget('/api/clients/top/', {'by': 'outstanding'})
+        self.assertWithinQueryBudget('/api/analytics/', {'granularity': 'week'})
+        self.assertWithinQueryBudget('/api/analytics/cache-stats/')
+
+    def test_budget_helper_reports_n_plus_one(self):
+        with self.assertRaisesMessage(AssertionError, 'x6'):
+            with self.assertQueryBudget(2):
+                for case in Case.objects.all():
+                    case.client.company_name
+
+    @override_settings(SQL_PROFILING=True)
+    def test_middleware_sets_headers_and_accumulates_endpoint_stats(self):
+        for _ in range(2):
+            response = self.client.get('/api/clients/top/')
+
+        self.assertEqual(response['X-DB-Query-Budget'], '6')
+        self.assertGreater(int(response['X-DB-Queries']), 0)
+        self.assertEqual(response['X-DB-N-Plus-One'], '0')
+        profile = EndpointProfile.objects.get(endpoint='api_top_clients')
+        self.assertEqual(profile.calls, 2)
+        self.assertEqual(profile.over_budget_calls, 0)
+        self.assertEqual(profile.max_queries, int(response['X-DB-Queries']))
+
+    def test_record_profile_survives_concurrent_first_call(self):
+        from django.db import connection
+
+        def concurrent_insert(execute, sql, params, many, context):
+            result = execute(sql, params, many, context)
+            # Параллельный запрос создает строку между UPDATE (0 строк) и INSERT
+            if sql.startswith('UPDATE') and 'crm_endpointprofile' in sql and not EndpointProfile.objects.exists():
+                EndpointProfile.objects.create(endpoint='api_race', calls=1, total_queries=2, max_queries=2)
+            return result
+
+        with profile_queries() as profile:
+            Case.objects.count()
+        with connection.execute_wrapper(concurrent_insert):
+            record_profile('api_race', profile, budget=5)
+
+        stats = EndpointProfile.objects.get(endpoint='api_race')
+        self.assertEqual(stats.calls, 2)
+        self.assertEqual(stats.total_queries, 3)
+
+    def test_middleware_is_off_by_default(self):
+        response = self.client.get('/api/clients/top/')
+        self.assertNotIn('X-DB-Queries', response)
+        self.assertFalse(EndpointProfile.objects.exists())
+
+    def test_analytics_without_rollups_has_no_repeated_queries(self):
+        with profile_queries() as profile:
+            compose_analytics('month')
+        self.assertEqual(profile.similar(), {})
+
+
+class SearchIndexTests(TestCase):
+    def setUp(self):
+        self.lawyer = make_firm(2)[0]
+        user = CustomUser.objects.create_user(username='romashka', first_name='Иван', last_name='Петров')
+        self.client_obj = Client.objects.create(user=user, company_name='ООО «Ромашка»', inn='7701234567')
+        self.case = Case.objects.create(
+            case_number='А40-12345/2024', title='Взыскание долга по поставке', client=self.client_obj,
+            lawyer=self.lawyer, case_type='arbitration', description='', budget=Decimal('1000.00'),
+            start_date=date.today()
+        )
+
+    def test_finds_by_case_number_prefix_company_inn_and_client_name(self):
+        for query in ('а40-123', 'А40-12345/2024', 'ромаш', '770123', 'петров', 'взыскание долг'):
+            self.assertEqual([case.pk for case in search_cases(query)], [self.case.pk], query)
+        self.assertEqual(list(search_clients('ромашка')), [self.client_obj])
+        self.assertFalse(search_cases('ромашка арбуз').exists())
+
+    def test_exact_token_outranks_prefix(self):
+        other = Case.objects.create(
+            case_number='Б-1', title='Долгая история', client=self.client_obj, lawyer=self.lawyer,
+            case_type='civil', description='', budget=Decimal('1.00'), start_date=date.today()
+        )
+        results = list(search_cases('долга'))
+        self.assertEqual(results, [self.case, other])
+        self.assertGreater(results[0].search_rank, results[1].search_rank)
+
+    def test_index_follows_saves_and_deletes(self):
+        self.client_obj.user.last_name = 'Сидоров'
+        self.client_obj.user.save()
+        self.assertTrue(search_cases('сидоров').exists())
+        self.assertFalse(search_cases('петров').exists())
+
+        self.case.delete()
+        self.assertFalse(SearchEntry.objects.filter(kind='case', object_id=self.case.pk).exists())
+
+    def test_search_respects_base_queryset_with_fixed_queries(self):
+        expected = list(Case.objects.filter(lawyer=self.lawyer, title__startswith='Дело').order_by('-id'))
+        # Совпадения и ранг - подзапросы в выборке дел
+        with self.assertNumQueries(1):
+            self.assertEqual(list(search_cases('дело', Case.objects.filter(lawyer=self.lawyer))), expected)
+
+    def test_case_list_search_is_not_capped(self):
+        make_supply_cases(self.client_obj, self.lawyer, SEARCH_RESULT_LIMIT + 50)
+        manager = CustomUser.objects.create_user(username='manager', role='manager')
+
+        self.assertEqual(search_cases('договор поставки').count(), SEARCH_RESULT_LIMIT + 50)
+        context = _view_context(CaseListView, manager, {'search': 'договор поставки', 'page': 13})
+        self.assertEqual(context['paginator'].count, SEARCH_RESULT_LIMIT + 50)
+        self.assertEqual(len(context['cases']), 10)
+        # В режиме курсора проходится весь список
+        seen, params = [], {'search': 'договор поставки', 'cursor': ''}
+        while True:
+            context = _view_context(CaseListView, manager, params)
+            seen += [case.pk for case in context['cases']]
+            if not context['next_page_url']:
+                break
+            params['cursor'] = context['page_obj'].next_cursor
+        self.assertEqual(len(set(seen)), SEARCH_RESULT_LIMIT + 50)
+
+    def test_rebuild_command_restores_index(self):
+        SearchEntry.objects.all().delete()
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(list(search_cases('ромашка')), [self.case])
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.lawyers = make_firm(3, clients_per_lawyer=4)
+        # Одинаковое время создания: порядок между ними задает id
+        Case.objects.filter(pk__in=Case.objects.order_by('pk').values('pk')[:6]).update(
+            created_at=timezone.now() - timedelta(days=3)
+        )
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass', role='manager')
+
+    def test_pages_cover_offset_order_without_gaps_or_duplicates(self):
+        expected = list(Case.objects.order_by('-created_at', '-id'))
+        paginator = KeysetPaginator(Case.objects.all(), 5)
+        collected, cursor = [], None
+        while True:
+            page = paginator.page(cursor)
+            collected.extend(page)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(collected, expected)
+
+    def test_deep_page_is_a_single_query_without_count(self):
+        last = Case.objects.order_by('-created_at', '-id')[7]
+        with self.assertNumQueries(1):
+            page = KeysetPaginator(Case.objects.all(), 3).page(encode_cursor([last.created_at, last.id]))
+        self.assertEqual(list(page), list(Case.objects.order_by('-created_at', '-id')[8:11]))
+
+    def test_case_list_cursor_mode_keeps_filters(self):
+        lawyer = self.lawyers[0]
+        context = _view_context(CaseListView, self.manager, {'cursor': '', 'lawyer': lawyer.id})
+        self.assertEqual(len(context['cases']), 4)
+        self.assertIsNone(context['next_page_url'])
+        self.assertEqual(context['paginator'].count, 4)
+
+        context = _view_context(CaseListView, self.manager, {'cursor': '', 'search': 'дело'})
+        self.assertEqual(len(context['cases']), 12)
+
+    def test_api_follows_cursor_and_caches_count(self):
+        self.client.force_login(self.manager)
+        first = self.client.get('/api/time-entries/', {'page_size': 5}).json()
+        self.assertEqual(first['count'], 12)
+        with self.assertNumQueries(3):
+            second = self.client.get('/api/time-entries/', {'page_size': 5, 'cursor': first['next_cursor']}).json()
+        ids = [entry['id'] for entry in first['results'] + second['results']]
+        self.assertEqual(len(set(ids)), 10)
+        self.assertEqual(self.client.get('/api/time-entries/', {'cursor': '!!'}).status_code, 400)
+
+
+class IndexUsageTests(IndexUsageTestMixin, TestCase):
+    HOT_TABLES = ['crm_case', 'crm_task', 'crm_calendarevent', 'crm_payment', 'crm_timeentry']
+
+    def setUp(self):
+        self.lawyer = make_firm(2)[0]
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass', role='manager')
+        case = Case.objects.first()
+        Task.objects.create(
+            title='Иск', description='', case=case, assigned_to=self.lawyer, assigned_by=self.manager,
+            due_date=timezone.now() + timedelta(days=2)
+        )
+        event = CalendarEvent.objects.create(
+            title='Заседание', event_type='court_hearing', start_time=timezone.now(),
+            end_time=timezone.now() + timedelta(hours=1), case=case, created_by=self.manager
+        )
+        event.participants.add(self.lawyer)
+        # Аналитика на дашборде берется из кэша и здесь не проверяется
+        get_cached_analytics('month')
+
+    def test_case_list_uses_indexes(self):
+        for params in ({}, {'stage': 'court'}, {'lawyer': self.lawyer.id}, {'cursor': ''}):
+            with self.assertUsesIndexes(self.HOT_TABLES):
+                _view_context(CaseListView, self.manager, params)
+
+    def test_dashboard_uses_indexes(self):
+        for user in (self.manager, self.lawyer):
+            with self.assertUsesIndexes(self.HOT_TABLES):
+                _view_context(DashboardView, user)
+
+    def test_dashboard_deadlines_use_local_day_boundaries(self):
+        Task.objects.all().delete()
+        day_start = timezone.make_aware(datetime.combine(timezone.localdate(), datetime.min.time()))
+        for title, offset in (('Вчера', timedelta(minutes=-30)), ('Сегодня', timedelta(minutes=30)),
+                              ('Через неделю', timedelta(days=7, hours=23)), ('Позже', timedelta(days=8))):
+            Task.objects.create(title=title, description='', assigned_to=self.lawyer, due_date=day_start + offset)
+
+        context = _view_context(DashboardView, self.manager)
+
+        self.assertEqual([task.title for task in context['upcoming_deadlines']], ['Сегодня', 'Через неделю'])
+
+    def test_list_apis_use_indexes(self):
+        self.client.force_login(self.lawyer)
+        with self.assertUsesIndexes(self.HOT_TABLES):
+            self.client.get('/api/tasks/', {'status': 'todo'})
+            self.client.get('/api/time-entries/')
+            self.client.get('/api/calendar/events/', {
+                'start': timezone.now() - timedelta(days=1), 'end': timezone.now() + timedelta(days=1)
+            })
+
+    def test_full_scan_is_reported(self):
+        with self.assertRaisesMessage(AssertionError, 'crm_case'):
+            with self.assertUsesIndexes(['crm_case']):
+                list(Case.objects.filter(description='нет индекса'))
+
+
+class CaseDetailTabsTests(TestCase):
+    def setUp(self):
+        self.lawyer = make_firm(1, clients_per_lawyer=1)[0]
+        self.case = Case.objects.get()
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass', role='manager')
+        TimeEntry.objects.bulk_create([
+            TimeEntry(lawyer=self.lawyer, case=self.case, description=f'Работа {i}',
+                      start_time=timezone.now() - timedelta(hours=i), duration=Decimal('1.00'))
+            for i in range(30)
+        ])
+
+    def section(self, section, **params):
+        request = RequestFactory().get('/', params)
+        request.user = self.manager
+        return CaseSectionView.as_view()(request, pk=self.case.pk, section=section).context_data
+
+    def test_detail_renders_only_header_with_section_links(self):
+        with self.assertNumQueries(1):
+            context = _view_context(CaseDetailView, self.manager, pk=self.case.pk)
+            context['case'].client.user.get_full_name()
+        self.assertEqual(
+            [section['url'] for section in context['sections']][:2],
+            [f'/crm/cases/{self.case.pk}/communications/', f'/crm/cases/{self.case.pk}/documents/']
+        )
+
+    def test_section_pages_follow_cursor_with_users_joined(self):
+        with self.assertNumQueries(2):
+            first = self.section('time_entries')
+            names = [entry.lawyer.username for entry in first['items']]
+        self.assertEqual(len(names), 25)
+        self.assertIn('cursor=', first['next_page_url'])
+
+        cursor = first['next_page_url'].split('cursor=')[1]
+        second = self.section('time_entries', cursor=cursor)
+        self.assertEqual(len(second['items']), 6)
+        self.assertIsNone(second['next_page_url'])
+        self.assertNotIn('form', second)
+
+    def test_task_form_offers_only_this_case(self):
+        form = self.section('tasks')['form']
+        self.assertEqual(list(form.fields['case'].queryset), [self.case])
+
+    def test_unknown_section_is_404(self):
+        with self.assertRaises(Http404):
+            self.section('secrets')
+
+
+class CaseSummaryTests(TestCase):
+    def setUp(self):
+        self.lawyer = make_firm(1)[0]
+        self.case, self.other = Case.objects.order_by('pk')
+
+    def test_summary_follows_changes(self):
+        self.case.refresh_from_db()
+        self.assertEqual(self.case.total_paid, Decimal('5000.00'))
+        self.assertEqual(self.case.total_hours, Decimal('2.50'))
+        self.assertEqual(self.case.actual_cost, Decimal('2500.00'))
+
+        task = Task.objects.create(
+            title='Иск', description='', case=self.case, assigned_to=self.lawyer, due_date=timezone.now()
+        )
+        Document.objects.create(case=self.case, title='Договор', category='contract', file='d.pdf', uploaded_by=self.lawyer)
+        Payment.objects.create(
+            case=self.case, amount=Decimal('700.00'), payment_type='final', payment_date=date.today(), is_paid=False
+        )
+        task.status = 'done'
+        task.save()
+
+        self.case.refresh_from_db()
+        self.assertEqual(
+            (self.case.tasks_done, self.case.tasks_pending, self.case.documents_count, self.case.total_outstanding),
+            (1, 0, 1, Decimal('700.00'))
+        )
+        self.assertEqual(summary_drift(Case.objects.all()), [])
+
+    def test_moving_and_deleting_rows_updates_both_cases(self):
+        entry = TimeEntry.objects.get(case=self.case)
+        entry.case = self.other
+        entry.save()
+        self.case.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual((self.case.total_hours, self.other.total_hours), (Decimal('0.00'), Decimal('5.00')))
+
+        Payment.objects.get(case=self.other).delete()
+        self.other.refresh_from_db()
+        self.assertEqual(self.other.total_paid, Decimal('0.00'))
+
+    def test_case_edit_keeps_summary_updated_after_loading(self):
+        case = Case.objects.get(pk=self.case.pk)
+        Payment.objects.create(
+            case=self.case, amount=Decimal('500.00'), payment_type='final', payment_date=date.today(), is_paid=True
+        )
+
+        case.stage = 'closed'
+        case.save()
+
+        case.refresh_from_db()
+        self.assertEqual(case.stage, 'closed')
+        self.assertEqual(case.total_paid, Decimal('5500.00'))
+        self.assertEqual(summary_drift(Case.objects.all()), [])
+        self.assertEqual(set(Case.SUMMARY_FIELDS), set(SUMMARY_FIELDS))
+
+    def test_repair_command_finds_and_fixes_bulk_drift(self):
+        Payment.objects.filter(case=self.case).update(amount=Decimal('1.00'))
+        with self.assertRaisesMessage(CommandError, 'дел 1'):
+            call_command('repair_case_summaries', check=True, stdout=StringIO())
+
+        call_command('repair_case_summaries', stdout=StringIO())
+        self.case.refresh_from_db()
+        self.assertEqual(self.case.total_paid, Decimal('1.00'))
+        self.assertEqual(summary_drift(Case.objects.all()), [])
+
+    def test_report_statistics_come_from_summary(self):
+        report = generate_case_report(self.case.pk)
+        self.assertEqual(report['statistics']['total_paid'], 5000.0)
+        self.assertEqual(report['statistics']['total_cost'], 2500.0)
+        self.assertEqual(report['statistics']['total_hours_spent'], 2.5)
+
+
+class CaseReportExportTests(TestCase):
+    def setUp(self):
+        import tempfile
+
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=media.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        cache.clear()
+
+        self.lawyer = make_firm(1)[0]
+        self.case = Case.objects.order_by('pk').first()
+
+    def add_entries(self, count):
+        TimeEntry.objects.bulk_create([
+            TimeEntry(lawyer=self.lawyer, case=self.case, description=f'Работа {i}',
+                      start_time=timezone.now(), duration=Decimal('1.00'))
+            for i in range(count)
+        ])
+
+    def test_xlsx_has_case_sheet_and_a_sheet_per_section(self):
+        from openpyxl import load_workbook
+        from django.core.files.storage import default_storage
+
+        file_name = build_case_report(self.case.pk, 'xlsx')
+
+        workbook = load_workbook(default_storage.open(file_name, 'rb'))
+        self.assertEqual(workbook.sheetnames, ['Дело', 'Коммуникации', 'Документы', 'Задачи', 'Платежи', 'Учет времени'])
+        self.assertEqual(list(workbook['Платежи'].values)[1][0], 5000.0)
+
+    def test_pdf_queries_do_not_grow_with_rows(self):
+        from django.core.files.storage import default_storage
+
+        with profile_queries() as profile:
+            build_case_report(self.case.pk, 'pdf')
+        self.add_entries(300)
+        Case.objects.filter(pk=self.case.pk).update(updated_at=timezone.now())
+        with self.assertNumQueries(profile.count):
+            file_name = build_case_report(self.case.pk, 'pdf')
+
+        self.assertEqual(default_storage.open(file_name, 'rb').read(4), b'%PDF')
+        self.assertEqual(len(default_storage.listdir(f'reports/case_{self.case.pk}')[1]), 1)
+
+    def test_unchanged_case_is_served_from_storage(self):
+        file_name = build_case_report(self.case.pk, 'xlsx')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(build_case_report(self.case.pk, 'xlsx'), file_name)
+
+        Payment.objects.create(
+            case=self.case, amount=Decimal('10.00'), payment_type='final', payment_date=date.today()
+        )
+        self.case.refresh_from_db()
+        self.assertEqual(report_status(self.case, 'xlsx'), 'missing')
+        self.assertNotEqual(build_case_report(self.case.pk, 'xlsx'), file_name)
+
+    def test_status_api_and_download(self):
+        self.client.force_login(self.lawyer)
+        url = f'/api/cases/{self.case.pk}/report/'
+
+        self.assertEqual(self.client.get(url, {'format': 'xlsx'}).json()['status'], 'missing')
+        self.assertEqual(self.client.get(url, {'format': 'doc'}).status_code, 400)
+
+        build_case_report(self.case.pk, 'xlsx')
+        data = self.client.post(url, {'format': 'xlsx'}).json()
+        self.assertEqual(data['status'], 'ready')
+        response = self.client.get(data['download_url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Disposition'].startswith('attachment'))
+
+    def test_client_sees_only_own_cases(self):
+        other = Case.objects.exclude(client=self.case.client).first()
+        self.client.force_login(self.case.client.user)
+
+        self.assertEqual(self.client.get(f'/api/cases/{self.case.pk}/report/').status_code, 200)
+        self.assertEqual(self.client.get(f'/api/cases/{other.pk}/report/').status_code, 404)
+
+
+class ListExportTests(TestCase):
+    def setUp(self):
+        self.lawyers = make_firm(2)
+        self.manager = CustomUser.objects.create_user(username='manager', role='manager')
+        self.client.force_login(self.manager)
+
+    def read_csv(self, response):
+        import csv
+
+        content = b''.join(response.streaming_content).decode('utf-8-sig')
+        return list(csv.reader(content.splitlines(), delimiter=';'))
+
+    def test_case_csv_uses_case_list_filters(self):
+        response = self.client.get('/api/exports/cases/', {'stage': 'court', 'lawyer': self.lawyers[1].pk})
+
+        self.assertTrue(response.streaming)
+        rows = self.read_csv(response)
+        self.assertEqual(rows[0][:3], ['Номер', 'Название', 'Клиент'])
+        self.assertEqual([row[0] for row in rows[1:]], ['1-1'])
+        self.assertEqual(rows[1][3:6], ['Юрист 1', 'Гражданское дело', 'Судебное заседание'])
+
+        rows = self.read_csv(self.client.get('/api/exports/cases/', {'search': '0-1'}))
+        found = search_cases('0-1', Case.objects.filter(is_active=True)).order_by('pk')
+        self.assertEqual([row[0] for row in rows[1:]], [case.case_number for case in found])
+        self.assertLess(len(rows) - 1, Case.objects.count())
+
+    def test_case_export_has_every_search_match(self):
+        client = Client.objects.first()
+        make_supply_cases(client, self.lawyers[0], SEARCH_RESULT_LIMIT + 50)
+
+        rows = self.read_csv(self.client.get('/api/exports/cases/', {'search': 'договор поставки'}))
+
+        self.assertEqual(len(rows) - 1, SEARCH_RESULT_LIMIT + 50)
+        self.assertEqual({row[0] for row in rows[1:]}, {f'П-{i}' for i in range(SEARCH_RESULT_LIMIT + 50)})
+        # Порции по pk тоже видят все совпадения
+        export = EXPORTS['cases']
+        rows = list(iter_export_rows(export['queryset']({'search': 'договор поставки'}), export['columns'], chunk_size=100))
+        self.assertEqual(len(rows), SEARCH_RESULT_LIMIT + 50)
+
+    def test_time_entries_for_period_in_xlsx(self):
+        from openpyxl import load_workbook
+
+        TimeEntry.objects.create(
+            lawyer=self.lawyers[0], case=Case.objects.first(), description='Старое',
+            start_time=timezone.now() - timedelta(days=200), duration=Decimal('1.00')
+        )
+        today = timezone.localdate()
+        response = self.client.get('/api/exports/time_entries/', {
+            'format': 'xlsx', 'date_from': (today - timedelta(days=90)).isoformat(), 'date_to': today.isoformat(),
+        })
+
+        rows = list(load_workbook(BytesIO(b''.join(response.streaming_content))).active.values)
+        self.assertEqual(len(rows), 1 + 4)
+        self.assertNotIn('Старое', [row[2] for row in rows])
+
+    def test_rows_are_read_in_chunks(self):
+        export = EXPORTS['payments']
+        with self.assertNumQueries(3):
+            rows = list(iter_export_rows(export['queryset']({}), export['columns'], chunk_size=2))
+        self.assertEqual(len(rows), 4)
+
+    def test_only_managers_export(self):
+        self.client.force_login(self.lawyers[0])
+        self.assertEqual(self.client.get('/api/exports/payments/').status_code, 403)
+        self.client.force_login(self.manager)
+        self.assertEqual(self.client.get('/api/exports/unknown/').status_code, 404)
+        self.assertEqual(self.client.get('/api/exports/tasks/', {'format': 'pdf'}).status_code, 400)
+
+
+class GlobalSearchTests(QueryBudgetTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.lawyer = make_firm(1)[0]
+        user = CustomUser.objects.create_user(username='romashka', first_name='Иван', last_name='Петров')
+        self.client_obj = Client.objects.create(user=user, company_name='ООО Ромашка', inn='7701234567')
+        self.case = Case.objects.create(
+            case_number='А40-1/2024', title='Ромашка против Лютика', client=self.client_obj, lawyer=self.lawyer,
+            case_type='arbitration', description='', budget=Decimal('1000.00'), start_date=date.today()
+        )
+        self.task = Task.objects.create(
+            title='Отзыв Ромашке', description='', case=self.case, assigned_to=self.lawyer, due_date=timezone.now()
+        )
+        self.document = Document.objects.create(
+            case=self.case, title='Претензия Ромашки', category='other', file='p.pdf', uploaded_by=self.lawyer
+        )
+
+    def test_groups_results_by_type(self):
+        results = global_search(self.lawyer, 'ромаш')
+
+        self.assertEqual([item['id'] for item in results['case']], [self.case.pk])
+        self.assertEqual([item['id'] for item in results['client']], [self.client_obj.pk])
+        self.assertEqual([item['id'] for item in results['task']], [self.task.pk])
+        self.assertEqual(results['document'][0]['subtitle'], 'А40-1/2024')
+        self.assertEqual(results['case'][0]['url'], f'/crm/cases/{self.case.pk}/')
+        self.assertEqual(global_search(self.lawyer, 'р'), {})
+
+    def test_client_sees_only_own_cases_and_documents(self):
+        other = Case.objects.exclude(pk=self.case.pk).first()
+        other.title = 'Ромашковое поле'
+        other.save()
+
+        results = global_search(self.client_obj.user, 'ромаш')
+
+        self.assertEqual(set(results), {'case', 'document'})
+        self.assertEqual([item['id'] for item in results['case']], [self.case.pk])
+
+    def test_results_are_cached_per_user_and_normalized_query(self):
+        first = global_search(self.lawyer, 'Ромашка ')
+        with self.assertNumQueries(0):
+            self.assertEqual(global_search(self.lawyer, 'ромашка'), first)
+        manager = CustomUser.objects.create_user(username='manager', role='manager')
+        with profile_queries() as profile:
+            self.assertEqual(global_search(manager, 'ромашка'), first)
+        self.assertGreater(profile.count, 0)
+
+    def test_task_index_follows_title_only(self):
+        entries = list(SearchEntry.objects.filter(kind='task').values_list('pk', flat=True))
+        self.task.status = 'done'
+        self.task.save(update_fields=['status'])
+        self.assertEqual(list(SearchEntry.objects.filter(kind='task').values_list('pk', flat=True)), entries)
+        self.task.title = 'Апелляция'
+        self.task.save()
+
+        self.assertEqual(global_search(self.lawyer, 'апелляц')['task'][0]['id'], self.task.pk)
+
+    def test_api_echoes_sequence_within_budget(self):
+        self.client.force_login(self.lawyer)
+        data = self.client.get('/api/search/', {'q': 'лютик', 'seq': '7'}).json()
+
+        self.assertEqual(data['seq'], '7')
+        self.assertEqual([item['id'] for item in data['results']['case']], [self.case.pk])
+        self.assertWithinQueryBudget('/api/search/', {'q': 'ромашка пет'})
+
+    def test_client_url_encodes_company_name(self):
+        from urllib.parse import parse_qs, urlsplit
+
+        self.client_obj.company_name = 'Ромашка & Лютик "Сад" #1 + 2'
+        self.client_obj.save()
+
+        url = global_search(self.lawyer, 'лютик')['client'][0]['url']
+
+        self.assertNotIn('"', url)
+        self.assertEqual(parse_qs(urlsplit(url).query), {'search': ['Ромашка & Лютик "Сад" #1 + 2']})
+
+
+class CaseFacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.lawyers = make_firm(2)
+        self.manager = CustomUser.objects.create_user(username='manager', role='manager')
+        Client.objects.filter(company_name='ООО 1-1').update(status='active')
+
+    def counts(self, facets, name):
+        return {item['value']: item['count'] for item in facets[name] if item['count']}
+
+    def test_counts_ignore_own_filter_and_apply_the_others(self):
+        with self.assertNumQueries(2):
+            facets = case_facets({'stage': 'court', 'lawyer': str(self.lawyers[1].pk)})
+
+        # Стадии - по делам юриста 1 без фильтра по стадии
+        self.assertEqual(self.counts(facets, 'stage'), {'closed': 1, 'court': 1})
+        self.assertTrue(next(item for item in facets['stage'] if item['value'] == 'court')['selected'])
+        # Юристы - по делам на стадии court без фильтра по юристу
+        self.assertEqual(self.counts(facets, 'lawyer'), {self.lawyers[0].pk: 1, self.lawyers[1].pk: 1})
+        self.assertEqual(self.counts(facets, 'client_status'), {'active': 1})
+        self.assertEqual(self.counts(case_facets({'stage': 'court'}), 'client_status'), {'new': 1, 'active': 1})
+        self.assertEqual(self.counts(facets, 'case_type'), {'civil': 1})
+        self.assertEqual(len(facets['case_type']), len(Case.TYPE_CHOICES))
+
+    def test_facet_counts_match_filtered_list(self):
+        params = {'client_status': 'active'}
+        facets = case_facets(params)
+
+        for item in facets['stage']:
+            self.assertEqual(item['count'], Case.objects.filter(client__status='active', stage=item['value']).count())
+
+    def test_cached_per_filter_signature(self):
+        case_facets({'stage': 'court'})
+        with self.assertNumQueries(0):
+            case_facets({'stage': 'court', 'cursor': ''})
+        with self.assertNumQueries(2):
+            case_facets({'stage': 'closed'})
+
+    def test_case_list_context_has_facets(self):
+        context = _view_context(CaseListView, self.manager, {'search': 'дело'})
+
+        self.assertEqual(sum(item['count'] for item in context['facets']['stage']), 4)
+
+    def test_search_counts_every_match(self):
+        client = Client.objects.get(company_name='ООО 1-1')
+        make_supply_cases(client, self.lawyers[1], SEARCH_RESULT_LIMIT + 50)
+
+        with self.assertNumQueries(2):
+            facets = case_facets({'search': 'договор поставки'})
+
+        self.assertEqual(self.counts(facets, 'stage'), {'court': SEARCH_RESULT_LIMIT + 50})
+        self.assertEqual(self.counts(facets, 'lawyer'), {self.lawyers[1].pk: SEARCH_RESULT_LIMIT + 50})
+        self.assertEqual(self.counts(facets, 'client_status'), {'active': SEARCH_RESULT_LIMIT + 50})
+
+
+class BulkTaskTests(TestCase):
+    def setUp(self):
+        self.lawyers = make_firm(2)
+        self.manager = CustomUser.objects.create_user(username='manager', role='manager')
+        self.case = Case.objects.order_by('pk').first()
+        self.due = timezone.now() + timedelta(days=3)
+        self.tasks = [self.create_task(self.lawyers[0]) for _ in range(3)]
+
+    def create_task(self, lawyer, **fields):
+        return Task.objects.create(
+            title='Задача', description='', case=self.case, assigned_to=lawyer, assigned_by=self.manager,
+            due_date=self.due, **fields
+        )
+
+    def test_status_change_reports_each_id_and_refreshes_summary(self):
+        done = self.create_task(self.lawyers[0], status='done')
+        ids = [task.pk for task in self.tasks] + [done.pk, 999999]
+
+        results = bulk_update_tasks(self.lawyers[0], 'status', 'done', ids=ids)
+
+        self.assertEqual(results, {
+            **{task.pk: 'updated' for task in self.tasks}, done.pk: 'unchanged', 999999: 'not_found'
+        })
+        self.case.refresh_from_db()
+        self.assertEqual((self.case.tasks_done, self.case.tasks_pending), (4, 0))
+        self.assertFalse(Task.objects.filter(status='done', completed_at__isnull=True).exclude(pk=done.pk).exists())
+        # Одно уведомление постановщику на все задачи
+        notification = Notification.objects.get(user=self.manager)
+        self.assertEqual(notification.message.split(' (')[0], 'Задач: 3')
+
+    def test_reassignment_by_filter_has_fixed_number_of_queries(self):
+        def reassign(source, target):
+            return bulk_update_tasks(self.manager, 'assign', target.pk, filters={'assigned_to': source.pk})
+
+        with profile_queries() as profile:
+            reassign(self.lawyers[0], self.lawyers[1])
+        for _ in range(30):
+            self.create_task(self.lawyers[1])
+        with self.assertNumQueries(profile.count):
+            results = reassign(self.lawyers[1], self.lawyers[0])
+
+        self.assertEqual(len(results), 33)
+        self.assertEqual(Task.objects.filter(assigned_to=self.lawyers[0]).count(), 33)
+        self.assertEqual(Notification.objects.filter(user=self.lawyers[0]).count(), 1)
+
+    def test_due_shift_and_priority(self):
+        bulk_update_tasks(self.manager, 'shift_due', -2, ids=[self.tasks[0].pk])
+        bulk_update_tasks(self.manager, 'priority', 'urgent', filters={'case': self.case.pk})
+
+        self.tasks[0].refresh_from_db()
+        self.assertEqual(self.tasks[0].due_date, self.due - timedelta(days=2))
+        self.assertEqual(Task.objects.filter(priority='urgent').count(), 3)
+
+    def test_every_operation_marks_cases_changed(self):
+        past = timezone.now() - timedelta(days=1)
+        for operation, value in (('assign', self.lawyers[1].pk), ('shift_due', 1), ('priority', 'low')):
+            Case.objects.filter(pk=self.case.pk).update(updated_at=past)
+            old_file = report_file_name(Case.objects.get(pk=self.case.pk), 'xlsx')
+
+            bulk_update_tasks(self.manager, operation, value, ids=[task.pk for task in self.tasks])
+
+            case = Case.objects.get(pk=self.case.pk)
+            self.assertGreater(case.updated_at, past, operation)
+            self.assertNotEqual(report_file_name(case, 'xlsx'), old_file, operation)
+
+    def test_lawyer_cannot_touch_other_tasks(self):
+        results = bulk_update_tasks(self.lawyers[1], 'priority', 'low', ids=[self.tasks[0].pk])
+
+        self.assertEqual(results, {self.tasks[0].pk: 'not_found'})
+
+    def test_api(self):
+        import json
+
+        self.client.force_login(self.manager)
+        response = self.client.post('/api/tasks/bulk/', json.dumps({
+            'operation': 'status', 'value': 'in_progress', 'ids': [self.tasks[0].pk],
+        }), content_type='application/json')
+        self.assertEqual(response.json()['results'], {str(self.tasks[0].pk): 'updated'})
+
+        for payload in ({'operation': 'delete', 'ids': [1]}, {'operation': 'status', 'value': 'done'}, [1]):
+            response = self.client.post('/api/tasks/bulk/', json.dumps(payload), content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_malformed_filters_are_rejected(self):
+        import json
+
+        self.client.force_login(self.manager)
+        for bad_filter in ({'assigned_to': 'abc'}, ['status'], {'case': None}, {'status': 'lost'}, {'priority': 1}):
+            response = self.client.post('/api/tasks/bulk/', json.dumps({
+                'operation': 'priority', 'value': 'low', 'filter': bad_filter,
+            }), content_type='application/json')
+            self.assertEqual(response.status_code, 400, bad_filter)
+            self.assertFalse(response.json()['success'])
+        self.assertFalse(Task.objects.filter(priority='low').exists())
+
+        # Id числом в строке допустим
+        results = bulk_update_tasks(self.manager, 'priority', 'low', filters={'assigned_to': str(self.lawyers[0].pk)})
+        self.assertEqual(set(results.values()), {'updated'})
+
+
+class CalendarFeedTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.lawyer, self.other = make_firm(2)
+        self.start = timezone.make_aware(datetime(2024, 3, 1))
+        self.end = timezone.make_aware(datetime(2024, 3, 8))
+        self.window = {'start': self.start.isoformat(), 'end': self.end.isoformat()}
+        self.client.force_login(self.lawyer)
+
+    def create_event(self, title, start, hours, created_by=None, participants=()):
+        event = CalendarEvent.objects.create(
+            title=title, event_type='meeting', start_time=start, end_time=start + timedelta(hours=hours),
+            created_by=created_by or self.lawyer
+        )
+        event.participants.add(*participants)
+        return event
+
+    def test_overlapping_events_of_the_user(self):
+        self.create_event('Через начало окна', self.start - timedelta(hours=2), 4)
+        self.create_event('Через конец окна', self.end - timedelta(hours=1), 3)
+        self.create_event('Участие', self.start + timedelta(days=1), 1, created_by=self.other, participants=[self.lawyer])
+        self.create_event('До окна', self.start - timedelta(hours=3), 3)
+        self.create_event('Чужое', self.start + timedelta(days=1), 1, created_by=self.other)
+
+        response = self.client.get('/api/calendar/events/', self.window)
+
+        self.assertEqual([event['title'] for event in response.json()],
+                         ['Через начало окна', 'Участие', 'Через конец окна'])
+        self.assertEqual(self.client.get('/api/calendar/events/', {'start': 'x', 'end': '2024-03-01'}).status_code, 400)
+
+    def test_unchanged_window_is_not_modified_without_event_queries(self):
+        event = self.create_event('Встреча', self.start + timedelta(days=1), 1)
+        response = self.client.get('/api/calendar/events/', self.window)
+        etag = response['ETag']
+
+        # Только сессия и пользователь
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/calendar/events/', self.window, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        event.participants.add(self.other)
+        response = self.client.get('/api/calendar/events/', self.window, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_participant_sees_new_version_after_event_change(self):
+        event = self.create_event('Встреча', self.start + timedelta(days=1), 1, created_by=self.other,
+                                  participants=[self.lawyer])
+        etag = self.client.get('/api/calendar/events/', self.window)['ETag']
+
+        event.title = 'Перенесенная встреча'
+        event.save()
+        response = self.client.get('/api/calendar/events/', self.window, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.json()[0]['title'], 'Перенесенная встреча')
+
+        event.delete()
+        self.assertEqual(self.client.get('/api/calendar/events/', self.window).json(), [])
+
+    def test_page_embeds_only_current_window(self):
+        case = Case.objects.first()
+        for week in range(50):
+            self.create_event(f'Старое {week}', self.start - timedelta(weeks=week + 1), 1)
+        event = self.create_event('Среда', self.start + timedelta(days=5), 1)
+        event.case = case
+        event.save()
+
+        with self.assertNumQueries(1):
+            context = _view_context(CalendarView, self.lawyer, {'view': 'week', 'date': '2024-03-06'})
+        initial = context['calendar_initial']
+
+        self.assertEqual(initial['view'], 'timeGridWeek')
+        self.assertEqual((initial['start'][:10], initial['end'][:10]), ('2024-03-04', '2024-03-11'))
+        self.assertEqual([(item['title'], item['case']) for item in initial['events']], [('Среда', case.title)])
+
+        month = _view_context(CalendarView, self.lawyer, {'date': '2024-03-20'})['calendar_initial']
+        self.assertEqual((month['start'][:10], month['end'][:10]), ('2024-02-26', '2024-04-08'))
+
+
+class RecurringEventTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.lawyer, self.other = make_firm(2)
+        self.client.force_login(self.lawyer)
+        # Понедельник
+        self.first = timezone.make_aware(datetime(2024, 3, 4, 10))
+        self.series = CalendarEvent.objects.create(
+            title='Планерка', event_type='meeting', start_time=self.first, end_time=self.first + timedelta(hours=1),
+            created_by=self.lawyer, recurrence_rule='FREQ=WEEKLY;BYDAY=MO,WE;COUNT=6'
+        )
+
+    def feed(self, start, end):
+        return self.client.get('/api/calendar/events/', {'start': start.isoformat(), 'end': end.isoformat()}).json()
+
+    def local_starts(self, rule, dtstart, start, end):
+        return [
+            timezone.localtime(moment).strftime('%Y-%m-%d %H:%M')
+            for moment in RecurrenceRule.parse(rule).occurrences(dtstart, timedelta(hours=1), start, end)
+        ]
+
+    def test_rule_parsing(self):
+        rule = RecurrenceRule.parse('RRULE:FREQ=WEEKLY;INTERVAL=2;BYDAY=WE,MO;UNTIL=20241231')
+        self.assertEqual(str(rule).split(';UNTIL=')[0], 'FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,WE')
+        for text in ('FREQ=YEARLY', 'FREQ=DAILY;BYDAY=MO', 'FREQ=DAILY;COUNT=2;UNTIL=20240101', 'FREQ=DAILY;BYHOUR=1'):
+            with self.assertRaises(RecurrenceError):
+                RecurrenceRule.parse(text)
+        event = CalendarEvent(title='x', event_type='meeting', start_time=self.first, end_time=self.first,
+                              created_by=self.lawyer, recurrence_rule='FREQ=HOURLY')
+        with self.assertRaises(ValidationError):
+            event.full_clean()
+
+    def test_series_is_expanded_only_for_the_window(self):
+        self.assertEqual(self.series.recurrence_end, timezone.make_aware(datetime(2024, 3, 20, 11)))
+        self.assertEqual(
+            [event['start'][:16] for event in self.feed(self.first + timedelta(days=7), self.first + timedelta(days=14))],
+            ['2024-03-11T10:00', '2024-03-13T10:00']
+        )
+        # После шестого повторения серия закончилась и не выбирается
+        with self.assertNumQueries(3):
+            self.assertEqual(self.feed(self.first + timedelta(days=21), self.first + timedelta(days=28)), [])
+
+        # Пропуск к окну учитывает COUNT; 31-го числа нет в апреле
+        start = timezone.make_aware(datetime(2024, 1, 31, 9))
+        self.assertEqual(
+            self.local_starts('FREQ=DAILY;COUNT=40', start, start + timedelta(days=38), start + timedelta(days=60)),
+            ['2024-03-09 09:00', '2024-03-10 09:00']
+        )
+        self.assertEqual(
+            self.local_starts('FREQ=MONTHLY', start, start + timedelta(days=50), start + timedelta(days=125)),
+            ['2024-03-31 09:00', '2024-05-31 09:00']
+        )
+
+    @override_settings(TIME_ZONE='Europe/Berlin')
+    def test_occurrences_keep_local_time_across_dst(self):
+        start = timezone.make_aware(datetime(2024, 4, 1, 10))
+        self.assertEqual(
+            self.local_starts('FREQ=WEEKLY', start - timedelta(weeks=1), start - timedelta(weeks=1), start + timedelta(days=1)),
+            ['2024-03-25 10:00', '2024-04-01 10:00']
+        )
+
+    def test_overrides_cancel_move_and_rename_occurrences(self):
+        week = (self.first + timedelta(days=7), self.first + timedelta(days=14))
+        etag = self.client.get('/api/calendar/events/', {'start': week[0].isoformat(), 'end': week[1].isoformat()})['ETag']
+        url = f'/api/calendar/events/{self.series.pk}/occurrences/'
+
+        response = self.client.post(url, {'original_start': '2024-03-11T10:00:00+03:00', 'cancel': True},
+                                    content_type='application/json')
+        self.assertEqual(response.json(), {'success': True})
+        # Повторение из следующей недели переносится в эту
+        response = self.client.post(url, {
+            'original_start': '2024-03-18T10:00:00+03:00', 'start': '2024-03-15T12:00:00+03:00', 'title': 'Перенос'
+        }, content_type='application/json')
+        self.assertEqual(response.json()['event']['end'][:16], '2024-03-15T13:00')
+
+        response = self.client.get('/api/calendar/events/', {'start': week[0].isoformat(), 'end': week[1].isoformat()},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual([(event['title'], event['start'][:16]) for event in response.json()],
+                         [('Планерка', '2024-03-13T10:00'), ('Перенос', '2024-03-15T12:00')])
+        self.assertEqual(self.feed(week[1], week[1] + timedelta(days=7))[0]['start'][:16], '2024-03-20T10:00')
+
+        response = self.client.post(url, {'original_start': '2024-03-12T10:00:00+03:00', 'cancel': True},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.client.force_login(self.other)
+        response = self.client.post(url, {'original_start': '2024-03-13T10:00:00+03:00', 'cancel': True},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_reminders_expand_series_for_the_next_day(self):
+        start = timezone.now() + timedelta(hours=2)
+        series = CalendarEvent.objects.create(
+            title='Сверка с судом', event_type='court_hearing', start_time=start - timedelta(weeks=3),
+            end_time=start - timedelta(weeks=3) + timedelta(hours=1), created_by=self.lawyer,
+            recurrence_rule='FREQ=WEEKLY'
+        )
+        series.participants.add(self.other)
+
+        send_event_reminders()
+
+        self.assertEqual(
+            set(Notification.objects.filter(related_object_type='calendar_event').values_list('user', 'related_object_id')),
+            {(self.lawyer.pk, series.pk), (self.other.pk, series.pk)}
+        )
+
+
+class FreeBusyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.lawyer, self.other = make_firm(2)
+        self.case = Case.objects.first()
+        # Понедельник
+        self.day = timezone.make_aware(datetime(2024, 3, 4))
+        self.at = lambda hour, minute=0: self.day + timedelta(hours=hour, minutes=minute)
+
+        CalendarEvent.objects.create(title='Встреча', event_type='meeting', start_time=self.at(10),
+                                     end_time=self.at(11), created_by=self.lawyer)
+        hearing = CalendarEvent.objects.create(title='Заседание', event_type='court_hearing', start_time=self.at(10, 30),
+                                               end_time=self.at(12), created_by=self.other)
+        hearing.participants.add(self.lawyer)
+        CalendarEvent.objects.create(title='Планерка', event_type='meeting', start_time=self.at(9) - timedelta(weeks=1),
+                                     end_time=self.at(9, 30) - timedelta(weeks=1), created_by=self.other,
+                                     recurrence_rule='FREQ=WEEKLY')
+        Task.objects.create(title='Иск', description='', assigned_to=self.lawyer, due_date=self.at(15),
+                            estimated_hours=Decimal('2'))
+        Task.objects.create(title='Готово', description='', assigned_to=self.lawyer, due_date=self.at(17), status='done')
+        call = Communication.objects.create(case=self.case, communication_type='phone', subject='Звонок', content='',
+                                            scheduled_for=self.at(16), created_by=self.other)
+        call.participants.add(self.lawyer)
+
+    def test_busy_intervals_from_all_sources_in_two_queries(self):
+        with self.assertNumQueries(2):
+            busy = busy_intervals([self.lawyer.pk, self.other.pk], self.day, self.day + timedelta(days=1))
+
+        self.assertEqual(
+            [(interval.title, timezone.localtime(interval.start).strftime('%H:%M'), timezone.localtime(interval.end).strftime('%H:%M'))
+             for interval in busy[self.lawyer.pk]],
+            [('Встреча', '10:00', '11:00'), ('Заседание', '10:30', '12:00'), ('Иск', '13:00', '15:00'),
+             ('Звонок', '16:00', '17:00')]
+        )
+        self.assertEqual([interval.title for interval in busy[self.other.pk]], ['Планерка', 'Заседание', 'Звонок'])
+
+        free = free_slots(busy, self.day, self.day + timedelta(days=1), min_duration=timedelta(minutes=60))
+        self.assertEqual(
+            [(timezone.localtime(start).strftime('%H:%M'), timezone.localtime(end).strftime('%H:%M')) for start, end in free],
+            [('12:00', '13:00'), ('15:00', '16:00'), ('17:00', '19:00')]
+        )
+
+    def test_creator_who_is_also_participant_is_busy_once(self):
+        meeting = CalendarEvent.objects.get(title='Встреча')
+        meeting.participants.add(self.lawyer)
+        call = Communication.objects.get(subject='Звонок')
+        call.participants.add(self.other)
+
+        busy = busy_intervals([self.lawyer.pk, self.other.pk], self.day, self.day + timedelta(days=1))
+
+        self.assertEqual([interval.title for interval in busy[self.lawyer.pk]], ['Встреча', 'Заседание', 'Иск', 'Звонок'])
+        self.assertEqual([interval.title for interval in busy[self.other.pk]], ['Планерка', 'Заседание', 'Звонок'])
+        conflicts = event_conflicts([self.lawyer.pk], self.at(10), self.at(10, 15))
+        self.assertEqual([interval.title for _, interval in conflicts], ['Встреча'])
+
+    def test_api_returns_merged_busy_and_free_slots(self):
+        self.client.force_login(self.lawyer)
+        response = self.client.get('/api/calendar/free-busy/', {
+            'users': f'{self.lawyer.pk},{self.other.pk}', 'start': self.day.isoformat(),
+            'end': (self.day + timedelta(days=2)).isoformat(), 'duration': 120,
+        })
+        data = response.json()
+        self.assertEqual([item['start'][11:16] for item in data['busy'][str(self.lawyer.pk)]], ['10:00', '13:00', '16:00'])
+        self.assertEqual([(item['start'][:16], item['end'][11:16]) for item in data['free']],
+                         [('2024-03-04T17:00', '19:00'), ('2024-03-05T09:00', '19:00')])
+
+        client_user = CustomUser.objects.filter(role='client').first()
+        self.client.force_login(client_user)
+        self.assertEqual(self.client.get('/api/calendar/free-busy/', {
+            'start': self.day.isoformat(), 'end': (self.day + timedelta(days=1)).isoformat()
+        }).status_code, 403)
+
+    def test_event_form_reports_conflicts(self):
+        data = {
+            'title': 'Новая встреча', 'description': '', 'event_type': 'meeting',
+            'start_time': '2024-03-11 09:15', 'end_time': '2024-03-11 09:45', 'participants': [self.other.pk],
+            'location': '', 'color': '#3788d8', 'recurrence_rule': '',
+        }
+        form = CalendarEventForm(data, user=self.lawyer)
+        self.assertFalse(form.is_valid())
+        self.assertIn('Планерка', ' '.join(form.non_field_errors()))
+
+        form = CalendarEventForm({**data, 'ignore_conflicts': 'on'}, user=self.lawyer)
+        self.assertTrue(form.is_valid())
+
+        # Изменение события не пересекается само с собой
+        event = CalendarEvent.objects.get(title='Встреча')
+        form = CalendarEventForm({**data, 'start_time': '2024-03-04 10:00', 'end_time': '2024-03-04 10:20',
+                                  'participants': [self.lawyer.pk]}, instance=event)
+        self.assertTrue(form.is_valid(), form.errors)
+
+
+@override_settings(CALENDAR_SYNC_SETTLE=0)
+class CalendarSyncTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        LocalCalendarClient.stores.clear()
+        self.lawyer, self.other = make_firm(2)
+        self.client.force_login(self.lawyer)
+        start = timezone.make_aware(datetime(2024, 3, 4, 10))
+        self.own = self.create_event('Встреча', start, self.lawyer)
+        self.joined = self.create_event('Заседание', start + timedelta(days=1), self.other)
+        self.joined.participants.add(self.lawyer)
+
+    def create_event(self, title, start, created_by, **fields):
+        return CalendarEvent.objects.create(title=title, event_type='meeting', start_time=start,
+                                            end_time=start + timedelta(hours=1), created_by=created_by, **fields)
+
+    def sync(self, token=None):
+        return self.client.get('/api/calendar/sync/', {'token': token} if token else {})
+
+    def test_delta_returns_only_changes_and_tombstones(self):
+        full = self.sync().json()
+        self.assertTrue(full['full'])
+        self.assertEqual({change['uid'] for change in full['changes']}, {event_uid(self.own.pk), event_uid(self.joined.pk)})
+
+        self.own.title = 'Встреча с клиентом'
+        self.own.save()
+        self.joined.participants.remove(self.lawyer)
+        added = self.create_event('Звонок', self.own.start_time + timedelta(days=2), self.lawyer)
+        # Изменения чужого календаря в выдачу не попадают
+        self.create_event('Чужое', self.own.start_time, self.other)
+
+        with self.assertNumQueries(5):
+            delta = self.sync(full['token']).json()
+        self.assertEqual(
+            [(change['action'], change['uid'], change.get('event', {}).get('title')) for change in delta['changes']],
+            [('upsert', event_uid(self.own.pk), 'Встреча с клиентом'), ('delete', event_uid(self.joined.pk), None),
+             ('upsert', event_uid(added.pk), 'Звонок')]
+        )
+        self.assertEqual(delta['changes'][0]['event']['sequence'], 1)
+        self.assertEqual(self.sync(delta['token']).json()['changes'], [])
+
+        token, uid = delta['token'], event_uid(added.pk)
+        added.delete()
+        self.assertEqual(self.sync(token).json()['changes'], [{'action': 'delete', 'uid': uid}])
+
+    @override_settings(CALENDAR_SYNC_SETTLE=3600)
+    def test_token_does_not_pass_unsettled_changes(self):
+        token = self.sync().json()['token']
+        self.own.save()
+        first = self.sync(token).json()
+        self.assertEqual(self.sync(first['token']).json()['changes'], first['changes'])
+
+    def test_invalid_and_expired_tokens(self):
+        token = self.sync().json()['token']
+        self.assertEqual(self.sync('garbage').status_code, 400)
+        with override_settings(CALENDAR_SYNC_TOKEN_TTL=-1):
+            self.assertEqual(self.sync(token).status_code, 410)
+
+    def test_external_sync_with_local_client(self):
+        result = sync_calendar_with_external(self.lawyer.pk, 'local')
+        self.assertEqual((result['status'], result['changes']), ('ok', 2))
+        events = LocalCalendarClient.stores[self.lawyer.pk]
+        self.assertEqual(set(events), {event_uid(self.own.pk), event_uid(self.joined.pk)})
+
+        self.joined.delete()
+        self.own.title = 'Перенесенная встреча'
+        self.own.save()
+        result = sync_calendar_with_external(self.lawyer.pk, 'local')
+        self.assertEqual(result['changes'], 2)
+        self.assertEqual([event['title'] for event in events.values()], ['Перенесенная встреча'])
+        self.assertEqual(sync_calendar_with_external(self.lawyer.pk, 'local')['changes'], 0)
+
+        self.assertEqual(sync_calendar_with_external(self.lawyer.pk, 'google')['status'], 'not_configured')
+
+    def test_ics_feed_with_series_and_conditional_get(self):
+        series = self.create_event('Планерка, еженедельная', timezone.now(), self.lawyer,
+                                   recurrence_rule='FREQ=WEEKLY;COUNT=4', description='Повестка: ' + 'пункт; ' * 20)
+        occurrences = list(series.rule.occurrences(series.start_time, timedelta(hours=1)))
+        CalendarEventOverride.objects.create(event=series, original_start=occurrences[1], is_cancelled=True)
+        CalendarEventOverride.objects.create(event=series, original_start=occurrences[2], title='Перенесенная',
+                                             start_time=occurrences[2] + timedelta(hours=2),
+                                             end_time=occurrences[2] + timedelta(hours=3))
+        url = f'/api/calendar/ics/{self.lawyer.calendar_token}/'
+        self.client.logout()
+
+        response = self.client.get(url)
+        ics = response.content.decode()
+        self.assertEqual(response['Content-Type'], 'text/calendar; charset=utf-8')
+        self.assertIn('SUMMARY:Планерка\\, еженедельная', ics)
+        self.assertIn('RRULE:FREQ=WEEKLY;COUNT=4', ics)
+        self.assertIn('EXDATE:' + occurrences[1].astimezone(dt_timezone.utc).strftime('%Y%m%dT%H%M%SZ'), ics)
+        self.assertIn('RECURRENCE-ID:' + occurrences[2].astimezone(dt_timezone.utc).strftime('%Y%m%dT%H%M%SZ'), ics)
+        self.assertTrue(all(len(line.encode()) <= 75 for line in ics.split('\r\n')))
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get('/api/calendar/ics/00000000-0000-0000-0000-000000000000/').status_code, 404)
@@ -0,0 +1,12 @@
+from django.urls import path
+from . import views
+
+urlpatterns = [
+    path('cases/', views.CaseListView.as_view(), name='case_list'),
+    path('cases/<int:pk>/', views.CaseDetailView.as_view(), name='case_detail'),
+    path('cases/<int:pk>/<slug:section>/', views.CaseSectionView.as_view(), name='case_section'),
+    path('tasks/create/', views.TaskCreateView.as_view(), name='task_create'),
+    path('calendar/', views.CalendarView.as_view(), name='calendar'),
+    path('analytics/', views.AnalyticsView.as_view(), name='analytics'),
+    path('reports/clients/', views.ClientRankingView.as_view(), name='client_ranking'),
+]
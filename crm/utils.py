@@ -1,10 +1,59 @@
-from django.db.models import Sum, Count, Avg
+from django.db.models import Sum, Count, Avg, Q, F, ExpressionWrapper, DecimalField, DateField
+from django.db.models.functions import Trunc, TruncDate
+from django.db import transaction
 from django.utils import timezone
-from datetime import datetime, timedelta
+from django.utils.dateparse import parse_date
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 from django.contrib import messages
 from .models import *
+from .search import search_cases
+from .calendar_feed import window_filter, expand_occurrences
+from .calendar_sync import sync_external
 import json
 
+# Тип результата денежных и часовых сумм (запас разрядов под агрегаты)
+AGGREGATE_DECIMAL = DecimalField(max_digits=15, decimal_places=2)
+
+# Себестоимость часов: duration (2 знака) * hourly_rate (2 знака) дает ровно 4 знака
+COST_DECIMAL = DecimalField(max_digits=20, decimal_places=4)
+TIME_ENTRY_COST = ExpressionWrapper(F('duration') * F('lawyer__hourly_rate'), output_field=COST_DECIMAL)
+
+def total_cost(time_entries):
+    """Себестоимость оплачиваемых записей времени одним агрегатом в БД"""
+    return time_entries.filter(billable=True).aggregate(
+        total=Sum(TIME_ENTRY_COST, output_field=COST_DECIMAL)
+    )['total'] or 0
+
+def cost_by_lawyer(time_entries):
+    """Себестоимость оплачиваемых записей времени по юристам: {lawyer_id: сумма}"""
+    return dict(
+        time_entries.filter(billable=True).order_by().values('lawyer').annotate(
+            total=Sum(TIME_ENTRY_COST, output_field=COST_DECIMAL)
+        ).values_list('lawyer', 'total')
+    )
+
+def cost_by_case(time_entries):
+    """Себестоимость оплачиваемых записей времени по делам: {case_id: сумма}"""
+    return dict(
+        time_entries.filter(billable=True).order_by().values('case').annotate(
+            total=Sum(TIME_ENTRY_COST, output_field=COST_DECIMAL)
+        ).values_list('case', 'total')
+    )
+
+def lawyer_daily_costs(time_entries):
+    """
+    Свертка записей времени по юристу и локальному дню: часы, оплачиваемые часы
+    и себестоимость. Общая основа для аналитики и расчета бонусов.
+    """
+    return time_entries.annotate(day=TruncDate('start_time')).order_by().values(
+        'lawyer', 'day'
+    ).annotate(
+        hours=Sum('duration', output_field=AGGREGATE_DECIMAL),
+        billable_hours=Sum('duration', filter=Q(billable=True), output_field=AGGREGATE_DECIMAL),
+        cost=Sum(TIME_ENTRY_COST, filter=Q(billable=True), output_field=COST_DECIMAL),
+    )
+
 def generate_analytics(period='month', date_from=None, date_to=None):
     """Генерация аналитики для заданного периода"""
     
@@ -36,22 +85,18 @@ def generate_analytics(period='month', date_from=None, date_to=None):
     total_revenue = payments_qs.aggregate(total=Sum('amount'))['total'] or 0
     
     # Расходы (рассчитываем как сумма зарплат юристов за отработанные часы)
-    time_entries_qs = TimeEntry.objects.filter(
+    total_expenses = total_cost(TimeEntry.objects.filter(
         start_time__gte=date_from,
-        start_time__lte=date_to,
-        billable=True
-    ).select_related('lawyer')
-    
-    total_expenses = 0
-    for entry in time_entries_qs:
-        if entry.lawyer.hourly_rate:
-            total_expenses += entry.duration * entry.lawyer.hourly_rate
-    
-    # Активные дела
-    active_cases = Case.objects.filter(
-        is_active=True,
-        created_at__gte=date_from
-    ).count()
+        start_time__lte=date_to
+    ))
+    
+    # Счетчики по делам одним запросом
+    case_counters = Case.objects.filter(created_at__gte=date_from).aggregate(
+        active_cases=Count('id', filter=Q(is_active=True)),
+        total_closed_cases=Count('id', filter=Q(stage='closed')),
+        total_cases_in_period=Count('id', filter=Q(created_at__lte=date_to)),
+    )
+    active_cases = case_counters['active_cases']
     
     # Новые клиенты
     new_clients = Client.objects.filter(
@@ -60,19 +105,15 @@ def generate_analytics(period='month', date_from=None, date_to=None):
     ).count()
     
     # Средняя длительность дела (в днях)
-    closed_cases = Case.objects.filter(
+    closed_periods = list(Case.objects.filter(
         end_date__isnull=False,
         created_at__gte=date_from
-    )
+    ).values_list('start_date', 'end_date'))
     
     avg_duration = 0
-    if closed_cases.exists():
-        total_days = sum([
-            (case.end_date - case.start_date).days 
-            for case in closed_cases 
-            if case.end_date
-        ])
-        avg_duration = total_days / closed_cases.count()
+    if closed_periods:
+        total_days = sum((end_date - start_date).days for start_date, end_date in closed_periods)
+        avg_duration = total_days / len(closed_periods)
     
     analytics = {
         'period': period,
@@ -93,24 +134,15 @@ def generate_analytics(period='month', date_from=None, date_to=None):
         'case_success_rate': 0,
     }
     
-    # Статистика по юристам
-    lawyers = CustomUser.objects.filter(role='lawyer', is_active=True)
+    # Статистика по юристам (один запрос с подзапросами вместо цикла)
+    lawyers = CustomUser.objects.lawyers().with_statistics(
+        date_from=date_from,
+        cases=Case.objects.filter(is_active=True),
+        closed_cases=Case.objects.filter(stage='closed', created_at__gte=date_from),
+    )
     for lawyer in lawyers:
-        # Количество дел юриста
-        cases = Case.objects.filter(lawyer=lawyer, is_active=True)
-        
-        # Выручка по делам юриста
-        lawyer_revenue = Payment.objects.filter(
-            case__lawyer=lawyer,
-            is_paid=True,
-            payment_date__gte=date_from
-        ).aggregate(total=Sum('amount'))['total'] or 0
-        
-        # Отработанные часы
-        worked_hours = TimeEntry.objects.filter(
-            lawyer=lawyer,
-            start_time__gte=date_from
-        ).aggregate(total=Sum('duration'))['total'] or 0
+        lawyer_revenue = lawyer.revenue
+        worked_hours = lawyer.total_hours
         
         # Эффективность (выручка на час работы)
         efficiency = 0
@@ -118,20 +150,14 @@ def generate_analytics(period='month', date_from=None, date_to=None):
             efficiency = lawyer_revenue / worked_hours
         
         # Процент успешных дел
-        successful_cases = Case.objects.filter(
-            lawyer=lawyer,
-            stage='closed',
-            created_at__gte=date_from
-        ).count()
-        
         success_rate = 0
-        if cases.count() > 0:
-            success_rate = (successful_cases / cases.count()) * 100
+        if lawyer.cases_count > 0:
+            success_rate = (lawyer.closed_cases_count / lawyer.cases_count) * 100
         
         analytics['lawyer_productivity'].append({
             'id': lawyer.id,
             'name': lawyer.get_full_name() or lawyer.username,
-            'cases_count': cases.count(),
+            'cases_count': lawyer.cases_count,
             'revenue': round(lawyer_revenue, 2),
             'worked_hours': round(worked_hours, 2),
             'hourly_rate': lawyer.hourly_rate,
@@ -144,11 +170,15 @@ def generate_analytics(period='month', date_from=None, date_to=None):
     
     # Распределение по типам дел
     case_types = dict(Case.TYPE_CHOICES)
+    type_counts = dict(
+        Case.objects.filter(created_at__gte=date_from)
+        .order_by()
+        .values('case_type')
+        .annotate(count=Count('id'))
+        .values_list('case_type', 'count')
+    )
     for case_type, label in case_types.items():
-        count = Case.objects.filter(
-            case_type=case_type,
-            created_at__gte=date_from
-        ).count()
+        count = type_counts.get(case_type, 0)
         if count > 0:
             analytics['case_type_distribution'][label] = {
                 'count': count,
@@ -157,89 +187,579 @@ def generate_analytics(period='month', date_from=None, date_to=None):
     
     # Распределение по стадиям
     stages = dict(Case.STAGE_CHOICES)
+    stage_counts = dict(
+        Case.objects.filter(is_active=True, created_at__gte=date_from)
+        .order_by()
+        .values('stage')
+        .annotate(count=Count('id'))
+        .values_list('stage', 'count')
+    )
     for stage, label in stages.items():
-        count = Case.objects.filter(
-            stage=stage,
-            is_active=True,
-            created_at__gte=date_from
-        ).count()
+        count = stage_counts.get(stage, 0)
         if count > 0:
             analytics['stage_distribution'][label] = {
                 'count': count,
                 'percentage': round((count / active_cases * 100) if active_cases > 0 else 0, 1)
             }
     
-    # Выручка по месяцам
-    revenue_by_month = []
-    current_date = date_from
-    while current_date <= date_to:
-        month_start = current_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        if period in ['year', 'quarter', 'month']:
-            next_month = month_start + timedelta(days=32)
-            month_end = next_month.replace(day=1) - timedelta(days=1)
-        else:
-            month_end = min(current_date + timedelta(days=30), date_to)
-        
-        month_revenue = Payment.objects.filter(
-            is_paid=True,
-            payment_date__gte=month_start,
-            payment_date__lte=month_end
-        ).aggregate(total=Sum('amount'))['total'] or 0
-        
-        revenue_by_month.append({
-            'month': month_start.strftime('%b %Y'),
-            'revenue': round(month_revenue, 2),
-            'start_date': month_start,
-            'end_date': month_end
-        })
-        
-        if period in ['year', 'quarter', 'month']:
-            current_date = month_end + timedelta(days=1)
-        else:
-            current_date = month_end
+    # Выручка по месяцам (для коротких периодов - по дням) одним запросом
+    granularity = 'month' if period in ['year', 'quarter', 'month'] else 'day'
+    revenue_by_month = [
+        {
+            'month': bucket['label'],
+            'revenue': round(bucket['value'], 2),
+            'start_date': bucket['start_date'],
+            'end_date': bucket['end_date'],
+        }
+        for bucket in revenue_series(
+            _parse_analytics_date(date_from),
+            _parse_analytics_date(date_to),
+            granularity
+        )
+    ]
     
     analytics['revenue_by_month'] = revenue_by_month
     
     # Топ клиентов по выручке
-    top_clients = []
+    top_clients = Client.objects.ranked('revenue', date_from=date_from)[:10]
+    
+    analytics['top_clients'] = [
+        {
+            'client': client,
+            'revenue': round(client.revenue, 2),
+            'cases_count': client.cases_count
+        }
+        for client in top_clients
+    ]
+    
+    # Процент успешных дел
+    total_closed_cases = case_counters['total_closed_cases']
+    total_cases_in_period = case_counters['total_cases_in_period']
+    
+    if total_cases_in_period > 0:
+        analytics['case_success_rate'] = round((total_closed_cases / total_cases_in_period) * 100, 1)
+    
+    return analytics
+
+# Материализованная аналитика: дневные срезы и их свертки
+
+ROLLUP_PERIODS = ('daily', 'weekly', 'monthly', 'yearly')
+
+def _period_bounds(period, day):
+    """Первый и последний день периода, содержащего day"""
+    if period == 'daily':
+        return day, day
+    if period == 'weekly':
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=6)
+    if period == 'monthly':
+        start = day.replace(day=1)
+        return start, (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    if period == 'quarterly':
+        start = day.replace(month=(day.month - 1) // 3 * 3 + 1, day=1)
+        return start, (start + timedelta(days=95)).replace(day=1) - timedelta(days=1)
+    if period == 'yearly':
+        return day.replace(month=1, day=1), day.replace(month=12, day=31)
+    raise ValueError(f'Неизвестный период: {period}')
+
+def local_day_range(date_from, date_to):
+    """Границы [начало date_from, начало дня после date_to) в локальной зоне"""
+    start = timezone.make_aware(datetime.combine(date_from, datetime.min.time()))
+    end = timezone.make_aware(datetime.combine(date_to + timedelta(days=1), datetime.min.time()))
+    return start, end
+
+def _empty_metrics():
+    return {
+        'total_revenue': Decimal('0'),
+        'total_expenses': Decimal('0'),
+        'active_cases': 0,
+        'new_clients': 0,
+        'lawyer_performance': {},
+        'case_type_distribution': {},
+    }
+
+def _lawyer_metrics(metrics, lawyer_id):
+    return metrics['lawyer_performance'].setdefault(str(lawyer_id), {
+        'revenue': Decimal('0'),
+        'hours': Decimal('0'),
+        'expenses': Decimal('0'),
+        'cases': 0,
+    })
+
+def _merge_metrics(target, source):
+    """Сложение метрик source в target (все метрики аддитивны)"""
+    for key in ('total_revenue', 'total_expenses', 'active_cases', 'new_clients'):
+        target[key] += source[key]
+    for lawyer_id, values in source['lawyer_performance'].items():
+        lawyer_metrics = _lawyer_metrics(target, lawyer_id)
+        for key, value in values.items():
+            lawyer_metrics[key] += value
+    for case_type, count in source['case_type_distribution'].items():
+        target['case_type_distribution'][case_type] = target['case_type_distribution'].get(case_type, 0) + count
+    return target
+
+def _sum_metrics(metrics_list):
+    total = _empty_metrics()
+    for metrics in metrics_list:
+        _merge_metrics(total, metrics)
+    return total
+
+def collect_daily_metrics(date_from, date_to):
+    """
+    Метрики по каждому дню диапазона из исходных таблиц.
+    Количество запросов не зависит от длины диапазона: по одному GROUP BY на таблицу.
+    """
+    start, end = local_day_range(date_from, date_to)
+    days = {}
+    
+    def day_metrics(day):
+        return days.setdefault(day, _empty_metrics())
+    
+    payments = Payment.objects.filter(
+        is_paid=True,
+        payment_date__gte=date_from,
+        payment_date__lte=date_to
+    ).order_by().values('payment_date', 'case__lawyer').annotate(
+        total=Sum('amount', output_field=AGGREGATE_DECIMAL)
+    )
+    for row in payments:
+        metrics = day_metrics(row['payment_date'])
+        metrics['total_revenue'] += row['total']
+        if row['case__lawyer']:
+            _lawyer_metrics(metrics, row['case__lawyer'])['revenue'] += row['total']
+    
+    daily_costs = lawyer_daily_costs(TimeEntry.objects.filter(
+        start_time__gte=start,
+        start_time__lt=end
+    ))
+    for row in daily_costs:
+        metrics = day_metrics(row['day'])
+        lawyer_metrics = _lawyer_metrics(metrics, row['lawyer'])
+        lawyer_metrics['hours'] += row['hours']
+        if row['cost']:
+            lawyer_metrics['expenses'] += row['cost']
+            metrics['total_expenses'] += row['cost']
+    
+    cases = Case.objects.filter(
+        created_at__gte=start,
+        created_at__lt=end
+    ).annotate(day=TruncDate('created_at')).order_by().values(
+        'day', 'lawyer', 'case_type'
+    ).annotate(
+        count=Count('id'),
+        active=Count('id', filter=Q(is_active=True))
+    )
+    for row in cases:
+        metrics = day_metrics(row['day'])
+        metrics['active_cases'] += row['active']
+        distribution = metrics['case_type_distribution']
+        distribution[row['case_type']] = distribution.get(row['case_type'], 0) + row['count']
+        if row['lawyer']:
+            _lawyer_metrics(metrics, row['lawyer'])['cases'] += row['count']
+    
     clients = Client.objects.filter(
-        cases__payments__is_paid=True,
-        cases__payments__payment_date__gte=date_from
-    ).distinct()
+        created_at__gte=start,
+        created_at__lt=end
+    ).annotate(day=TruncDate('created_at')).order_by().values('day').annotate(count=Count('id'))
+    for row in clients:
+        day_metrics(row['day'])['new_clients'] += row['count']
     
-    for client in clients:
-        client_revenue = Payment.objects.filter(
-            case__client=client,
-            is_paid=True,
-            payment_date__gte=date_from
-        ).aggregate(total=Sum('amount'))['total'] or 0
+    day = date_from
+    while day <= date_to:
+        day_metrics(day)
+        day += timedelta(days=1)
+    return days
+
+def _metrics_to_row(period, period_date, metrics):
+    return Analytics(
+        period=period,
+        period_date=period_date,
+        total_revenue=metrics['total_revenue'],
+        total_expenses=metrics['total_expenses'],
+        total_profit=metrics['total_revenue'] - metrics['total_expenses'],
+        active_cases=metrics['active_cases'],
+        new_clients=metrics['new_clients'],
+        lawyer_performance={
+            lawyer_id: {
+                key: str(value) if isinstance(value, Decimal) else value
+                for key, value in values.items()
+            }
+            for lawyer_id, values in metrics['lawyer_performance'].items()
+        },
+        case_type_distribution=metrics['case_type_distribution'],
+    )
+
+def _row_to_metrics(row):
+    metrics = _empty_metrics()
+    metrics['total_revenue'] = row.total_revenue
+    metrics['total_expenses'] = row.total_expenses
+    metrics['active_cases'] = row.active_cases
+    metrics['new_clients'] = row.new_clients
+    for lawyer_id, values in row.lawyer_performance.items():
+        lawyer_metrics = _lawyer_metrics(metrics, lawyer_id)
+        lawyer_metrics['revenue'] = Decimal(values['revenue'])
+        lawyer_metrics['hours'] = Decimal(values['hours'])
+        lawyer_metrics['expenses'] = Decimal(values['expenses'])
+        lawyer_metrics['cases'] = values['cases']
+    metrics['case_type_distribution'] = dict(row.case_type_distribution)
+    return metrics
+
+def _replace_rollups(period, rows):
+    """Атомарная замена строк периода на новые значения"""
+    with transaction.atomic():
+        Analytics.objects.filter(
+            period=period,
+            period_date__in=[row.period_date for row in rows]
+        ).delete()
+        Analytics.objects.bulk_create(rows)
+
+def build_daily_analytics(date_from, date_to=None):
+    """Пересчет дневных срезов за диапазон из исходных таблиц"""
+    date_to = date_to or date_from
+    days = collect_daily_metrics(date_from, date_to)
+    rows = [_metrics_to_row('daily', day, metrics) for day, metrics in sorted(days.items())]
+    _replace_rollups('daily', rows)
+    return len(rows)
+
+def rollup_analytics(period, date_from, date_to=None):
+    """Свертка дневных срезов в недельные, месячные или годовые строки"""
+    date_to = date_to or date_from
+    first_start, _ = _period_bounds(period, date_from)
+    _, last_end = _period_bounds(period, date_to)
+    
+    buckets = {}
+    period_start = first_start
+    while period_start <= last_end:
+        buckets[period_start] = _empty_metrics()
+        period_start = _period_bounds(period, period_start)[1] + timedelta(days=1)
+    
+    daily_rows = Analytics.objects.filter(
+        period='daily',
+        period_date__gte=first_start,
+        period_date__lte=last_end
+    )
+    for row in daily_rows:
+        period_start = _period_bounds(period, row.period_date)[0]
+        _merge_metrics(buckets[period_start], _row_to_metrics(row))
+    
+    rows = [_metrics_to_row(period, period_start, metrics) for period_start, metrics in sorted(buckets.items())]
+    _replace_rollups(period, rows)
+    return len(rows)
+
+def backfill_analytics(date_from, date_to, chunk_days=31):
+    """Заполнение истории дневными срезами порциями и пересчет сверток"""
+    chunk_start = date_from
+    days_built = 0
+    while chunk_start <= date_to:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), date_to)
+        days_built += build_daily_analytics(chunk_start, chunk_end)
+        chunk_start = chunk_end + timedelta(days=1)
+    
+    for period in ROLLUP_PERIODS[1:]:
+        rollup_analytics(period, date_from, date_to)
+    return days_built
+
+# Дни до вчерашнего, пересчитываемые каждую ночь без отметки устаревания:
+# QuerySet.update и правки мимо ORM сигналов не вызывают
+ANALYTICS_REFRESH_DAYS = 35
+
+def mark_analytics_stale(days):
+    """
+    Срезы и свертки, содержащие дни days (даты, моменты или строки), устарели:
+    до ночного пересчета compose_analytics считает эти периоды по исходным таблицам
+    """
+    # Сегодняшний день в срезы еще не попал, свертки текущих периодов пересчитываются каждую ночь
+    today = timezone.localdate()
+    days = {day for day in map(_parse_analytics_date, days) if day and day < today}
+    if not days:
+        return 0
+    lookup = Q(period='daily', period_date__in=days)
+    for period in ROLLUP_PERIODS[1:]:
+        lookup |= Q(period=period, period_date__in={_period_bounds(period, day)[0] for day in days})
+    return Analytics.objects.filter(lookup, is_stale=False).update(is_stale=True)
+
+def _day_ranges(days):
+    """Разбиение множества дней на непрерывные диапазоны [(первый, последний)]"""
+    ranges = []
+    for day in sorted(days):
+        if ranges and ranges[-1][1] + timedelta(days=1) == day:
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return [tuple(item) for item in ranges]
+
+def refresh_analytics(day=None, trailing_days=ANALYTICS_REFRESH_DAYS):
+    """
+    Пересчет срезов за trailing_days дней по day (по умолчанию вчера) и всех
+    устаревших дней до него, затем сверток, содержащих эти дни. Возвращает число дней.
+    """
+    day = day or timezone.localdate() - timedelta(days=1)
+    days = {day - timedelta(days=offset) for offset in range(trailing_days)}
+    days.update(Analytics.objects.filter(
+        period='daily', is_stale=True, period_date__lte=day
+    ).values_list('period_date', flat=True))
+    
+    for date_from, date_to in _day_ranges(days):
+        build_daily_analytics(date_from, date_to)
+        for period in ROLLUP_PERIODS[1:]:
+            rollup_analytics(period, date_from, date_to)
+    return len(days)
+
+def _rollup_cover(date_from, date_to):
+    """
+    Разбиение диапазона на целые месяцы и оставшиеся дни.
+    Каждая строка лежит внутри одного месяца, поэтому из них же строится помесячная выручка.
+    """
+    cover = []
+    day = date_from
+    while day <= date_to:
+        month_start, month_end = _period_bounds('monthly', day)
+        if day == month_start and month_end <= date_to:
+            cover.append(('monthly', day, month_end))
+            day = month_end + timedelta(days=1)
+        else:
+            cover.append(('daily', day, day))
+            day += timedelta(days=1)
+    return cover
+
+def _parse_analytics_date(value):
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return timezone.localtime(value).date() if timezone.is_aware(value) else value.date()
+    if isinstance(value, date):
+        return value
+    return parse_date(value)
+
+def _add_case_sections(analytics, date_from, date_to):
+    """
+    Длительность и успешность дел, стадии и топ клиентов за [date_from, date_to]
+    по исходным таблицам, как в generate_analytics. Возвращает {юрист: закрытых дел}.
+    """
+    start, end = local_day_range(date_from, date_to)
+    period_cases = Case.objects.filter(created_at__gte=start, created_at__lt=end)
+    
+    # Одна группировка на стадии, закрытые дела юристов и успешность
+    closed_by_lawyer = {}
+    stage_counts = {}
+    total_cases = closed_cases = active_cases = 0
+    for row in period_cases.order_by().values('lawyer', 'stage', 'is_active').annotate(count=Count('id')):
+        total_cases += row['count']
+        if row['stage'] == 'closed':
+            closed_cases += row['count']
+            if row['lawyer']:
+                closed_by_lawyer[row['lawyer']] = closed_by_lawyer.get(row['lawyer'], 0) + row['count']
+        if row['is_active']:
+            active_cases += row['count']
+            stage_counts[row['stage']] = stage_counts.get(row['stage'], 0) + row['count']
+    for stage, label in Case.STAGE_CHOICES:
+        count = stage_counts.get(stage, 0)
+        if count > 0:
+            analytics['stage_distribution'][label] = {
+                'count': count,
+                'percentage': round((count / active_cases * 100) if active_cases > 0 else 0, 1)
+            }
+    if total_cases > 0:
+        analytics['case_success_rate'] = round(closed_cases / total_cases * 100, 1)
+    
+    closed_periods = list(period_cases.filter(end_date__isnull=False).values_list('start_date', 'end_date'))
+    if closed_periods:
+        total_days = sum((end_date - start_date).days for start_date, end_date in closed_periods)
+        analytics['avg_case_duration'] = round(total_days / len(closed_periods), 1)
+    
+    analytics['top_clients'] = [
+        {
+            'client': client,
+            'revenue': round(client.revenue, 2),
+            'cases_count': client.cases_count
+        }
+        for client in Client.objects.ranked('revenue', date_from=date_from, date_to=date_to)[:10]
+    ]
+    return closed_by_lawyer
+
+def compose_analytics(period='month', date_from=None, date_to=None):
+    """
+    Аналитика за произвольный диапазон из материализованных срезов (те же
+    разделы, что у generate_analytics). Исходные таблицы читаются для
+    сегодняшнего (неполного) дня, для дней, которые еще не попали в срезы,
+    и для разделов, которых в срезах нет (стадии, длительность, топ клиентов).
+    """
+    today = timezone.localdate()
+    date_to = _parse_analytics_date(date_to) or today
+    date_from = _parse_analytics_date(date_from)
+    if not date_from:
+        days_back = {'day': 1, 'week': 7, 'month': 30, 'quarter': 90, 'year': 365}.get(period, 30)
+        date_from = date_to - timedelta(days=days_back)
+    
+    segments = {}
+    history_to = min(date_to, today - timedelta(days=1))
+    if date_from <= history_to:
+        cover = _rollup_cover(date_from, history_to)
+        lookup = Q(pk__in=[])
+        for cover_period in ('monthly', 'daily'):
+            dates = [start for p, start, _ in cover if p == cover_period]
+            if dates:
+                lookup |= Q(period=cover_period, period_date__in=dates)
+        stored = {(row.period, row.period_date): row for row in Analytics.objects.filter(lookup, is_stale=False)}
+        
+        # Срезы, которые еще не построены или устарели, считаем по исходным таблицам:
+        # соседние пропуски объединяются, чтобы не делать запросы на каждый из них
+        missing = []
+        for cover_period, start, end in cover:
+            row = stored.get((cover_period, start))
+            if row:
+                segments[start] = _row_to_metrics(row)
+            elif missing and missing[-1][1] + timedelta(days=1) == start:
+                missing[-1][1] = end
+            else:
+                missing.append([start, end])
         
-        if client_revenue > 0:
-            top_clients.append({
-                'client': client,
-                'revenue': round(client_revenue, 2),
-                'cases_count': client.cases.count()
-            })
+        for start, end in missing:
+            for day, metrics in collect_daily_metrics(start, end).items():
+                segments[day] = metrics
     
-    top_clients.sort(key=lambda x: x['revenue'], reverse=True)
-    analytics['top_clients'] = top_clients[:10]
+    if date_from <= today <= date_to:
+        segments[today] = collect_daily_metrics(today, today)[today]
     
-    # Процент успешных дел
-    total_closed_cases = Case.objects.filter(
-        stage='closed',
-        created_at__gte=date_from
-    ).count()
+    total = _sum_metrics(segments.values())
+    total_revenue = total['total_revenue']
+    total_expenses = total['total_expenses']
+    active_cases = total['active_cases']
     
-    total_cases_in_period = Case.objects.filter(
-        created_at__gte=date_from,
-        created_at__lte=date_to
-    ).count()
+    analytics = {
+        'period': period,
+        'date_from': date_from,
+        'date_to': date_to,
+        'total_revenue': total_revenue,
+        'total_expenses': total_expenses,
+        'total_profit': total_revenue - total_expenses,
+        'active_cases': active_cases,
+        'new_clients': total['new_clients'],
+        'avg_case_duration': 0,
+        'profit_margin': round(((total_revenue - total_expenses) / total_revenue * 100) if total_revenue > 0 else 0, 1),
+        'lawyer_productivity': [],
+        'case_type_distribution': {},
+        'stage_distribution': {},
+        'revenue_by_month': [],
+        'top_clients': [],
+        'case_success_rate': 0,
+    }
+    # Разделы, которых нет в срезах, - по исходным таблицам (три запроса)
+    closed_by_lawyer = _add_case_sections(analytics, date_from, date_to)
     
-    if total_cases_in_period > 0:
-        analytics['case_success_rate'] = round((total_closed_cases / total_cases_in_period) * 100, 1)
+    lawyers = CustomUser.objects.in_bulk([int(lawyer_id) for lawyer_id in total['lawyer_performance']])
+    for lawyer_id, values in total['lawyer_performance'].items():
+        lawyer = lawyers.get(int(lawyer_id))
+        if not lawyer:
+            continue
+        efficiency = values['revenue'] / values['hours'] if values['hours'] > 0 else 0
+        analytics['lawyer_productivity'].append({
+            'id': lawyer.id,
+            'name': lawyer.get_full_name() or lawyer.username,
+            'cases_count': values['cases'],
+            'revenue': round(values['revenue'], 2),
+            'worked_hours': round(values['hours'], 2),
+            'expenses': round(values['expenses'], 2),
+            'hourly_rate': lawyer.hourly_rate,
+            'efficiency': round(efficiency, 2),
+            'success_rate': round(closed_by_lawyer.get(lawyer.id, 0) / values['cases'] * 100 if values['cases'] else 0, 1),
+        })
+    analytics['lawyer_productivity'].sort(key=lambda x: x['efficiency'], reverse=True)
+    
+    for case_type, label in Case.TYPE_CHOICES:
+        count = total['case_type_distribution'].get(case_type, 0)
+        if count > 0:
+            analytics['case_type_distribution'][label] = {
+                'count': count,
+                'percentage': round((count / active_cases * 100) if active_cases > 0 else 0, 1)
+            }
+    
+    revenue_by_month = {}
+    for start, metrics in sorted(segments.items()):
+        month_start = start.replace(day=1)
+        revenue_by_month[month_start] = revenue_by_month.get(month_start, 0) + metrics['total_revenue']
+    analytics['revenue_by_month'] = [
+        {
+            'month': month_start.strftime('%b %Y'),
+            'revenue': round(revenue, 2),
+            'start_date': month_start,
+            'end_date': _period_bounds('monthly', month_start)[1],
+        }
+        for month_start, revenue in revenue_by_month.items()
+    ]
     
     return analytics
 
+# Временные ряды: одна группировка по усеченной дате, пропуски заполняются нулями
+
+SERIES_GRANULARITIES = {
+    'day': ('daily', '%d.%m.%Y'),
+    'week': ('weekly', '%d.%m.%Y'),
+    'month': ('monthly', '%b %Y'),
+    'quarter': ('quarterly', None),
+}
+
+def _bucket_label(granularity, start):
+    if granularity == 'quarter':
+        return f'{(start.month - 1) // 3 + 1} кв. {start.year}'
+    return start.strftime(SERIES_GRANULARITIES[granularity][1])
+
+def _fill_series(granularity, date_from, date_to, totals):
+    """Все корзины диапазона по порядку, пустые - с нулем"""
+    period = SERIES_GRANULARITIES[granularity][0]
+    series = []
+    bucket_start = _period_bounds(period, date_from)[0]
+    while bucket_start <= date_to:
+        bucket_end = _period_bounds(period, bucket_start)[1]
+        series.append({
+            'label': _bucket_label(granularity, bucket_start),
+            'start_date': bucket_start,
+            'end_date': bucket_end,
+            'value': totals.get(bucket_start, 0),
+        })
+        bucket_start = bucket_end + timedelta(days=1)
+    return series
+
+def _check_granularity(granularity):
+    if granularity not in SERIES_GRANULARITIES:
+        raise ValueError(f'Неизвестная гранулярность: {granularity}')
+
+def revenue_series(date_from, date_to, granularity='month'):
+    """Оплаченная выручка по корзинам day/week/month/quarter одним запросом"""
+    _check_granularity(granularity)
+    totals = dict(
+        Payment.objects.filter(
+            is_paid=True,
+            payment_date__gte=date_from,
+            payment_date__lte=date_to
+        ).annotate(
+            bucket=Trunc('payment_date', granularity, output_field=DateField())
+        ).order_by().values('bucket').annotate(
+            total=Sum('amount', output_field=AGGREGATE_DECIMAL)
+        ).values_list('bucket', 'total')
+    )
+    return _fill_series(granularity, date_from, date_to, totals)
+
+def hours_series(date_from, date_to, granularity='month', time_entries=None):
+    """
+    Отработанные часы по корзинам одним запросом. Дни и недели считаются
+    в локальной зоне (TIME_ZONE), а не в UTC.
+    """
+    _check_granularity(granularity)
+    start, end = local_day_range(date_from, date_to)
+    time_entries = TimeEntry.objects.all() if time_entries is None else time_entries
+    totals = dict(
+        time_entries.filter(
+            start_time__gte=start,
+            start_time__lt=end
+        ).annotate(
+            bucket=Trunc('start_time', granularity, output_field=DateField(), tzinfo=timezone.get_current_timezone())
+        ).order_by().values('bucket').annotate(
+            total=Sum('duration', output_field=AGGREGATE_DECIMAL)
+        ).values_list('bucket', 'total')
+    )
+    return _fill_series(granularity, date_from, date_to, totals)
+
 def create_calendar_event_from_communication(communication):
     """Создание события календаря из коммуникации"""
     if communication.scheduled_for and communication.communication_type in ['meeting', 'phone']:
@@ -349,183 +869,344 @@ def send_task_reminders():
     
     return f"Отправлено {notifications_sent} напоминаний о задачах"
 
+def send_event_reminders(hours=24):
+    """
+    Напоминания автору и участникам о событиях календаря, начинающихся в
+    ближайшие hours часов. Серии разворачиваются только на это окно.
+    """
+    start = timezone.now()
+    end = start + timedelta(hours=hours)
+    events = CalendarEvent.objects.filter(window_filter(start, end)).prefetch_related('participants')
+    
+    notifications = []
+    for occurrence in expand_occurrences(events, start, end):
+        if occurrence.start_time < start:
+            continue
+        recipients = {occurrence.created_by_id, *(user.pk for user in occurrence.participants.all())}
+        notifications.extend(
+            Notification(
+                user_id=user_id,
+                title='Напоминание о событии',
+                message=f'{occurrence.title}: {timezone.localtime(occurrence.start_time).strftime("%d.%m.%Y %H:%M")}',
+                notification_type='reminder',
+                related_object_id=occurrence.event.pk,
+                related_object_type='calendar_event',
+            )
+            for user_id in recipients
+        )
+    Notification.objects.bulk_create(notifications)
+    return f"Отправлено {len(notifications)} напоминаний о событиях"
+
+def _name(user):
+    return user.get_full_name() if user else ''
+
+def _datetime(value):
+    return value.strftime('%d.%m.%Y %H:%M') if value else None
+
+def _date(value):
+    return value.strftime('%d.%m.%Y') if value else None
+
+def _yes_no(value):
+    return 'Да' if value else 'Нет'
+
+# Разделы отчета по делу: (ключ, заголовок, queryset по делу, колонки (поле, подпись), строка).
+# Пользователи подтягиваются JOIN (select_related), а не запросом на каждую строку.
+CASE_REPORT_SECTIONS = [
+    ('communications', 'Коммуникации',
+     lambda case: Communication.objects.filter(case=case).select_related('created_by').order_by('-created_at', '-id'),
+     [('type', 'Тип'), ('subject', 'Тема'), ('date', 'Дата'), ('created_by', 'Автор')],
+     lambda comm: {
+         'type': comm.get_communication_type_display(),
+         'subject': comm.subject,
+         'date': _datetime(comm.created_at),
+         'created_by': _name(comm.created_by),
+     }),
+    ('documents', 'Документы',
+     lambda case: Document.objects.filter(case=case).select_related('uploaded_by').order_by('-uploaded_at', '-id'),
+     [('title', 'Название'), ('category', 'Категория'), ('uploaded_at', 'Загружен'),
+      ('uploaded_by', 'Загрузил'), ('is_signed', 'Подписан')],
+     lambda doc: {
+         'title': doc.title,
+         'category': doc.get_category_display(),
+         'uploaded_at': _datetime(doc.uploaded_at),
+         'uploaded_by': _name(doc.uploaded_by),
+         'is_signed': _yes_no(doc.is_signed),
+     }),
+    ('tasks', 'Задачи',
+     lambda case: Task.objects.filter(case=case).select_related('assigned_to').order_by('-due_date', '-id'),
+     [('title', 'Задача'), ('status', 'Статус'), ('priority', 'Приоритет'), ('assigned_to', 'Исполнитель'),
+      ('due_date', 'Срок'), ('completed_at', 'Выполнена'), ('estimated_hours', 'Оценка, ч'),
+      ('actual_hours', 'Факт, ч')],
+     lambda task: {
+         'title': task.title,
+         'status': task.get_status_display(),
+         'priority': task.get_priority_display(),
+         'assigned_to': _name(task.assigned_to),
+         'due_date': _datetime(task.due_date),
+         'completed_at': _datetime(task.completed_at),
+         'estimated_hours': float(task.estimated_hours),
+         'actual_hours': float(task.actual_hours),
+     }),
+    ('payments', 'Платежи',
+     lambda case: Payment.objects.filter(case=case).order_by('-payment_date', '-id'),
+     [('amount', 'Сумма'), ('type', 'Тип'), ('payment_date', 'Дата'), ('is_paid', 'Оплачен'),
+      ('paid_date', 'Дата оплаты')],
+     lambda payment: {
+         'amount': float(payment.amount),
+         'type': payment.get_payment_type_display(),
+         'payment_date': _date(payment.payment_date),
+         'is_paid': _yes_no(payment.is_paid),
+         'paid_date': _date(payment.paid_date),
+     }),
+    ('time_entries', 'Учет времени',
+     lambda case: TimeEntry.objects.filter(case=case).select_related('lawyer').order_by('-start_time', '-id'),
+     [('lawyer', 'Юрист'), ('description', 'Описание'), ('start_time', 'Начало'),
+      ('duration', 'Часы'), ('billable', 'Оплачиваемое')],
+     lambda time_entry: {
+         'lawyer': _name(time_entry.lawyer),
+         'description': time_entry.description,
+         'start_time': _datetime(time_entry.start_time),
+         'duration': float(time_entry.duration),
+         'billable': _yes_no(time_entry.billable),
+     }),
+]
+
+CASE_INFO_LABELS = {
+    'number': 'Номер дела', 'title': 'Название', 'client': 'Клиент', 'lawyer': 'Юрист',
+    'type': 'Тип', 'stage': 'Стадия', 'start_date': 'Начало', 'end_date': 'Окончание',
+    'budget': 'Бюджет', 'actual_cost': 'Себестоимость', 'success_probability': 'Вероятность успеха, %',
+}
+
+CASE_STATISTICS_LABELS = {
+    'total_paid': 'Оплачено', 'remaining_budget': 'Остаток бюджета', 'total_hours_spent': 'Часы',
+    'total_cost': 'Себестоимость', 'documents_count': 'Документов', 'tasks_completed': 'Задач выполнено',
+    'tasks_pending': 'Задач в работе',
+}
+
+def case_report_header(case):
+    """Сведения и статистика дела (дело загружено с select_related('client__user', 'lawyer'))"""
+    case_info = {
+        'number': case.case_number,
+        'title': case.title,
+        'client': case.client.user.get_full_name(),
+        'lawyer': case.lawyer.get_full_name() if case.lawyer else 'Не назначен',
+        'type': case.get_case_type_display(),
+        'stage': case.get_stage_display(),
+        'start_date': case.start_date.strftime('%d.%m.%Y'),
+        'end_date': case.end_date.strftime('%d.%m.%Y') if case.end_date else 'В процессе',
+        'budget': float(case.budget),
+        'actual_cost': float(case.actual_cost),
+        'success_probability': case.success_probability,
+    }
+    # Статистика из сводки по делу (crm.case_summary)
+    statistics = {
+        'total_paid': float(case.total_paid),
+        'remaining_budget': float(case.budget - case.total_paid),
+        'total_hours_spent': float(case.total_hours),
+        'total_cost': float(case.actual_cost),
+        'documents_count': case.documents_count,
+        'tasks_completed': case.tasks_done,
+        'tasks_pending': case.tasks_pending,
+    }
+    return case_info, statistics
+
+def iter_case_report_rows(case, section, chunk_size=500):
+    """Строки раздела отчета потоком, порциями по chunk_size"""
+    for key, _, queryset, _, row in CASE_REPORT_SECTIONS:
+        if key == section:
+            return (row(obj) for obj in queryset(case).iterator(chunk_size=chunk_size))
+    raise KeyError(section)
+
 def generate_case_report(case_id):
     """Генерация отчета по делу"""
     try:
-        case = Case.objects.get(id=case_id)
-        
-        report = {
-            'case_info': {
-                'number': case.case_number,
-                'title': case.title,
-                'client': case.client.user.get_full_name(),
-                'lawyer': case.lawyer.get_full_name() if case.lawyer else 'Не назначен',
-                'type': case.get_case_type_display(),
-                'stage': case.get_stage_display(),
-                'start_date': case.start_date.strftime('%d.%m.%Y'),
-                'end_date': case.end_date.strftime('%d.%m.%Y') if case.end_date else 'В процессе',
-                'budget': float(case.budget),
-                'actual_cost': float(case.actual_cost),
-                'success_probability': case.success_probability,
-            },
-            'communications': [],
-            'documents': [],
-            'tasks': [],
-            'payments': [],
-            'time_entries': [],
-            'statistics': {}
-        }
-        
-        # Коммуникации
-        for comm in case.communications.all().order_by('-created_at'):
-            report['communications'].append({
-                'type': comm.get_communication_type_display(),
-                'subject': comm.subject,
-                'date': comm.created_at.strftime('%d.%m.%Y %H:%M'),
-                'created_by': comm.created_by.get_full_name()
-            })
-        
-        # Документы
-        for doc in case.documents.all().order_by('-uploaded_at'):
-            report['documents'].append({
-                'title': doc.title,
-                'category': doc.get_category_display(),
-                'uploaded_at': doc.uploaded_at.strftime('%d.%m.%Y %H:%M'),
-                'uploaded_by': doc.uploaded_by.get_full_name(),
-                'is_signed': 'Да' if doc.is_signed else 'Нет'
-            })
-        
-        # Задачи
-        for task in case.tasks.all().order_by('-due_date'):
-            report['tasks'].append({
-                'title': task.title,
-                'status': task.get_status_display(),
-                'priority': task.get_priority_display(),
-                'assigned_to': task.assigned_to.get_full_name(),
-                'due_date': task.due_date.strftime('%d.%m.%Y %H:%M'),
-                'completed_at': task.completed_at.strftime('%d.%m.%Y %H:%M') if task.completed_at else None,
-                'estimated_hours': float(task.estimated_hours),
-                'actual_hours': float(task.actual_hours),
-            })
-        
-        # Платежи
-        for payment in case.payments.all().order_by('-payment_date'):
-            report['payments'].append({
-                'amount': float(payment.amount),
-                'type': payment.get_payment_type_display(),
-                'payment_date': payment.payment_date.strftime('%d.%m.%Y'),
-                'is_paid': 'Да' if payment.is_paid else 'Нет',
-                'paid_date': payment.paid_date.strftime('%d.%m.%Y') if payment.paid_date else None,
-            })
-        
-        # Учет времени
-        for time_entry in case.time_entries.all().order_by('-start_time'):
-            report['time_entries'].append({
-                'lawyer': time_entry.lawyer.get_full_name(),
-                'description': time_entry.description,
-                'start_time': time_entry.start_time.strftime('%d.%m.%Y %H:%M'),
-                'duration': float(time_entry.duration),
-                'billable': 'Да' if time_entry.billable else 'Нет',
-            })
-        
-        # Статистика
-        total_paid = case.payments.filter(is_paid=True).aggregate(total=Sum('amount'))['total'] or 0
-        total_hours = case.time_entries.aggregate(total=Sum('duration'))['total'] or 0
-        
-        report['statistics'] = {
-            'total_paid': float(total_paid),
-            'remaining_budget': float(case.budget - total_paid),
-            'total_hours_spent': float(total_hours),
-            'documents_count': len(report['documents']),
-            'tasks_completed': case.tasks.filter(status='done').count(),
-            'tasks_pending': case.tasks.filter(status__in=['todo', 'in_progress']).count(),
-        }
-        
-        return report
-    
+        case = Case.objects.select_related('client__user', 'lawyer').get(id=case_id)
     except Case.DoesNotExist:
         return None
+    
+    case_info, statistics = case_report_header(case)
+    report = {'case_info': case_info}
+    for key, _, queryset, _, row in CASE_REPORT_SECTIONS:
+        report[key] = [row(obj) for obj in queryset(case)]
+    report['statistics'] = statistics
+    return report
+
+# Фильтры списка дел: параметр запроса -> поле
+CASE_LIST_FILTERS = {
+    'stage': 'stage',
+    'case_type': 'case_type',
+    'lawyer': 'lawyer_id',
+    'client_status': 'client__status',
+}
+
+def filter_case_list(queryset, params, exclude=()):
+    """
+    Фильтры списка дел ?stage=&case_type=&lawyer=&client_status=&search=
+    (CaseListView, выгрузка, счетчики фасетов). exclude - параметры, которые не применять.
+    """
+    for param, field in CASE_LIST_FILTERS.items():
+        if param not in exclude and params.get(param):
+            queryset = queryset.filter(**{field: params[param]})
+    
+    search = params.get('search')
+    if search and 'search' not in exclude:
+        # Поиск по индексу токенов, порядок - по релевантности
+        # (в режиме курсора - по дате, как и весь список)
+        return search_cases(search, queryset)
+    
+    return queryset.order_by('-created_at')
+
+def _bonus_statistics(period_start, period_end):
+    """Юристы с выручкой и делами за период (один запрос)"""
+    return CustomUser.objects.filter(role='lawyer').with_statistics(
+        date_from=period_start,
+        date_to=period_end,
+        cases=Case.objects.filter(created_at__gte=period_start, created_at__lte=period_end),
+    )
+
+def _bonus_time_entries(period_start, period_end):
+    return TimeEntry.objects.filter(
+        start_time__gte=period_start,
+        start_time__lte=period_end
+    )
+
+def _compute_bonus(lawyer, hours, cost, period_start, period_end):
+    """Расчет бонуса по готовым показателям юриста (общий для одиночного и пакетного режима)"""
+    revenue = lawyer.revenue
+    
+    # Процент успешных дел
+    success_rate = (lawyer.closed_cases_count / lawyer.cases_count * 100) if lawyer.cases_count > 0 else 0
+    
+    # Расчет бонуса
+    base_bonus = 0
+    efficiency = revenue / (hours * lawyer.hourly_rate) if hours > 0 and lawyer.hourly_rate > 0 else 0
+    
+    if efficiency > Decimal('1.5'):  # Высокая эффективность
+        base_bonus = revenue * Decimal('0.1')  # 10% от выручки
+    elif efficiency > Decimal('1.2'):
+        base_bonus = revenue * Decimal('0.07')  # 7% от выручки
+    elif efficiency > Decimal('1.0'):
+        base_bonus = revenue * Decimal('0.05')  # 5% от выручки
+    
+    # Дополнительный бонус за высокий процент успешных дел
+    success_bonus = 0
+    if success_rate > 90:
+        success_bonus = base_bonus * Decimal('0.5')  # +50% к бонусу
+    elif success_rate > 80:
+        success_bonus = base_bonus * Decimal('0.3')  # +30% к бонусу
+    elif success_rate > 70:
+        success_bonus = base_bonus * Decimal('0.1')  # +10% к бонусу
+    
+    total_bonus = base_bonus + success_bonus
+    
+    return {
+        'lawyer': lawyer.get_full_name(),
+        'period': f'{period_start.strftime("%d.%m.%Y")} - {period_end.strftime("%d.%m.%Y")}',
+        'revenue': round(revenue, 2),
+        'hours': round(hours, 2),
+        'cost': round(cost, 2),
+        'efficiency': round(efficiency, 2),
+        'success_rate': round(success_rate, 1),
+        'base_bonus': round(base_bonus, 2),
+        'success_bonus': round(success_bonus, 2),
+        'total_bonus': round(total_bonus, 2),
+    }
 
 def calculate_lawyer_bonus(lawyer_id, period_start, period_end):
     """Расчет бонуса для юриста на основе эффективности"""
     try:
-        lawyer = CustomUser.objects.get(id=lawyer_id, role='lawyer')
-        
-        # Получаем дела юриста за период
-        cases = Case.objects.filter(
-            lawyer=lawyer,
-            created_at__gte=period_start,
-            created_at__lte=period_end
-        )
-        
-        # Выручка от дел юриста
-        revenue = Payment.objects.filter(
-            case__lawyer=lawyer,
-            is_paid=True,
-            payment_date__gte=period_start,
-            payment_date__lte=period_end
-        ).aggregate(total=Sum('amount'))['total'] or 0
-        
-        # Отработанные часы
-        hours = TimeEntry.objects.filter(
-            lawyer=lawyer,
-            start_time__gte=period_start,
-            start_time__lte=period_end
-        ).aggregate(total=Sum('duration'))['total'] or 0
-        
-        # Процент успешных дел
-        successful_cases = cases.filter(stage='closed').count()
-        success_rate = (successful_cases / cases.count() * 100) if cases.count() > 0 else 0
+        # Выручка и дела юриста за период одним запросом
+        lawyer = _bonus_statistics(period_start, period_end).get(id=lawyer_id)
         
-        # Расчет бонуса
-        base_bonus = 0
-        efficiency = revenue / (hours * lawyer.hourly_rate) if hours > 0 and lawyer.hourly_rate > 0 else 0
+        # Отработанные часы и себестоимость из дневной свертки
+        daily_costs = lawyer_daily_costs(_bonus_time_entries(period_start, period_end).filter(lawyer=lawyer))
+        hours = sum((row['hours'] for row in daily_costs), Decimal('0'))
+        cost = sum((row['cost'] or 0 for row in daily_costs), Decimal('0'))
         
-        if efficiency > 1.5:  # Высокая эффективность
-            base_bonus = revenue * 0.1  # 10% от выручки
-        elif efficiency > 1.2:
-            base_bonus = revenue * 0.07  # 7% от выручки
-        elif efficiency > 1.0:
-            base_bonus = revenue * 0.05  # 5% от выручки
-        
-        # Дополнительный бонус за высокий процент успешных дел
-        success_bonus = 0
-        if success_rate > 90:
-            success_bonus = base_bonus * 0.5  # +50% к бонусу
-        elif success_rate > 80:
-            success_bonus = base_bonus * 0.3  # +30% к бонусу
-        elif success_rate > 70:
-            success_bonus = base_bonus * 0.1  # +10% к бонусу
-        
-        total_bonus = base_bonus + success_bonus
-        
-        return {
-            'lawyer': lawyer.get_full_name(),
-            'period': f'{period_start.strftime("%d.%m.%Y")} - {period_end.strftime("%d.%m.%Y")}',
-            'revenue': round(revenue, 2),
-            'hours': round(hours, 2),
-            'efficiency': round(efficiency, 2),
-            'success_rate': round(success_rate, 1),
-            'base_bonus': round(base_bonus, 2),
-            'success_bonus': round(success_bonus, 2),
-            'total_bonus': round(total_bonus, 2),
-        }
+        return _compute_bonus(lawyer, hours, cost, period_start, period_end)
     
     except CustomUser.DoesNotExist:
         return None
 
-def sync_calendar_with_external(user_id, service='google'):
-    """Синхронизация календаря с внешними сервисами"""
-    # Заглушка для интеграции с Google Calendar, Outlook и т.д.
-    # В реальной реализации здесь будет API вызов
+def calculate_payroll(period_start, period_end):
+    """
+    Бонусы всех активных юристов за период за два запроса:
+    статистика юристов и дневная свертка часов. Цифры совпадают с calculate_lawyer_bonus.
+    """
+    hours = {}
+    costs = {}
+    for row in lawyer_daily_costs(_bonus_time_entries(period_start, period_end).filter(lawyer__role='lawyer')):
+        hours[row['lawyer']] = hours.get(row['lawyer'], Decimal('0')) + row['hours']
+        costs[row['lawyer']] = costs.get(row['lawyer'], Decimal('0')) + (row['cost'] or 0)
     
-    user = CustomUser.objects.get(id=user_id)
+    payroll = []
+    for lawyer in _bonus_statistics(period_start, period_end).filter(is_active=True).order_by('last_name', 'first_name', 'id'):
+        bonus = _compute_bonus(
+            lawyer,
+            hours.get(lawyer.id, Decimal('0')),
+            costs.get(lawyer.id, Decimal('0')),
+            period_start,
+            period_end
+        )
+        bonus['lawyer_id'] = lawyer.id
+        payroll.append(bonus)
+    return payroll
+
+PAYROLL_COLUMNS = (
+    ('lawyer', 'Юрист'),
+    ('revenue', 'Выручка'),
+    ('hours', 'Часы'),
+    ('cost', 'Себестоимость'),
+    ('efficiency', 'Эффективность'),
+    ('success_rate', 'Успешные дела, %'),
+    ('base_bonus', 'Базовый бонус'),
+    ('success_bonus', 'Бонус за успех'),
+    ('total_bonus', 'Итого бонус'),
+)
+
+def write_payroll_xlsx(payroll, output):
+    """Ведомость бонусов в XLSX (write-only режим openpyxl, строки пишутся потоком)"""
+    from openpyxl import Workbook
     
-    # Для примера, просто возвращаем статус
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Бонусы')
+    sheet.append([label for _, label in PAYROLL_COLUMNS])
+    total = Decimal('0')
+    for row in payroll:
+        sheet.append([row[key] for key, _ in PAYROLL_COLUMNS])
+        total += row['total_bonus']
+    sheet.append(['Итого'] + [None] * (len(PAYROLL_COLUMNS) - 2) + [total])
+    workbook.save(output)
+    return output
+
+def payroll_bounds(date_from, date_to):
+    """Период ведомости по датам включительно: от начала date_from до конца date_to"""
+    start, end = local_day_range(date_from, date_to)
+    return start, end - timedelta(microseconds=1)
+
+def payroll_file_name(period_start, period_end):
+    return f'payroll/payroll_{period_start.strftime("%Y%m%d")}_{period_end.strftime("%Y%m%d")}.xlsx'
+
+def sync_calendar_with_external(user_id, service='google', client=None):
+    """
+    Синхронизация календаря с внешним сервисом: изменения с последней
+    синхронизации по токену (crm.calendar_sync). Клиент сервиса берется из
+    CALENDAR_SYNC_CLIENTS, если не передан.
+    """
+    user = CustomUser.objects.get(id=user_id)
+    try:
+        changes = sync_external(user, service, client)
+    except LookupError as error:
+        return {
+            'user': user.get_full_name(),
+            'service': service,
+            'status': 'not_configured',
+            'message': str(error),
+        }
     return {
         'user': user.get_full_name(),
         'service': service,
-        'status': 'not_implemented',
-        'message': 'Функция синхронизации календаря находится в разработке',
+        'status': 'ok',
+        'changes': changes,
         'last_sync': timezone.now().isoformat()
     }
\ No newline at end of file
@@ -1,27 +1,43 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+from django.views.decorators.http import condition
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView, TemplateView
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
 from django.db.models import Sum, Count, Q
 from django.utils import timezone
-from django.http import JsonResponse
+from django.utils.dateparse import parse_date
+from django.http import JsonResponse, FileResponse, HttpResponse, Http404
+from django.core.files.storage import default_storage
 from django.core.paginator import Paginator
 import json
 from datetime import datetime, timedelta
 from .models import *
 from .forms import *
-from .utils import generate_analytics
+from .utils import (
+    generate_analytics, compose_analytics, revenue_series, hours_series, SERIES_GRANULARITIES,
+    payroll_bounds, payroll_file_name, local_day_range, filter_case_list,
+)
+from .analytics_cache import get_cached_analytics, analytics_cache_stats
+from .profiling import query_budget
+from .pagination import KeysetPaginationMixin, InvalidCursor, keyset_results
+from . import case_export, search, calendar_feed, calendar_sync
+from .exports import EXPORTS, EXPORT_FORMATS, export_response
+from .facets import case_facets
+from .task_bulk import BulkTaskError, bulk_update_tasks
+from .recurrence import RecurrenceError
+from .free_busy import MAX_FREE_BUSY_USERS, free_busy, serialize_interval
 
 class DashboardView(LoginRequiredMixin, TemplateView):
     template_name = 'crm/dashboard.html'
+    query_budget = 20
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         user = self.request.user
         
         # Общая статистика
-        today = timezone.now().date()
+        today = timezone.localdate()
         month_start = today.replace(day=1)
         
         if user.role in ['admin', 'manager']:
@@ -32,23 +48,29 @@ class DashboardView(LoginRequiredMixin, TemplateView):
                 stage__in=['consultation', 'analysis', 'negotiation', 'lawsuit', 'court']
             ).count()
             context['total_clients'] = Client.objects.count()
+            # Диапазоны вместо __month/__year и __date: функция над столбцом не дает использовать индекс
             context['monthly_revenue'] = Payment.objects.filter(
-                payment_date__month=today.month,
-                payment_date__year=today.year,
+                payment_date__gte=month_start,
+                payment_date__lt=(month_start + timedelta(days=32)).replace(day=1),
                 is_paid=True
             ).aggregate(total=Sum('amount'))['total'] or 0
             
-            # Дела с приближающимися дедлайнами
+            # Дела с приближающимися дедлайнами: с начала сегодняшнего дня (местного) на неделю вперед
+            deadlines_start, deadlines_end = local_day_range(today, today + timedelta(days=7))
             context['upcoming_deadlines'] = Task.objects.filter(
                 status__in=['todo', 'in_progress'],
-                due_date__gte=today,
-                due_date__lte=today + timedelta(days=7)
+                due_date__gte=deadlines_start,
+                due_date__lt=deadlines_end
             ).order_by('due_date')[:10]
             
             # Календарь событий на сегодня
-            context['today_events'] = CalendarEvent.objects.filter(
-                start_time__date=today
-            ).order_by('start_time')
+            day_start, day_end = local_day_range(today, today)
+            context['today_events'] = [
+                occurrence for occurrence in calendar_feed.expand_occurrences(
+                    CalendarEvent.objects.filter(calendar_feed.window_filter(day_start, day_end)), day_start, day_end
+                )
+                if occurrence.start_time >= day_start
+            ]
             
         elif user.role == 'lawyer':
             # Для юристов
@@ -60,90 +82,156 @@ class DashboardView(LoginRequiredMixin, TemplateView):
                 assigned_to=user,
                 status__in=['todo', 'in_progress']
             ).count()
-            context['upcoming_meetings'] = CalendarEvent.objects.filter(
-                participants=user,
-                start_time__gte=today,
-                start_time__lte=today + timedelta(days=3)
-            ).order_by('start_time')
+            meetings_start, meetings_end = local_day_range(today, today + timedelta(days=3))
+            context['upcoming_meetings'] = [
+                occurrence for occurrence in calendar_feed.expand_occurrences(
+                    CalendarEvent.objects.filter(
+                        calendar_feed.window_filter(meetings_start, meetings_end), participants=user
+                    ),
+                    meetings_start, meetings_end
+                )
+                if occurrence.start_time >= meetings_start
+            ]
             
-        # Аналитика
-        context['analytics'] = generate_analytics(today)
+        # Аналитика (кэшируется, сбрасывается при изменении платежей, часов, дел и клиентов)
+        context['analytics'] = get_cached_analytics('month')
         
         return context
 
-class CaseListView(LoginRequiredMixin, ListView):
+class CaseListView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
     model = Case
     template_name = 'crm/case_list.html'
+    keyset_partial_template = 'crm/partials/case_rows.html'
+    query_budget = 16
     context_object_name = 'cases'
     paginate_by = 20
     
     def get_queryset(self):
-        queryset = Case.objects.filter(is_active=True).select_related('client', 'lawyer')
-        
-        # Фильтрация
-        stage = self.request.GET.get('stage')
-        lawyer_id = self.request.GET.get('lawyer')
-        search = self.request.GET.get('search')
-        
-        if stage:
-            queryset = queryset.filter(stage=stage)
-        if lawyer_id:
-            queryset = queryset.filter(lawyer_id=lawyer_id)
-        if search:
-            queryset = queryset.filter(
-                Q(title__icontains=search) |
-                Q(case_number__icontains=search) |
-                Q(client__user__first_name__icontains=search) |
-                Q(client__user__last_name__icontains=search)
-            )
-        
-        return queryset.order_by('-created_at')
+        # Фильтры общие с выгрузкой списка дел (crm.exports)
+        return filter_case_list(
+            Case.objects.filter(is_active=True).select_related('client', 'lawyer'), self.request.GET
+        )
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['lawyers'] = CustomUser.objects.filter(role='lawyer', is_active=True)
         context['stages'] = dict(Case.STAGE_CHOICES)
+        # Счетчики для боковой панели фильтров: два сгруппированных запроса или кэш
+        context['facets'] = case_facets(self.request.GET)
         return context
 
 class CaseDetailView(LoginRequiredMixin, DetailView):
+    """
+    Первая загрузка - только шапка дела. Разделы (коммуникации, документы, задачи,
+    платежи, время, события) подгружаются htmx-фрагментами CaseSectionView.
+    """
     model = Case
     template_name = 'crm/case_detail.html'
+    query_budget = 4
     context_object_name = 'case'
     
+    def get_queryset(self):
+        return Case.objects.select_related('client__user', 'lawyer')
+    
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        case = self.object
-        
-        # Коммуникации
-        context['communications'] = case.communications.all().order_by('-created_at')
-        
-        # Документы
-        context['documents'] = case.documents.all().order_by('-uploaded_at')
-        
-        # Задачи
-        context['tasks'] = case.tasks.all().order_by('-due_date')
-        
-        # Платежи
-        context['payments'] = case.payments.all().order_by('-payment_date')
-        
-        # Затраты времени
-        context['time_entries'] = case.time_entries.all().order_by('-start_time')
-        
-        # События календаря
-        context['calendar_events'] = case.calendar_events.all().order_by('start_time')
-        
-        # Формы
-        context['communication_form'] = CommunicationForm()
-        context['document_form'] = DocumentForm()
-        context['task_form'] = TaskForm()
-        context['payment_form'] = PaymentForm()
-        
+        context['sections'] = [
+            {
+                'key': key,
+                'title': section['title'],
+                'url': reverse('case_section', kwargs={'pk': self.object.pk, 'section': key}),
+            }
+            for key, section in CaseSectionView.SECTIONS.items()
+        ]
+        return context
+
+class CaseSectionView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
+    """
+    Раздел карточки дела для htmx: постранично по курсору, связанные пользователи
+    загружаются в том же запросе. Первая страница содержит форму добавления,
+    следующие - только строки и ссылку next_page_url.
+    """
+    SECTIONS = {
+        'communications': {
+            'title': 'Коммуникации',
+            'ordering': ('-created_at', '-id'),
+            'select_related': ('created_by',),
+            'prefetch_related': ('participants',),
+            'form': CommunicationForm,
+        },
+        'documents': {
+            'title': 'Документы',
+            'ordering': ('-uploaded_at', '-id'),
+            'select_related': ('uploaded_by',),
+            'form': DocumentForm,
+        },
+        'tasks': {
+            'title': 'Задачи',
+            'ordering': ('-due_date', '-id'),
+            'select_related': ('assigned_to', 'assigned_by'),
+            'form': TaskForm,
+        },
+        'payments': {
+            'title': 'Платежи',
+            'ordering': ('-payment_date', '-id'),
+            'form': PaymentForm,
+        },
+        'time_entries': {
+            'title': 'Затраты времени',
+            'ordering': ('-start_time', '-id'),
+            'select_related': ('lawyer', 'task'),
+        },
+        'calendar_events': {
+            'title': 'События',
+            'ordering': ('start_time', 'id'),
+            'select_related': ('created_by',),
+            'prefetch_related': ('participants',),
+        },
+    }
+    
+    context_object_name = 'items'
+    paginate_by = 25
+    query_budget = 6
+    
+    def keyset_mode(self):
+        return True
+    
+    def dispatch(self, request, *args, **kwargs):
+        if kwargs['section'] not in self.SECTIONS:
+            raise Http404('Неизвестный раздел')
+        self.section = self.SECTIONS[kwargs['section']]
+        self.keyset_ordering = self.section['ordering']
+        return super().dispatch(request, *args, **kwargs)
+    
+    def get_template_names(self):
+        return [f"crm/partials/case_{self.kwargs['section']}.html"]
+    
+    def get_queryset(self):
+        self.case = get_object_or_404(Case, pk=self.kwargs['pk'])
+        return getattr(self.case, self.kwargs['section']).select_related(
+            *self.section.get('select_related', ())
+        ).prefetch_related(*self.section.get('prefetch_related', ()))
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['case'] = self.case
+        context['section'] = self.kwargs['section']
+        context['is_first_page'] = not self.request.GET.get('cursor')
+        form_class = self.section.get('form')
+        if form_class and context['is_first_page']:
+            form = form_class()
+            if 'case' in form.fields:
+                # Выбор из всех дел фирмы не нужен - задача создается для этого дела
+                form.fields['case'].queryset = Case.objects.filter(pk=self.case.pk)
+                form.initial['case'] = self.case.pk
+            context['form'] = form
         return context
 
 class TaskCreateView(LoginRequiredMixin, CreateView):
     model = Task
     form_class = TaskForm
     template_name = 'crm/task_form.html'
+    query_budget = 6
     success_url = reverse_lazy('task_list')
     
     def form_valid(self, form):
@@ -151,36 +239,43 @@ class TaskCreateView(LoginRequiredMixin, CreateView):
         return super().form_valid(form)
 
 class CalendarView(LoginRequiredMixin, TemplateView):
+    """
+    Страница календаря: в HTML встраиваются только события текущего окна
+    (?view=month|week|day&date=), соседние окна клиент подгружает из ленты
+    api_calendar_events.
+    """
     template_name = 'crm/calendar.html'
+    query_budget = 5
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        user = self.request.user
-        
-        # Получение событий календаря
-        events = CalendarEvent.objects.filter(
-            Q(participants=user) | Q(created_by=user)
-        ).distinct().order_by('start_time')
-        
-        # Преобразование в формат для FullCalendar
-        context['events_json'] = json.dumps([
-            {
-                'id': event.id,
-                'title': event.title,
-                'start': event.start_time.isoformat(),
-                'end': event.end_time.isoformat() if event.end_time else None,
-                'color': event.color,
-                'description': event.description,
-                'type': event.event_type,
-                'case': event.case.title if event.case else None,
-            }
-            for event in events
-        ])
+        view = self.request.GET.get('view')
+        if view not in calendar_feed.CALENDAR_VIEWS:
+            view = 'month'
+        day = parse_date(self.request.GET.get('date') or '') or timezone.localdate()
+        start, end = calendar_feed.view_window(view, day)
         
+        # Для {{ calendar_initial|json_script:"calendar-initial" }}
+        context['calendar_initial'] = {
+            'view': calendar_feed.CALENDAR_VIEWS[view],
+            'date': day.isoformat(),
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'feed_url': reverse('api_calendar_events'),
+            'events': [
+                calendar_feed.serialize_event(occurrence)
+                for occurrence in calendar_feed.user_occurrences(self.request.user, start, end)
+            ],
+        }
+        # Адрес подписки на календарь для внешних клиентов
+        context['ics_url'] = self.request.build_absolute_uri(
+            reverse('api_calendar_ics', kwargs={'token': self.request.user.calendar_token})
+        )
         return context
 
 class AnalyticsView(LoginRequiredMixin, UserPassesTestMixin, TemplateView):
     template_name = 'crm/analytics.html'
+    query_budget = 15
     
     def test_func(self):
         return self.request.user.role in ['admin', 'manager']
@@ -193,55 +288,180 @@ class AnalyticsView(LoginRequiredMixin, UserPassesTestMixin, TemplateView):
         date_from = self.request.GET.get('date_from')
         date_to = self.request.GET.get('date_to')
         
-        # Генерация аналитики
-        context['analytics_data'] = generate_analytics(
+        # Аналитика из материализованных срезов
+        context['analytics_data'] = compose_analytics(
             period=period,
             date_from=date_from,
             date_to=date_to
         )
         
-        # Распределение по юристам
-        lawyers = CustomUser.objects.filter(role='lawyer', is_active=True)
-        lawyer_stats = []
-        
-        for lawyer in lawyers:
-            cases_count = Case.objects.filter(lawyer=lawyer).count()
-            total_hours = TimeEntry.objects.filter(
-                lawyer=lawyer,
-                start_time__date__gte=date_from if date_from else timezone.now() - timedelta(days=30)
-            ).aggregate(total=Sum('duration'))['total'] or 0
-            
-            revenue = Payment.objects.filter(
-                case__lawyer=lawyer,
-                is_paid=True,
-                payment_date__gte=date_from if date_from else timezone.now() - timedelta(days=30)
-            ).aggregate(total=Sum('amount'))['total'] or 0
-            
-            lawyer_stats.append({
+        # Распределение по юристам (один запрос на всех юристов)
+        stats_from = parse_date(date_from) if date_from else timezone.now() - timedelta(days=30)
+        lawyers = CustomUser.objects.lawyers().with_statistics(date_from=stats_from)
+        lawyer_stats = [
+            {
                 'lawyer': lawyer,
-                'cases_count': cases_count,
-                'total_hours': total_hours,
-                'revenue': revenue,
-                'efficiency': revenue / (lawyer.hourly_rate * total_hours) if total_hours > 0 else 0
-            })
+                'cases_count': lawyer.cases_count,
+                'total_hours': lawyer.total_hours,
+                'revenue': lawyer.revenue,
+                'efficiency': lawyer.efficiency,
+            }
+            for lawyer in lawyers
+        ]
         
         context['lawyer_stats'] = lawyer_stats
         
         return context
 
+class ClientRankingView(LoginRequiredMixin, UserPassesTestMixin, ListView):
+    """Отчет «Клиенты по выручке» (а также по делам и задолженности) с постраничным выводом"""
+    template_name = 'crm/client_ranking.html'
+    query_budget = 5
+    context_object_name = 'clients'
+    paginate_by = 50
+    
+    def test_func(self):
+        return self.request.user.role in ['admin', 'manager']
+    
+    def get_ranking(self):
+        ranking = self.request.GET.get('by', 'revenue')
+        return ranking if ranking in dict(Client.RANKING_CHOICES) else 'revenue'
+    
+    def get_queryset(self):
+        return Client.objects.ranked(
+            self.get_ranking(),
+            date_from=parse_date(self.request.GET.get('date_from') or ''),
+            date_to=parse_date(self.request.GET.get('date_to') or '')
+        )
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['ranking'] = self.get_ranking()
+        context['rankings'] = dict(Client.RANKING_CHOICES)
+        return context
+
 # API Views
+@query_budget(4)
+@login_required
+@condition(etag_func=calendar_feed.feed_etag, last_modified_func=calendar_feed.feed_last_modified)
 def get_calendar_events(request):
-    """API для получения событий календаря"""
-    start = request.GET.get('start')
-    end = request.GET.get('end')
+    """
+    API событий календаря пользователя для FullCalendar: ?start=&end= (ISO 8601).
+    События, пересекающие окно; неизменное окно - 304 по ETag/Last-Modified.
+    """
+    window = calendar_feed.parse_window(request.GET)
+    if window is None:
+        return JsonResponse({'success': False, 'error': 'Некорректное окно'}, status=400)
+    
+    events = [
+        calendar_feed.serialize_event(occurrence) for occurrence in calendar_feed.user_occurrences(request.user, *window)
+    ]
+    response = JsonResponse(events, safe=False)
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+@query_budget(4)
+@condition(etag_func=calendar_sync.ics_etag)
+def calendar_ics(request, token):
+    """ICS-лента календаря пользователя по секретному адресу (подписка без входа)"""
+    user = get_object_or_404(CustomUser, calendar_token=token, is_active=True)
+    response = HttpResponse(calendar_sync.ics_calendar(user), content_type='text/calendar; charset=utf-8')
+    response['Content-Disposition'] = 'inline; filename="calendar.ics"'
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+@query_budget(5)
+@login_required
+def calendar_sync_delta(request):
+    """
+    Изменения календаря для синхронизации: без ?token= - полная выгрузка,
+    с токеном - только изменения и удаления после него. 410 - токен устарел,
+    нужна полная синхронизация.
+    """
+    try:
+        delta = calendar_sync.calendar_delta(request.user, request.GET.get('token'))
+    except calendar_sync.SyncTokenExpired as error:
+        return JsonResponse({'success': False, 'error': str(error)}, status=410)
+    except calendar_sync.SyncTokenError as error:
+        return JsonResponse({'success': False, 'error': str(error)}, status=400)
+    return JsonResponse({'success': True, **delta})
+
+@query_budget(4)
+@login_required
+def free_busy_search(request):
+    """
+    Занятость и общие свободные окна: ?users=1,2,3&start=&end=
+    &duration=60 (минут, свободное окно не короче)&working_hours=0|1.
+    Возвращает только интервалы занятости, без названий событий.
+    """
+    if request.user.role == 'client':
+        return JsonResponse({'success': False}, status=403)
+    window = calendar_feed.parse_window(request.GET)
+    if window is None:
+        return JsonResponse({'success': False, 'error': 'Некорректное окно'}, status=400)
+    try:
+        user_ids = [int(user_id) for user_id in request.GET.get('users', '').split(',') if user_id] or [request.user.pk]
+        duration = timedelta(minutes=max(int(request.GET.get('duration', 60)), 1))
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Некорректные параметры'}, status=400)
+    if len(user_ids) > MAX_FREE_BUSY_USERS:
+        return JsonResponse({'success': False, 'error': f'Не более {MAX_FREE_BUSY_USERS} пользователей'}, status=400)
+    
+    result = free_busy(user_ids, *window, min_duration=duration,
+                       only_working_hours=request.GET.get('working_hours') != '0')
+    return JsonResponse({
+        'success': True,
+        'busy': {user_id: [serialize_interval(*item) for item in busy] for user_id, busy in result['busy'].items()},
+        'free': [serialize_interval(*item) for item in result['free']],
+    })
+
+@query_budget(6)
+@login_required
+def calendar_occurrence_update(request, pk):
+    """
+    Изменение одного повторения серии, POST с JSON:
+    {"original_start": ..., "cancel": true} - отмена,
+    {"original_start": ..., "restore": true} - вернуть как в серии,
+    {"original_start": ..., "title", "description", "location", "start", "end"} - изменение.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False}, status=405)
+    event = get_object_or_404(CalendarEvent, pk=pk)
+    if event.created_by_id != request.user.pk and request.user.role not in ['admin', 'manager']:
+        return JsonResponse({'success': False}, status=403)
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return JsonResponse({'success': False, 'error': 'Ожидается JSON-объект'}, status=400)
     
-    events = CalendarEvent.objects.filter(
-        start_time__gte=start,
-        end_time__lte=end
-    ).values('id', 'title', 'start_time', 'end_time', 'color', 'event_type')
+    original_start = calendar_feed.parse_moment(data.get('original_start'))
+    if original_start is None:
+        return JsonResponse({'success': False, 'error': 'Не указано повторение'}, status=400)
+    if data.get('restore'):
+        for override in event.overrides.filter(original_start=original_start):
+            override.delete()
+        return JsonResponse({'success': True})
     
-    return JsonResponse(list(events), safe=False)
+    changes = {field: str(data[field]) for field in ('title', 'description', 'location') if data.get(field)}
+    for key, field in (('start', 'start_time'), ('end', 'end_time')):
+        if data.get(key):
+            changes[field] = calendar_feed.parse_moment(data[key])
+            if changes[field] is None:
+                return JsonResponse({'success': False, 'error': 'Некорректное время'}, status=400)
+    try:
+        override = calendar_feed.save_occurrence_override(event, original_start, cancel=bool(data.get('cancel')), **changes)
+    except RecurrenceError as error:
+        return JsonResponse({'success': False, 'error': str(error)}, status=400)
+    if override.is_cancelled:
+        return JsonResponse({'success': True})
+    return JsonResponse({
+        'success': True,
+        'event': calendar_feed.serialize_event(calendar_feed.Occurrence(event, original_start, override)),
+    })
 
+@query_budget(5)
 def update_task_status(request, task_id):
     """API для обновления статуса задачи"""
     if request.method == 'POST':
@@ -252,8 +472,284 @@ def update_task_status(request, task_id):
             task.status = status
             if status == 'done':
                 task.completed_at = timezone.now()
-            task.save()
+            task.save(update_fields=['status', 'completed_at'])
             
             return JsonResponse({'success': True})
     
-    return JsonResponse({'success': False}, status=400)
\ No newline at end of file
+    return JsonResponse({'success': False}, status=400)
+
+@query_budget(10)
+@login_required
+def bulk_task_update(request):
+    """
+    Массовые операции с задачами, POST с JSON:
+    {"operation": "status|assign|shift_due|priority", "value": ..., "ids": [...]}
+    или вместо ids "filter": {"status", "priority", "assigned_to", "case"}.
+    Ответ - результат по каждой задаче: updated, unchanged или not_found.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False}, status=405)
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return JsonResponse({'success': False, 'error': 'Ожидается JSON-объект'}, status=400)
+    
+    try:
+        results = bulk_update_tasks(
+            request.user, data.get('operation'), data.get('value'), ids=data.get('ids'), filters=data.get('filter')
+        )
+    except BulkTaskError as error:
+        return JsonResponse({'success': False, 'error': str(error)}, status=400)
+    return JsonResponse({
+        'success': True,
+        'updated': sum(result == 'updated' for result in results.values()),
+        'results': results,
+    })
+
+@query_budget(3)
+@login_required
+def analytics_cache_status(request):
+    """API со счетчиками кэша аналитики"""
+    if request.user.role not in ['admin', 'manager']:
+        return JsonResponse({'success': False}, status=403)
+    
+    return JsonResponse(analytics_cache_stats())
+
+@query_budget(6)
+@login_required
+def top_clients(request):
+    """API рейтинга клиентов: ?by=revenue|cases|outstanding&page=N&page_size=M"""
+    if request.user.role not in ['admin', 'manager']:
+        return JsonResponse({'success': False}, status=403)
+    
+    ranking = request.GET.get('by', 'revenue')
+    if ranking not in dict(Client.RANKING_CHOICES):
+        return JsonResponse({'success': False, 'error': 'Неизвестный рейтинг'}, status=400)
+    
+    try:
+        page_size = min(max(int(request.GET.get('page_size', 10)), 1), 100)
+    except ValueError:
+        page_size = 10
+    
+    clients = Client.objects.ranked(
+        ranking,
+        date_from=parse_date(request.GET.get('date_from') or ''),
+        date_to=parse_date(request.GET.get('date_to') or '')
+    )
+    page = Paginator(clients, page_size).get_page(request.GET.get('page'))
+    
+    return JsonResponse({
+        'success': True,
+        'by': ranking,
+        'page': page.number,
+        'num_pages': page.paginator.num_pages,
+        'count': page.paginator.count,
+        'results': [
+            {
+                'rank': page.start_index() + index,
+                'id': client.id,
+                'name': client.user.get_full_name() or client.user.username,
+                'company_name': client.company_name,
+                'revenue': str(client.revenue),
+                'outstanding': str(client.outstanding),
+                'cases_count': client.cases_count,
+            }
+            for index, client in enumerate(page.object_list)
+        ],
+    })
+
+@query_budget(6)
+@login_required
+def analytics_series(request):
+    """API временных рядов для графиков: ?start_date=&end_date=&granularity=day|week|month|quarter"""
+    if request.user.role not in ['admin', 'manager']:
+        return JsonResponse({'success': False}, status=403)
+    
+    end_date = parse_date(request.GET.get('end_date') or '') or timezone.localdate()
+    start_date = parse_date(request.GET.get('start_date') or '') or end_date - timedelta(days=365)
+    granularity = request.GET.get('granularity', 'month')
+    if granularity not in SERIES_GRANULARITIES or start_date > end_date:
+        return JsonResponse({'success': False}, status=400)
+    
+    revenue = revenue_series(start_date, end_date, granularity)
+    hours = hours_series(start_date, end_date, granularity)
+    
+    case_types = dict(Case.TYPE_CHOICES)
+    # Диапазон вместо __date: функция над столбцом не дает использовать индекс
+    start, end = local_day_range(start_date, end_date)
+    distribution = Case.objects.filter(
+        created_at__gte=start,
+        created_at__lt=end
+    ).order_by().values('case_type').annotate(count=Count('id'))
+    
+    return JsonResponse({
+        'success': True,
+        'granularity': granularity,
+        'months': [bucket['label'] for bucket in revenue],
+        'revenue': [float(bucket['value']) for bucket in revenue],
+        'hours': [float(bucket['value']) for bucket in hours],
+        'case_distribution': {
+            'labels': [case_types.get(row['case_type'], row['case_type']) for row in distribution],
+            'values': [row['count'] for row in distribution],
+        },
+    })
+
+@query_budget(4)
+@login_required
+def payroll_export(request):
+    """
+    API ведомости бонусов за период ?period_start=&period_end= (YYYY-MM-DD).
+    POST ставит расчет в очередь Celery, GET отдает готовый XLSX.
+    """
+    if request.user.role not in ['admin', 'manager']:
+        return JsonResponse({'success': False}, status=403)
+    
+    params = request.POST if request.method == 'POST' else request.GET
+    period_start = parse_date(params.get('period_start') or '')
+    period_end = parse_date(params.get('period_end') or '')
+    if not period_start or not period_end or period_start > period_end:
+        return JsonResponse({'success': False, 'error': 'Некорректный период'}, status=400)
+    
+    if request.method == 'POST':
+        from .tasks import generate_payroll
+        generate_payroll.delay(period_start.isoformat(), period_end.isoformat())
+        return JsonResponse({'success': True, 'status': 'pending'}, status=202)
+    
+    file_name = payroll_file_name(*payroll_bounds(period_start, period_end))
+    if not default_storage.exists(file_name):
+        return JsonResponse({'success': False, 'status': 'not_ready'}, status=404)
+    return FileResponse(default_storage.open(file_name, 'rb'), as_attachment=True, filename=file_name.split('/')[-1])
+
+@query_budget(4)
+@login_required
+def case_report_export(request, pk):
+    """
+    API выгрузки отчета по делу ?format=pdf|xlsx.
+    POST ставит построение в очередь Celery (готовый файл текущей версии не
+    перестраивается), GET отдает статус, GET с ?download=1 - файл.
+    """
+    cases = Case.objects.select_related('client__user', 'lawyer')
+    if request.user.role == 'client':
+        cases = cases.filter(client__user=request.user)
+    case = get_object_or_404(cases, pk=pk)
+    
+    params = request.POST if request.method == 'POST' else request.GET
+    report_format = params.get('format', 'pdf')
+    if report_format not in case_export.REPORT_FORMATS:
+        return JsonResponse({'success': False, 'error': 'Неизвестный формат'}, status=400)
+    
+    status = case_export.report_status(case, report_format)
+    if request.method == 'POST' and status in ['missing', 'failed']:
+        from .tasks import export_case_report
+        case_export.mark_report_pending(case, report_format)
+        export_case_report.delay(case.pk, report_format)
+        status = 'pending'
+    
+    if request.GET.get('download'):
+        if status != 'ready':
+            return JsonResponse({'success': False, 'status': status}, status=404)
+        file_name = case_export.report_file_name(case, report_format)
+        return FileResponse(default_storage.open(file_name, 'rb'), as_attachment=True, filename=file_name.split('/')[-1])
+    
+    data = {'success': True, 'status': status}
+    if status == 'ready':
+        data['download_url'] = f"{reverse('api_case_report', kwargs={'pk': case.pk})}?format={report_format}&download=1"
+    return JsonResponse(data, status=202 if status == 'pending' else 200)
+
+@query_budget(14)
+@login_required
+def global_search(request):
+    """
+    Подсказки поиска по делам, клиентам, задачам и документам: ?q=&seq=.
+    seq возвращается как есть - клиент показывает только ответ на последний запрос.
+    """
+    return JsonResponse({
+        'seq': request.GET.get('seq'),
+        'query': request.GET.get('q', ''),
+        'results': search.global_search(request.user, request.GET.get('q', '')),
+    })
+
+@login_required
+def export_list(request, kind):
+    """
+    Выгрузка списка (cases, tasks, time_entries, payments) ?format=csv|xlsx
+    с фильтрами списка: для дел - как в CaseListView, для остальных - см. crm.exports
+    """
+    if request.user.role not in ['admin', 'manager']:
+        return JsonResponse({'success': False}, status=403)
+    if kind not in EXPORTS:
+        raise Http404('Неизвестная выгрузка')
+    
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'success': False, 'error': 'Неизвестный формат'}, status=400)
+    return export_response(kind, export_format, request.GET)
+
+def _keyset_json(request, queryset, serialize, ordering=('-created_at', '-id')):
+    try:
+        return JsonResponse(keyset_results(request, queryset, serialize, ordering))
+    except InvalidCursor:
+        return JsonResponse({'success': False, 'error': 'Некорректный курсор'}, status=400)
+
+@query_budget(4)
+@login_required
+def task_list(request):
+    """API задач с курсором: ?status=&assigned_to=&cursor=&page_size="""
+    tasks = Task.objects.select_related('assigned_to')
+    if request.user.role not in ['admin', 'manager']:
+        tasks = tasks.filter(assigned_to=request.user)
+    elif request.GET.get('assigned_to'):
+        tasks = tasks.filter(assigned_to_id=request.GET['assigned_to'])
+    if request.GET.get('status'):
+        tasks = tasks.filter(status=request.GET['status'])
+    
+    return _keyset_json(request, tasks, lambda task: {
+        'id': task.id,
+        'title': task.title,
+        'status': task.status,
+        'priority': task.priority,
+        'due_date': task.due_date,
+        'case_id': task.case_id,
+        'assigned_to_name': task.assigned_to.get_full_name() or task.assigned_to.username,
+    })
+
+@query_budget(4)
+@login_required
+def notification_list(request):
+    """API уведомлений текущего пользователя с курсором: ?unread=1&cursor=&page_size="""
+    notifications = Notification.objects.filter(user=request.user)
+    if request.GET.get('unread'):
+        notifications = notifications.filter(is_read=False)
+    
+    return _keyset_json(request, notifications, lambda notification: {
+        'id': notification.id,
+        'title': notification.title,
+        'message': notification.message,
+        'notification_type': notification.notification_type,
+        'is_read': notification.is_read,
+        'created_at': notification.created_at,
+    })
+
+@query_budget(4)
+@login_required
+def time_entry_list(request):
+    """API записей времени с курсором (новые сначала): ?case=&lawyer=&cursor=&page_size="""
+    entries = TimeEntry.objects.select_related('lawyer')
+    if request.user.role not in ['admin', 'manager']:
+        entries = entries.filter(lawyer=request.user)
+    elif request.GET.get('lawyer'):
+        entries = entries.filter(lawyer_id=request.GET['lawyer'])
+    if request.GET.get('case'):
+        entries = entries.filter(case_id=request.GET['case'])
+    
+    return _keyset_json(request, entries, lambda entry: {
+        'id': entry.id,
+        'description': entry.description,
+        'duration': entry.duration,
+        'lawyer_name': entry.lawyer.get_full_name() or entry.lawyer.username,
+        'case_id': entry.case_id,
+        'start_time': entry.start_time,
+        'billable': entry.billable,
+    }, ordering=('-start_time', '-id'))
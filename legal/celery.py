@@ -13,10 +13,18 @@ app.conf.beat_schedule = {
         'task': 'crm.tasks.send_task_reminders',
         'schedule': crontab(hour=9, minute=0),  # Каждый день в 9:00
     },
+    'send-event-reminders-every-day': {
+        'task': 'crm.tasks.send_event_reminders',
+        'schedule': crontab(hour=9, minute=0),  # События на следующие 24 часа
+    },
     'generate-daily-analytics': {
         'task': 'crm.tasks.generate_daily_analytics',
         'schedule': crontab(hour=0, minute=30),  # Каждый день в 00:30
     },
+    'prune-calendar-tombstones': {
+        'task': 'crm.tasks.prune_calendar_tombstones',
+        'schedule': crontab(day_of_week='sun', hour=1, minute=0),  # Каждое воскресенье в 01:00
+    },
     'cleanup-old-notifications': {
         'task': 'crm.tasks.cleanup_old_notifications',
         'schedule': crontab(day_of_month='1', hour=0, minute=0),  # 1-го числа каждого месяца
@@ -41,6 +41,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django_htmx.middleware.HtmxMiddleware',
+    'crm.profiling.SQLProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'legal.urls'
@@ -76,6 +77,15 @@ DATABASES = {
     }
 }
 
+# Локальная работа и замеры без MySQL: DB_ENGINE=sqlite
+if os.getenv('DB_ENGINE') == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        }
+    }
+
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
     {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'},
@@ -111,6 +121,51 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Кэш: Redis из docker-compose, без него - память процесса
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Кэш аналитики (секунды)
+ANALYTICS_CACHE_TTL = 300
+ANALYTICS_CACHE_STALE_TTL = 3600
+ANALYTICS_CACHE_LOCK_TTL = 60
+
+# Кэш общего количества строк в списках с курсором (секунды)
+LIST_COUNT_CACHE_TTL = 60
+
+# Кэш счетчиков фасетов списка дел по набору фильтров (секунды)
+CASE_FACETS_CACHE_TTL = 30
+
+# Кэш подсказок глобального поиска по пользователю и запросу (секунды)
+GLOBAL_SEARCH_CACHE_TTL = 30
+
+# Выгрузка отчета по делу: шрифт PDF с кириллицей, время жизни статуса построения (секунды)
+CASE_REPORT_FONT = os.getenv('CASE_REPORT_FONT', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+CASE_REPORT_STATUS_TTL = 3600
+
+# Синхронизация календаря: срок жизни токена изменений и удаленных событий, возраст
+# изменения, после которого по нему продвигается токен (секунды), и клиенты внешних
+# календарей (сервис -> класс, см. crm.calendar_sync)
+CALENDAR_SYNC_TOKEN_TTL = 90 * 24 * 3600
+CALENDAR_SYNC_SETTLE = 10
+CALENDAR_SYNC_CLIENTS = {
+    'local': 'crm.calendar_sync.LocalCalendarClient',
+}
+
+# Профилирование SQL по запросам и задачам (заголовки X-DB-*, лог crm.profiling)
+SQL_PROFILING = os.getenv('SQL_PROFILING', 'False') == 'True'
+
 # Настройки Celery
 CELERY_BROKER_URL = os.getenv('REDIS_URL')
 CELERY_RESULT_BACKEND = 'django-db'
@@ -167,9 +167,9 @@ function showToast(message, type = 'info') {
 
 // Load time entries
 function loadTimeEntries() {
-    $.get('/api/time-entries/', function(data) {
+    $.get('/api/time-entries/', {case: $('.stop-tracking').data('case-id')}, function(data) {
         var html = '';
-        data.forEach(function(entry) {
+        data.results.forEach(function(entry) {
             html += `
                 <div class="timeline-item">
                     <h6 class="mb-1">${entry.description}</h6>
@@ -183,6 +183,156 @@ function loadTimeEntries() {
     });
 }
 
+// Global search (typeahead): a newer query aborts the previous request,
+// and only the response to the latest query is rendered
+var searchRequest = null;
+var searchSeq = 0;
+var SEARCH_GROUPS = {case: 'Дела', client: 'Клиенты', task: 'Задачи', document: 'Документы'};
+
+// Also escapes quotes: the result is used inside attribute values too
+var HTML_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'};
+
+function escapeHtml(text) {
+    return String(text || '').replace(/[&<>"']/g, function(char) {
+        return HTML_ESCAPES[char];
+    });
+}
+
+function performSearch(searchTerm) {
+    var seq = ++searchSeq;
+    var results = $('.search-results');
+    if (searchRequest) {
+        searchRequest.abort();
+        searchRequest = null;
+    }
+    if (!searchTerm) {
+        results.empty().hide();
+        return;
+    }
+    
+    searchRequest = $.get('/api/search/', {q: searchTerm, seq: seq}, function(data) {
+        if (Number(data.seq) !== searchSeq) {
+            return;
+        }
+        var html = '';
+        $.each(SEARCH_GROUPS, function(kind, title) {
+            var items = data.results[kind] || [];
+            if (!items.length) {
+                return;
+            }
+            html += `<h6 class="dropdown-header">${title}</h6>`;
+            items.forEach(function(item) {
+                html += `
+                    <a class="dropdown-item" href="${escapeHtml(item.url || '#')}">
+                        ${escapeHtml(item.title)}
+                        <small class="text-muted d-block">${escapeHtml(item.subtitle)}</small>
+                    </a>
+                `;
+            });
+        });
+        results.html(html || '<span class="dropdown-item-text text-muted">Ничего не найдено</span>').show();
+    });
+}
+
+// Calendar: the page embeds only the current window, other windows are loaded
+// from the feed and kept in a client cache; neighbouring windows are prefetched
+var CALENDAR_CACHE_TTL = 5 * 60 * 1000;
+var calendarCache = {ranges: [], events: {}, pending: {}};
+
+function calendarCovered(start, end) {
+    var now = Date.now();
+    return calendarCache.ranges.some(function(range) {
+        return range.start <= start && range.end >= end && now - range.loadedAt < CALENDAR_CACHE_TTL;
+    });
+}
+
+function calendarStore(start, end, events) {
+    // Events of the window not returned by the server were deleted
+    $.each(calendarCache.events, function(id, event) {
+        if (Date.parse(event.start) < end && Date.parse(event.end) > start) {
+            delete calendarCache.events[id];
+        }
+    });
+    events.forEach(function(event) {
+        calendarCache.events[event.id] = event;
+    });
+    
+    // Merge overlapping loaded ranges, a merged range is as old as its oldest part
+    var ranges = calendarCache.ranges.concat([{start: start, end: end, loadedAt: Date.now()}]);
+    ranges.sort(function(a, b) { return a.start - b.start; });
+    calendarCache.ranges = ranges.reduce(function(merged, range) {
+        var last = merged[merged.length - 1];
+        if (last && range.start <= last.end) {
+            last.end = Math.max(last.end, range.end);
+            last.loadedAt = Math.min(last.loadedAt, range.loadedAt);
+        } else {
+            merged.push($.extend({}, range));
+        }
+        return merged;
+    }, []);
+}
+
+function calendarEventsIn(start, end) {
+    return $.map(calendarCache.events, function(event) {
+        return Date.parse(event.start) < end && Date.parse(event.end) > start ? event : null;
+    });
+}
+
+function loadCalendarWindow(feedUrl, start, end) {
+    var key = start + ':' + end;
+    if (!calendarCache.pending[key]) {
+        calendarCache.pending[key] = $.get(feedUrl, {
+            start: new Date(start).toISOString(),
+            end: new Date(end).toISOString()
+        }).done(function(events) {
+            calendarStore(start, end, events);
+        }).always(function() {
+            delete calendarCache.pending[key];
+        });
+    }
+    return calendarCache.pending[key];
+}
+
+function prefetchCalendarWindows(feedUrl, start, end) {
+    var span = end - start;
+    [[start - span, start], [end, end + span]].forEach(function(range) {
+        if (!calendarCovered(range[0], range[1])) {
+            loadCalendarWindow(feedUrl, range[0], range[1]);
+        }
+    });
+}
+
+function initCalendar() {
+    var calendarEl = document.getElementById('calendar');
+    var initialEl = document.getElementById('calendar-initial');
+    if (!calendarEl || !initialEl || typeof FullCalendar === 'undefined') {
+        return;
+    }
+    var initial = JSON.parse(initialEl.textContent);
+    calendarStore(Date.parse(initial.start), Date.parse(initial.end), initial.events);
+    
+    var calendar = new FullCalendar.Calendar(calendarEl, {
+        initialView: initial.view,
+        initialDate: initial.date,
+        firstDay: 1,
+        locale: 'ru',
+        events: function(info, success, failure) {
+            var start = info.start.getTime();
+            var end = info.end.getTime();
+            if (calendarCovered(start, end)) {
+                success(calendarEventsIn(start, end));
+                prefetchCalendarWindows(initial.feed_url, start, end);
+                return;
+            }
+            loadCalendarWindow(initial.feed_url, start, end).done(function() {
+                success(calendarEventsIn(start, end));
+                prefetchCalendarWindows(initial.feed_url, start, end);
+            }).fail(failure);
+        }
+    });
+    calendar.render();
+}
+
 // Load analytics
 function loadAnalytics(startDate, endDate) {
     $.get('/api/analytics/', {
@@ -204,6 +354,7 @@ function updateAnalyticsCharts(data) {
     
     // Update case distribution chart
     if (window.caseChart) {
+        window.caseChart.data.labels = data.case_distribution.labels;
         window.caseChart.data.datasets[0].data = data.case_distribution.values;
         window.caseChart.update();
     }
@@ -291,5 +442,6 @@ function initializeCharts() {
 // Initialize when page loads
 $(window).on('load', function() {
     initializeCharts();
+    initCalendar();
     loadTimeEntries();
 });
\ No newline at end of file